@@ -24,6 +24,51 @@ TIME_FORMAT_HA = "%Y-%m-%dT%H:%M:%S%z"
 TIMEOUT = 60 * 5
 CONFIG_REFRESH_PERIOD = 60 * 8
 
+# Coarse to fine charge search, the coarse scan tries every Nth SOC
+OPTIMISE_COARSE_STRIDE = 4
+
+# Discharge window patterns tried by the price band optimiser, every modulo'th group of divide windows in price order
+OPTIMISE_DISCHARGE_MODULO = [2, 3, 4, 6, 8, 16, 32]
+OPTIMISE_DISCHARGE_DIVIDE = [96, 48, 32, 16, 8, 4, 3, 2, 1]
+
+# Discharge window beam search, the number of plans kept at each step and the most steps the windows are split into
+OPTIMISE_DISCHARGE_BEAM = 2
+OPTIMISE_DISCHARGE_BEAM_STEPS = 8
+
+# Margin added to the metric a scenario must beat before it is pruned, covers rounding of the results
+OPTIMISE_PRUNE_MARGIN = 0.1
+
+# Dynamic programming optimiser, the battery SOC is split into this many buckets and the best plan ending in each is kept
+OPTIMISE_DP_BUCKETS = 20
+
+# Most combinations of levels the dynamic programming optimiser tries for windows which start together, the levels are thinned out beyond this
+OPTIMISE_DP_STAGE_OPTIONS = 200
+
+# Region optimisation launches the plans for this many following regions which share no windows with the current region while it is optimised
+OPTIMISE_REGION_PREFETCH = 1
+
+# Prediction scheduler, the number of chunks kept running for each worker, those beyond it wait in a queue where they can be cancelled
+SCHEDULER_QUEUE_DEPTH = 2
+
+# Seconds to wait for a chunk to finish before checking the workers running them are still alive
+SCHEDULER_WAIT = 0.5
+
+# Price band batches are split into this many chunks per worker so the chunks still queued can be launched again with a tighter prune bound
+SCHEDULER_BATCH_CHUNKS = 4
+
+# History is fetched incrementally, a full fetch is made if the last fetch is older than this many minutes
+HISTORY_MAX_GAP = 60
+
+# History is saved to the cache directory at most this often in minutes so a restart only needs to fetch the tail
+HISTORY_CACHE_SAVE_PERIOD = 30
+
+# Maximum number of history requests made to HA at once
+HISTORY_FETCH_THREADS = 4
+
+# State writes to HA are queued and sent in the background, this many at once, checking the queue every interval seconds
+HA_WRITE_CONCURRENCY = 8
+HA_WRITE_INTERVAL = 0.2
+
 # 240v x 100 amps x 3 phases / 1000 to kW / 60 minutes in an hour is the maximum kWh in a 1 minute period
 MAX_INCREMENT = 240 * 100 * 3 / 1000 / 60
 MINUTE_WATT = 60 * 1000
@@ -528,6 +573,27 @@ CONFIG_ITEMS = [
         "enable": "expert_mode",
         "default": False,
     },
+    {
+        "name": "calculate_coarse_to_fine",
+        "friendly_name": "Calculate charge levels coarse to fine (faster)",
+        "type": "switch",
+        "enable": "expert_mode",
+        "default": False,
+    },
+    {
+        "name": "calculate_discharge_greedy",
+        "friendly_name": "Calculate discharge windows with a beam search (faster)",
+        "type": "switch",
+        "enable": "expert_mode",
+        "default": False,
+    },
+    {
+        "name": "calculate_dynamic_programming",
+        "friendly_name": "Calculate plan with dynamic programming (experimental)",
+        "type": "switch",
+        "enable": "expert_mode",
+        "default": False,
+    },
     {
         "name": "calculate_secondary_order",
         "friendly_name": "Calculate secondary order slots",
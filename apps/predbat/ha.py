@@ -13,13 +13,16 @@ import os
 import re
 import time
 import math
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import asyncio
-from aiohttp import web, ClientSession, WSMsgType
+from aiohttp import web, ClientSession, ClientTimeout, WSMsgType
 import json
+import gzip
 import requests
 import traceback
-from config import TIME_FORMAT_HA, TIMEOUT
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import TIME_FORMAT_HA, HISTORY_MAX_GAP, HISTORY_CACHE_SAVE_PERIOD, HISTORY_FETCH_THREADS, HA_WRITE_CONCURRENCY, HA_WRITE_INTERVAL
 
 
 class HAInterface:
@@ -34,10 +37,16 @@ class HAInterface:
         self.ha_url = base.args.get("ha_url", "http://supervisor/core")
         self.ha_key = base.args.get("ha_key", os.environ.get("SUPERVISOR_TOKEN", None))
         self.websocket_active = False
+        self.http_client = base.http_client
 
         self.base = base
         self.log = base.log
         self.state_data = {}
+        self.write_queue = {}
+        self.write_lock = threading.Lock()
+        self.write_task_active = False
+        self.history_store = {}
+        self.history_cache_path = base.config_root + "/cache"
         self.slug = None
 
         if not self.ha_key:
@@ -59,6 +68,7 @@ class HAInterface:
                 self.base.create_task(self.socketLoop())
                 self.websocket_active = True
                 self.log("Info: Web Socket task started")
+                self.base.create_task(self.write_loop())
 
     def get_slug(self):
         """
@@ -231,9 +241,191 @@ class HAInterface:
 
         start = now - timedelta(days=days)
         end = now
+
+        # Only fetch the history since the last fetch, unless the day has changed or it's been too long
+        key = (sensor.lower(), days)
+        stored = self.history_store.get(key, None)
+        if not stored:
+            stored = self.load_history_cache(key, now, start)
+        if stored and stored["date"] == now.date() and timedelta(seconds=0) <= (now - stored["fetched"]) <= timedelta(minutes=HISTORY_MAX_GAP):
+            history = self.get_history_delta(sensor, stored, start, end)
+            if history is not None:
+                if (now - stored["saved"]) >= timedelta(minutes=HISTORY_CACHE_SAVE_PERIOD):
+                    self.save_history_cache(key, stored, now)
+                return [history]
+
         res = self.api_call("/api/history/period/{}".format(start.strftime(TIME_FORMAT_HA)), {"filter_entity_id": sensor, "end_time": end.strftime(TIME_FORMAT_HA)})
+        if res and isinstance(res, list) and isinstance(res[0], list):
+            self.history_store[key] = {"history": list(res[0]), "date": now.date(), "fetched": now, "saved": now}
+            self.save_history_cache(key, self.history_store[key], now)
+        else:
+            self.history_store.pop(key, None)
         return res
 
+    def history_cache_filename(self, key):
+        """
+        Get the filename of the history cache for a sensor and number of days
+        """
+        sensor, days = key
+        return self.history_cache_path + "/history_" + re.sub(r"[^a-z0-9_.]", "_", sensor) + "_" + str(days) + ".json.gz"
+
+    def save_history_cache(self, key, stored, now):
+        """
+        Save the stored history for a sensor to the cache directory, held by column with repeated values stored once
+        """
+        stored["saved"] = now
+        if not self.history_cache_path:
+            return
+        history = stored["history"]
+        columns = {}
+        for column in sorted(set(name for item in history for name in item)):
+            values = []
+            lookup = {}
+            index = []
+            for item in history:
+                if column not in item:
+                    index.append(-1)
+                    continue
+                value = item[column]
+                if isinstance(value, (dict, list)):
+                    # Attributes can't be hashed, they rarely change so are only stored again when they differ from the last ones
+                    if not values or values[-1] != value:
+                        values.append(value)
+                    index.append(len(values) - 1)
+                    continue
+                # The type is part of the key so 1, 1.0 and True are kept apart
+                value_key = (type(value), value)
+                if value_key not in lookup:
+                    lookup[value_key] = len(values)
+                    values.append(value)
+                index.append(lookup[value_key])
+            columns[column] = {"values": values, "index": index}
+
+        data = {
+            "sensor": key[0],
+            "days": key[1],
+            "date": stored["date"].isoformat(),
+            "fetched": stored["fetched"].strftime(TIME_FORMAT_HA),
+            "length": len(history),
+            "columns": columns,
+        }
+        filename = self.history_cache_filename(key)
+        try:
+            if not os.path.exists(self.history_cache_path):
+                os.makedirs(self.history_cache_path)
+            with gzip.open(filename + ".tmp", "wt") as f:
+                json.dump(data, f)
+            os.replace(filename + ".tmp", filename)
+        except OSError as e:
+            self.log("Warn: Unable to save history cache {}, error {}".format(filename, e))
+
+    def load_history_cache(self, key, now, start):
+        """
+        Load the stored history for a sensor from the cache directory, only the tail since it was saved then needs to be fetched
+        Returns the stored history or None if there is no usable cache
+        """
+        if not self.history_cache_path:
+            return None
+        filename = self.history_cache_filename(key)
+        if not os.path.exists(filename):
+            return None
+        try:
+            with gzip.open(filename, "rt") as f:
+                data = json.load(f)
+            fetched = self.base.str2time(data["fetched"])
+            date = datetime.strptime(data["date"], "%Y-%m-%d").date()
+            history = [{} for index in range(data["length"])]
+            for column, encoded in data["columns"].items():
+                values = encoded["values"]
+                for item, index in zip(history, encoded["index"]):
+                    if index >= 0:
+                        item[column] = values[index]
+        except (OSError, EOFError, ValueError, TypeError, KeyError, IndexError) as e:
+            self.log("Warn: Unable to load history cache {}, error {}".format(filename, e))
+            return None
+
+        # The cache must still cover the start of the period
+        if data.get("sensor") != key[0] or data.get("days") != key[1] or fetched <= start or fetched > now:
+            return None
+
+        # Keep when it was fetched so only the tail is fetched if it's still recent, otherwise get_history fetches it all again
+        stored = {"history": history, "date": date, "fetched": fetched, "saved": now}
+        self.history_store[key] = stored
+        return stored
+
+    def get_history_multiple(self, sensors, now, days=30):
+        """
+        Get the history for several sensors from Home Assistant, the requests are made concurrently over the shared session.
+
+        :param sensors: The sensors to get the history for.
+        :return: A list of the history for each sensor, None for those which failed.
+        """
+        unique = list(dict.fromkeys(sensors))
+        if not self.ha_key or len(unique) <= 1:
+            results = [self.get_history_safe(sensor, now, days=days) for sensor in unique]
+        else:
+            with ThreadPoolExecutor(max_workers=min(len(unique), HISTORY_FETCH_THREADS)) as executor:
+                results = list(executor.map(lambda sensor: self.get_history_safe(sensor, now, days=days), unique))
+        history = dict(zip(unique, results))
+        return [history[sensor] for sensor in sensors]
+
+    def get_history_safe(self, sensor, now, days=30):
+        """
+        Get the history for a sensor, returns None if it fails so one bad sensor doesn't stop the others being fetched
+        """
+        try:
+            return self.get_history(sensor, now, days=days)
+        except (ValueError, TypeError) as e:
+            self.log("Warn: Failed to fetch history for {}, error {}".format(sensor, e))
+            return None
+
+    def get_history_delta(self, sensor, stored, start, end):
+        """
+        Update stored history for a sensor with the changes since the last item and drop items before the start
+        Returns the updated history or None if a full fetch is needed
+        """
+        history = stored["history"]
+        if not history:
+            return None
+        try:
+            last_time = self.base.str2time(history[-1]["last_updated"])
+        except (ValueError, TypeError, KeyError):
+            return None
+
+        res = self.api_call("/api/history/period/{}".format(last_time.strftime(TIME_FORMAT_HA)), {"filter_entity_id": sensor, "end_time": end.strftime(TIME_FORMAT_HA)})
+        if not res or not isinstance(res, list) or not isinstance(res[0], list):
+            return None
+
+        # Append new items, the first returned item is the state at the start of the period which we already have
+        for item in res[0]:
+            try:
+                item_time = self.base.str2time(item["last_updated"])
+            except (ValueError, TypeError, KeyError):
+                continue
+            if item_time > last_time:
+                history.append(item)
+                last_time = item_time
+
+        # Drop items before the start, the last one becomes the state at the start as HA would return it
+        first = 0
+        for index in range(len(history)):
+            try:
+                if self.base.str2time(history[index]["last_updated"]) > start:
+                    break
+            except (ValueError, TypeError, KeyError):
+                pass
+            first = index
+        if first > 0 or self.base.str2time(history[0]["last_updated"]) < start:
+            item = history[first].copy()
+            item["last_updated"] = start.strftime(TIME_FORMAT_HA)
+            if "last_changed" in item:
+                item["last_changed"] = item["last_updated"]
+            history = [item] + history[first + 1 :]
+
+        stored["history"] = history
+        stored["fetched"] = end
+        return list(history)
+
     def set_state(self, entity_id, state, attributes={}):
         """
         Set the state of an entity in Home Assistant.
@@ -247,9 +439,97 @@ class HAInterface:
         data = {"state": state}
         if attributes:
             data["attributes"] = attributes
+
+        if self.websocket_active and self.write_task_active:
+            # Write behind, repeated writes to an entity are combined and the web socket will deliver the new state so it's not read back
+            previous = self.state_data.get(entity_id.lower(), {})
+            if previous and previous.get("state", None) == state:
+                last_changed = previous.get("last_changed", None)
+            else:
+                last_changed = datetime.now(timezone.utc).isoformat()
+            self.update_state_item({"entity_id": entity_id, "state": state, "attributes": attributes if attributes else {}, "last_changed": last_changed})
+            with self.write_lock:
+                # The task may have stopped since the check above, it takes the lock to stop so once queued the write is flushed
+                if self.write_task_active:
+                    self.write_queue[entity_id] = data
+                    return
+
         self.api_call("/api/states/{}".format(entity_id), data, post=True)
         self.update_state(entity_id)
 
+    def take_writes(self):
+        """
+        Take all of the queued state writes
+        """
+        with self.write_lock:
+            writes = self.write_queue
+            self.write_queue = {}
+        return writes
+
+    async def flush_writes(self, post):
+        """
+        Send all of the queued state writes concurrently using the post coroutine
+        """
+        writes = self.take_writes()
+        if not writes:
+            return 0
+        semaphore = asyncio.Semaphore(HA_WRITE_CONCURRENCY)
+
+        async def send(entity_id, data):
+            async with semaphore:
+                try:
+                    await post(entity_id, data)
+                except Exception as e:
+                    self.log("Warn: Failed to write state for {} to Home Assistant, error {}".format(entity_id, e))
+                    self.write_failed(entity_id)
+
+        await asyncio.gather(*[send(entity_id, data) for entity_id, data in writes.items()])
+        return len(writes)
+
+    def write_failed(self, entity_id):
+        """
+        A queued write didn't reach Home Assistant, forget the local copy of the state so the next publish writes it again
+        """
+        with self.write_lock:
+            if entity_id in self.write_queue:
+                # A newer write is queued and will be sent instead
+                return
+            self.state_data.pop(entity_id.lower(), None)
+        self.base.published_state.pop(entity_id, None)
+
+    async def write_loop(self):
+        """
+        Write behind loop, sends queued state writes to Home Assistant in the background
+        """
+        headers = {
+            "Authorization": "Bearer " + self.ha_key,
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+        async with ClientSession(timeout=ClientTimeout(total=self.http_client.timeout)) as session:
+
+            async def post(entity_id, data):
+                async with session.post(self.ha_url + "/api/states/{}".format(entity_id), headers=headers, json=data) as response:
+                    if response.status not in [200, 201]:
+                        raise ValueError("status {}".format(response.status))
+
+            with self.write_lock:
+                self.write_task_active = True
+            self.log("Info: Write behind task started")
+            try:
+                while not self.base.stop_thread:
+                    if not await self.flush_writes(post):
+                        await asyncio.sleep(HA_WRITE_INTERVAL)
+            except Exception as e:
+                self.log("Error: Write behind task exception {}".format(e))
+                self.log("Error: " + traceback.format_exc())
+            finally:
+                # Writes are made directly from now on, send anything left
+                with self.write_lock:
+                    self.write_task_active = False
+                await self.flush_writes(post)
+            self.log("Info: Write behind task stopping")
+
     def call_service(self, service, **kwargs):
         """
         Call a service in Home Assistant.
@@ -283,14 +563,14 @@ class HAInterface:
         }
         if post:
             if data_in:
-                response = requests.post(url, headers=headers, json=data_in, timeout=TIMEOUT)
+                response = self.http_client.post(url, headers=headers, json=data_in)
             else:
-                response = requests.post(url, headers=headers, timeout=TIMEOUT)
+                response = self.http_client.post(url, headers=headers)
         else:
             if data_in:
-                response = requests.get(url, headers=headers, params=data_in, timeout=TIMEOUT)
+                response = self.http_client.get(url, headers=headers, params=data_in)
             else:
-                response = requests.get(url, headers=headers, timeout=TIMEOUT)
+                response = self.http_client.get(url, headers=headers)
         try:
             data = response.json()
         except requests.exceptions.JSONDecodeError:
@@ -0,0 +1,112 @@
+# -----------------------------------------------------------------------------
+# Predbat Home Battery System
+# Copyright Trefor Southwell 2024 - All Rights Reserved
+# This application maybe used for personal use only and not for commercial use
+# -----------------------------------------------------------------------------
+# fmt off
+# pylint: disable=consider-using-f-string
+# pylint: disable=line-too-long
+# pylint: disable=attribute-defined-outside-init
+
+import time
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import TIMEOUT
+
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = 10
+
+# Stats are kept per route, the path is cut at this many segments or the first which holds an id, a timestamp or an entity name
+HTTP_STATS_ROUTE_DEPTH = 3
+HTTP_STATS_MAX_ROUTES = 100
+
+
+class HttpClient:
+    """
+    Shared HTTP client for all outbound requests
+    Connections are kept alive in a pool per host and the latency of each endpoint is recorded
+
+    Each thread makes its requests through its own session as a session isn't safe to share between threads,
+    the sessions all use the same adapter so the connection pool is still shared
+    """
+
+    def __init__(self, timeout=TIMEOUT, retries=0):
+        self.timeout = timeout
+        # Only idempotent requests are retried, writes to inverters have their own retry logic
+        self.adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=Retry(total=retries, backoff_factor=0.5, raise_on_status=False)
+        )
+        self.local = threading.local()
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    @property
+    def session(self):
+        """
+        The session for the calling thread
+        """
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", self.adapter)
+            session.mount("https://", self.adapter)
+            self.local.session = session
+        return session
+
+    def request(self, method, url, **kwargs):
+        """
+        Make a request using the shared session, the default timeout is used if none is given
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.time()
+        failed = True
+        try:
+            response = self.session.request(method, url, **kwargs)
+            failed = False
+            return response
+        finally:
+            self.record(method, url, time.time() - start, failed)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def route(self, path):
+        """
+        Reduce a path to its route so that requests for different entities, timestamps or ids are counted together
+        """
+        route = []
+        for segment in path.split("/")[1:]:
+            if len(route) >= HTTP_STATS_ROUTE_DEPTH or "." in segment or sum(char.isdigit() for char in segment) > 1:
+                break
+            route.append(segment)
+        return "/" + "/".join(route)
+
+    def record(self, method, url, latency, failed=False):
+        """
+        Record the latency of a request against its endpoint (method, host and route of the path)
+        Once HTTP_STATS_MAX_ROUTES endpoints are known any new ones are counted together as other
+        """
+        parts = urlsplit(url)
+        endpoint = "{} {}://{}{}".format(method, parts.scheme, parts.netloc, self.route(parts.path))
+        with self.lock:
+            if endpoint not in self.stats and len(self.stats) >= HTTP_STATS_MAX_ROUTES:
+                endpoint = "other"
+            stats = self.stats.setdefault(endpoint, {"count": 0, "errors": 0, "total": 0.0, "max": 0.0})
+            stats["count"] += 1
+            stats["total"] += latency
+            stats["max"] = max(stats["max"], latency)
+            if failed:
+                stats["errors"] += 1
+
+    def get_stats(self):
+        """
+        Returns the stats for each endpoint including the average latency in seconds
+        """
+        with self.lock:
+            return {endpoint: dict(stats, average=stats["total"] / stats["count"]) for endpoint, stats in self.stats.items()}
@@ -436,10 +436,10 @@ class Inverter:
         if soc_kwh_sensor and charge_rate_sensor and battery_power_sensor and predbat_status_sensor:
             battery_power_sensor = battery_power_sensor.replace("number.", "sensor.")  # Workaround as old template had number.
             self.log("Find {} curve with sensors {} and {} and {} and {}".format(curve_type, soc_kwh_sensor, charge_rate_sensor, predbat_status_sensor, battery_power_sensor))
-            soc_kwh_data = self.base.get_history_wrapper(entity_id=soc_kwh_sensor, days=self.base.max_days_previous)
-            charge_rate_data = self.base.get_history_wrapper(entity_id=charge_rate_sensor, days=self.base.max_days_previous)
-            predbat_status_data = self.base.get_history_wrapper(entity_id=predbat_status_sensor, days=self.base.max_days_previous)
-            battery_power_data = self.base.get_history_wrapper(entity_id=battery_power_sensor, days=self.base.max_days_previous)
+            # A history which failed to fetch is None, it is reported as missing history below
+            soc_kwh_data, charge_rate_data, predbat_status_data, battery_power_data = self.base.get_history_wrapper_multiple(
+                [soc_kwh_sensor, charge_rate_sensor, predbat_status_sensor, battery_power_sensor], days=self.base.max_days_previous
+            )
 
             if soc_kwh_data and charge_rate_data and charge_rate_data and battery_power_data:
                 soc_kwh = self.base.minute_data(
@@ -2021,7 +2021,7 @@ class Inverter:
         """
         url = self.rest_api + "/" + api
         try:
-            r = requests.get(url)
+            r = self.base.http_client.get(url)
         except Exception as e:
             self.base.log("Error: Exception raised {}".format(e))
             r = None
@@ -2061,7 +2061,7 @@ class Inverter:
         url = self.rest_api + "/setChargeTarget"
         data = {"chargeToPercent": target}
         for retry in range(5):
-            r = requests.post(url, json=data)
+            r = self.base.http_client.post(url, json=data)
             # time.sleep(10)
             self.rest_data = self.rest_runAll(self.rest_data)
             if float(self.rest_data["Control"]["Target_SOC"]) == target:
@@ -2080,7 +2080,7 @@ class Inverter:
         url = self.rest_api + "/setChargeRate"
         data = {"chargeRate": rate}
         for retry in range(5):
-            r = requests.post(url, json=data)
+            r = self.base.http_client.post(url, json=data)
             # time.sleep(10)
             self.rest_data = self.rest_runAll(self.rest_data)
             new = int(self.rest_data["Control"]["Battery_Charge_Rate"])
@@ -2100,7 +2100,7 @@ class Inverter:
         url = self.rest_api + "/setDischargeRate"
         data = {"dischargeRate": rate}
         for retry in range(5):
-            r = requests.post(url, json=data)
+            r = self.base.http_client.post(url, json=data)
             # time.sleep(10)
             self.rest_data = self.rest_runAll(self.rest_data)
             new = int(self.rest_data["Control"]["Battery_Discharge_Rate"])
@@ -2122,7 +2122,7 @@ class Inverter:
         data = {"mode": inverter_mode}
 
         for retry in range(5):
-            r = requests.post(url, json=data)
+            r = self.base.http_client.post(url, json=data)
             # time.sleep(10)
             self.rest_data = self.rest_runAll(self.rest_data)
             if inverter_mode == self.rest_data["Control"]["Mode"]:
@@ -2142,7 +2142,7 @@ class Inverter:
         url = self.rest_api + "/setBatteryReserve"
         data = {"reservePercent": target}
         for retry in range(5):
-            r = requests.post(url, json=data)
+            r = self.base.http_client.post(url, json=data)
             # time.sleep(10)
             self.rest_data = self.rest_runAll(self.rest_data)
             result = int(float(self.rest_data["Control"]["Battery_Power_Reserve"]))
@@ -2162,7 +2162,7 @@ class Inverter:
         data = {"state": "enable" if enable else "disable"}
 
         for retry in range(5):
-            r = requests.post(url, json=data)
+            r = self.base.http_client.post(url, json=data)
             # time.sleep(10)
             self.rest_data = self.rest_runAll(self.rest_data)
             new_value = self.rest_data["Control"]["Enable_Charge_Schedule"]
@@ -2187,7 +2187,7 @@ class Inverter:
         data = {"start": start[:5], "finish": finish[:5]}
 
         for retry in range(5):
-            r = requests.post(url, json=data)
+            r = self.base.http_client.post(url, json=data)
             # time.sleep(10)
             self.rest_data = self.rest_runAll(self.rest_data)
             if self.rest_data["Timeslots"]["Charge_start_time_slot_1"] == start and self.rest_data["Timeslots"]["Charge_end_time_slot_1"] == finish:
@@ -2206,7 +2206,7 @@ class Inverter:
         data = {"start": start[:5], "finish": finish[:5]}
 
         for retry in range(5):
-            r = requests.post(url, json=data)
+            r = self.base.http_client.post(url, json=data)
             # time.sleep(10)
             self.rest_data = self.rest_runAll(self.rest_data)
             if self.rest_data["Timeslots"]["Discharge_start_time_slot_1"] == start and self.rest_data["Timeslots"]["Discharge_end_time_slot_1"] == finish:
@@ -15,6 +15,8 @@ import time
 import math
 import sys
 from datetime import datetime, timedelta
+from itertools import product
+from collections import ChainMap
 import hashlib
 import traceback
 
@@ -29,11 +31,12 @@ import pytz
 import requests
 import yaml
 from multiprocessing import Pool, cpu_count, set_start_method
+from multiprocessing.pool import ThreadPool
 import asyncio
 import json
 
 THIS_VERSION = "v8.4.2"
-PREDBAT_FILES = ["predbat.py", "config.py", "prediction.py", "utils.py", "inverter.py", "ha.py", "download.py", "unit_test.py", "web.py"]
+PREDBAT_FILES = ["predbat.py", "config.py", "prediction.py", "utils.py", "inverter.py", "ha.py", "download.py", "unit_test.py", "web.py", "httpclient.py", "scheduler.py"]
 from download import predbat_update_move, predbat_update_download, check_install
 
 # Sanity check the install and re-download if corrupted
@@ -55,6 +58,16 @@ from config import (
     TIME_FORMAT_SECONDS,
     TIME_FORMAT_OCTOPUS,
     PREDICT_STEP,
+    OPTIMISE_COARSE_STRIDE,
+    OPTIMISE_DISCHARGE_MODULO,
+    OPTIMISE_DISCHARGE_DIVIDE,
+    OPTIMISE_DISCHARGE_BEAM,
+    OPTIMISE_DISCHARGE_BEAM_STEPS,
+    OPTIMISE_PRUNE_MARGIN,
+    OPTIMISE_DP_BUCKETS,
+    OPTIMISE_DP_STAGE_OPTIONS,
+    OPTIMISE_REGION_PREFETCH,
+    SCHEDULER_BATCH_CHUNKS,
     MINUTE_WATT,
     PREDBAT_MODE_OPTIONS,
     PREDBAT_MODE_MONITOR,
@@ -70,30 +83,35 @@ from config import (
     TIME_FORMAT_HA,
     TIMEOUT,
 )
-from prediction import Prediction, wrapped_run_prediction_single, wrapped_run_prediction_charge, wrapped_run_prediction_discharge, reset_prediction_globals
-from utils import remove_intersecting_windows, get_charge_rate_curve, get_discharge_rate_curve, find_charge_rate, calc_percent_limit
+from prediction import (
+    Prediction,
+    reset_prediction_globals,
+    prediction_worker_init,
+    PredictionShared,
+    PredictionCacheHandle,
+    PredictionBatchHandle,
+    PredictionPendingHandle,
+    prediction_cache_key,
+    PREDICT_RESULT_CHARGE,
+)
+from utils import (
+    remove_intersecting_windows,
+    get_charge_rate_curve,
+    get_discharge_rate_curve,
+    find_charge_rate,
+    calc_percent_limit,
+    compile_rate_curve_tables,
+    WindowIndex,
+    MinuteSeries,
+    str2time,
+    add_repeated,
+)
 from inverter import Inverter
 from ha import HAInterface
+from httpclient import HttpClient
+from scheduler import PredictionScheduler, ReadyResult
 from web import WebInterface
 
-"""
-Used to mimic threads when they are disabled
-"""
-
-
-class DummyThread:
-    def __init__(self, result):
-        """
-        Store the data into the class
-        """
-        self.result = result
-
-    def get(self):
-        """
-        Return the result
-        """
-        return self.result
-
 
 class PredBat(hass.Hass):
     """
@@ -249,7 +267,7 @@ class PredBat(hass.Hass):
                 return pdata
 
         self.log("Fetching {}".format(url))
-        r = requests.get(url, headers=headers)
+        r = self.http_client.get(url, headers=headers)
         try:
             data = r.json()
         except requests.exceptions.JSONDecodeError:
@@ -355,7 +373,7 @@ class PredBat(hass.Hass):
                 return pdata
 
         try:
-            r = requests.get(url)
+            r = self.http_client.get(url)
         except Exception:
             self.log("Warn: Unable to load data from Github URL: {}".format(url))
             return []
@@ -671,7 +689,7 @@ class PredBat(hass.Hass):
 
         if self.debug_enable:
             self.log("Download {}".format(url))
-        r = requests.get(url)
+        r = self.http_client.get(url)
         if r.status_code not in [200, 201]:
             self.log("Warn: Error downloading futurerate data from URL {}, code {}".format(url, r.status_code))
             self.record_status("Warn: Error downloading futurerate data from cloud", debug=url, had_errors=True)
@@ -701,7 +719,7 @@ class PredBat(hass.Hass):
         while url and pages < 3:
             if self.debug_enable:
                 self.log("Download {}".format(url))
-            r = requests.get(url)
+            r = self.http_client.get(url)
             if r.status_code not in [200, 201]:
                 self.log("Warn: Error downloading Octopus data from URL {}, code {}".format(url, r.status_code))
                 self.record_status("Warn: Error downloading Octopus data from cloud", debug=url, had_errors=True)
@@ -753,7 +771,7 @@ class PredBat(hass.Hass):
 
         # Perform fetch
         self.log("Fetching {}".format(url))
-        r = requests.get(url, params=params)
+        r = self.http_client.get(url, params=params)
         if r.status_code not in [200, 201]:
             self.log("Warn: Error downloading data from url {}, code {}".format(url, r.status_code))
         else:
@@ -914,13 +932,7 @@ class PredBat(hass.Hass):
         return minutes
 
     def str2time(self, str):
-        if "." in str:
-            tdata = datetime.strptime(str, TIME_FORMAT_SECONDS)
-        elif "T" in str:
-            tdata = datetime.strptime(str, TIME_FORMAT)
-        else:
-            tdata = datetime.strptime(str, TIME_FORMAT_OCTOPUS)
-        return tdata
+        return str2time(str)
 
     def load_car_energy(self, now_utc):
         """
@@ -939,6 +951,16 @@ class PredBat(hass.Hass):
         """
         return self.get_history(entity_id=entity_id, days=days)
 
+    def get_history_wrapper_multiple(self, entity_ids, days=30):
+        """
+        Wrapper function to get history for several entities from HA at once, returns None for any that fail
+        """
+        histories = self.ha_interface.get_history_multiple(entity_ids, days=days, now=self.now)
+        for entity_id, history in zip(entity_ids, histories):
+            if history is None:
+                self.log("Error: Failure to fetch history for {}".format(entity_id))
+        return histories
+
     def get_state_wrapper(self, entity_id=None, default=None, attribute=None, refresh=False):
         """
         Wrapper function to get state from HA
@@ -982,12 +1004,8 @@ class PredBat(hass.Hass):
             entity_ids = [entity_ids]
 
         import_today = {}
-        for entity_id in entity_ids:
-            try:
-                history = self.get_history_wrapper(entity_id=entity_id, days=self.max_days_previous)
-            except (ValueError, TypeError):
-                history = []
-
+        histories = self.get_history_wrapper_multiple(entity_ids, days=self.max_days_previous)
+        for entity_id, history in zip(entity_ids, histories):
             if history:
                 import_today = self.minute_data(
                     history[0],
@@ -1019,12 +1037,8 @@ class PredBat(hass.Hass):
 
         load_minutes = {}
         age_days = None
-        for entity_id in entity_ids:
-            try:
-                history = self.get_history_wrapper(entity_id=entity_id, days=max_days_previous)
-            except ValueError:
-                history = []
-
+        histories = self.get_history_wrapper_multiple(entity_ids, days=max_days_previous)
+        for entity_id, history in zip(entity_ids, histories):
             if history:
                 item = history[0][0]
                 try:
@@ -1293,6 +1307,16 @@ class PredBat(hass.Hass):
                 prev_last_updated_time = last_updated_time
             last_state = state
 
+        # Incrementing data is dense once cleaned so is held as a series, gaps are filled with the last values
+        if clean_increment:
+            mdata = MinuteSeries.from_history(mdata, 0 if to_key else 60 * 24 * days, newest_state)
+            mdata.clean_incrementing_reverse(max_increment)
+            if accumulate:
+                mdata.accumulate(accumulate, 60 * 24 * days)
+            if adjust_key:
+                self.io_adjusted = adata
+            return mdata.round(4)
+
         # If we only have a start time then fill the gaps with the last values
         if not to_key:
             state = newest_state
@@ -1302,10 +1326,6 @@ class PredBat(hass.Hass):
                 mdata[rindex] = state
                 minute += 1
 
-        # Reverse data with smoothing
-        if clean_increment:
-            mdata = self.clean_incrementing_reverse(mdata, max_increment)
-
         # Accumulate to previous data?
         if accumulate:
             for minute in range(60 * 24 * days):
@@ -1412,28 +1432,10 @@ class PredBat(hass.Hass):
         Cleanup an incrementing sensor data that runs backwards in time to remove the
         resets (where it goes back to 0) and make it always increment
         """
-        new_data = {}
-        length = max(data) + 1
-
-        increment = 0
-        last = data[length - 1]
-
-        for index in range(length):
-            rindex = length - index - 1
-            nxt = data.get(rindex, last)
-            if nxt >= last:
-                if (max_increment > 0) and ((nxt - last) > max_increment):
-                    # Smooth out big spikes
-                    pass
-                else:
-                    increment += nxt - last
-                last = nxt
-            elif nxt < last:
-                if nxt <= 0 or ((last - nxt) >= (1.0)):
-                    last = nxt
-            new_data[rindex] = increment
-
-        return new_data
+        if not isinstance(data, MinuteSeries):
+            # Missing minutes take the previous value which leaves the increment unchanged
+            data = MinuteSeries.from_history(data, 0)
+        return MinuteSeries(data.data).clean_incrementing_reverse(max_increment)
 
     def get_filtered_load_minute(self, data, minute_previous, historical, step=1):
         """
@@ -1470,6 +1472,52 @@ class PredBat(hass.Hass):
 
         return load_yesterday, load_yesterday_raw
 
+    def get_filtered_load_history(self, data, minutes, step, historical=True):
+        """
+        Gets the previous load for each of the given minutes after filtering for car charging
+        The same as calling get_filtered_load_minute for each minute but each series is only differentiated once
+        Returns a list of load and a list of raw load
+        """
+        if not minutes:
+            return [], []
+        length = max(minutes) + step
+        if historical:
+            get_array = self.get_historical_array
+        else:
+            get_array = self.get_increment_array
+        load_history = get_array(data, length)
+        car_history = None
+        iboost_history = None
+        if self.car_charging_hold and self.car_charging_energy:
+            car_history = get_array(self.car_charging_energy, length)
+        if self.iboost_energy_subtract and self.iboost_energy_today:
+            iboost_history = get_array(self.iboost_energy_today, length)
+        car_hold_threshold = self.car_charging_hold and (not self.car_charging_energy)
+
+        loads = []
+        loads_raw = []
+        for minute in minutes:
+            load_yesterday_raw = 0
+            for offset in range(step):
+                load_yesterday_raw += load_history[minute + offset]
+
+            # Subtract car charging energy and iboost energy (if enabled)
+            subtract_energy = 0
+            for offset in range(step):
+                if car_history:
+                    subtract_energy += car_history[minute + offset]
+                if iboost_history:
+                    subtract_energy += iboost_history[minute + offset]
+            load_yesterday = max(0, load_yesterday_raw - subtract_energy)
+
+            if car_hold_threshold and (load_yesterday >= (self.car_charging_threshold * step)):
+                # Car charging hold - ignore car charging in computation based on threshold
+                load_yesterday = max(load_yesterday - (self.car_charging_rate[0] * step / 60.0), 0)
+
+            loads.append(load_yesterday)
+            loads_raw.append(load_yesterday_raw)
+        return loads, loads_raw
+
     def previous_days_modal_filter(self, data):
         """
         Look at the data from previous days and discard the best case one
@@ -1481,14 +1529,19 @@ class PredBat(hass.Hass):
         min_sum = 99999999
         min_sum_day = 0
 
-        idx = 0
+        # Minutes ago of each step of each previous day, the series are differentiated once for all of the days
+        day_minutes = {}
         for days in self.days_previous:
             use_days = max(min(days, self.load_minutes_age), 1)
-            sum_day = 0
             full_days = 24 * 60 * (use_days - 1)
-            for minute in range(0, 24 * 60, PREDICT_STEP):
-                minute_previous = 24 * 60 - minute + full_days
-                load_yesterday, load_yesterday_raw = self.get_filtered_load_minute(data, minute_previous, historical=False, step=PREDICT_STEP)
+            day_minutes[days] = [24 * 60 - minute + full_days for minute in range(0, 24 * 60, PREDICT_STEP)]
+        all_minutes = [minute_previous for days in self.days_previous for minute_previous in day_minutes[days]]
+        loads, loads_raw = self.get_filtered_load_history(data, all_minutes, PREDICT_STEP, historical=False)
+
+        idx = 0
+        for days in self.days_previous:
+            sum_day = 0
+            for load_yesterday in loads[idx * len(day_minutes[days]) : (idx + 1) * len(day_minutes[days])]:
                 sum_day += load_yesterday
             sum_days.append(self.dp2(sum_day))
             sum_days_id[days] = sum_day
@@ -1504,15 +1557,19 @@ class PredBat(hass.Hass):
             del self.days_previous[min_sum_day_idx]
             del self.days_previous_weight[min_sum_day_idx]
 
-        # Gap filling
+        # Gap filling, each fill adds to all of the more recent minutes so the fills for a day are counted for each minute
+        # and added in one sweep, add_repeated() rounds the same as adding them one at a time
         gap_size = max(self.get_arg("load_filter_threshold", 30), 5)
+        if not all_minutes:
+            return
+        length = max(all_minutes) + gap_size + 1
+        values = [data.get(minute, 0) for minute in range(length)]
+        max_fill = 0
         for days in self.days_previous:
-            use_days = max(min(days, self.load_minutes_age), 1)
+            # Gaps are where the data does not increment, including what has been added by earlier fills
             num_gaps = 0
-            full_days = 24 * 60 * (use_days - 1)
-            for minute in range(0, 24 * 60, PREDICT_STEP):
-                minute_previous = 24 * 60 - minute + full_days
-                if data.get(minute_previous, 0) == data.get(minute_previous + gap_size, 0):
+            for minute_previous in day_minutes[days]:
+                if values[minute_previous] == values[minute_previous + gap_size]:
                     num_gaps += PREDICT_STEP
 
             # If we have some gaps
@@ -1530,16 +1587,36 @@ class PredBat(hass.Hass):
                         )
                     )
 
-                # Do the filling
+                # Do the filling, a fill at a minute adds to that minute and all later ones (down to minute 1)
+                # which can close the gap for the following steps so track the number of fills as we go
                 per_minute_increment = average_day / (24 * 60)
-                for minute in range(0, 24 * 60, PREDICT_STEP):
-                    minute_previous = 24 * 60 - minute + full_days
-                    if data.get(minute_previous, 0) == data.get(minute_previous + gap_size, 0):
-                        for offset in range(minute_previous, 0, -1):
-                            if offset in data:
-                                data[offset] += per_minute_increment * PREDICT_STEP
-                            else:
-                                data[offset] = per_minute_increment * PREDICT_STEP
+                fill_amount = per_minute_increment * PREDICT_STEP
+                day_fills = []
+                day_added = 0
+                for minute_previous in day_minutes[days]:
+                    # Fills so far this day are all older than this minute, only some may be older than the end of the gap
+                    while day_added < len(day_fills) and day_fills[day_added] >= minute_previous + gap_size:
+                        day_added += 1
+                    if add_repeated(values[minute_previous], fill_amount, len(day_fills)) == add_repeated(values[minute_previous + gap_size], fill_amount, day_added):
+                        day_fills.append(minute_previous)
+
+                # Add this day's fills with one sweep down from the oldest fill
+                if day_fills:
+                    max_fill = max(max_fill, day_fills[0])
+                    count = 0
+                    fill_index = 0
+                    for minute in range(day_fills[0], 0, -1):
+                        while fill_index < len(day_fills) and day_fills[fill_index] >= minute:
+                            count += 1
+                            fill_index += 1
+                        values[minute] = add_repeated(values[minute], fill_amount, count)
+
+        # Apply the fills to the data
+        if max_fill:
+            if isinstance(data, MinuteSeries) and len(data) <= max_fill:
+                data.data.extend([0.0] * (max_fill + 1 - len(data)))
+            for minute in range(1, max_fill + 1):
+                data[minute] = values[minute]
 
     def get_historical_base(self, data, minute, base_minutes):
         """
@@ -1580,12 +1657,66 @@ class PredBat(hass.Hass):
         else:
             return total / total_weight
 
+    def get_increment_array(self, data, length):
+        """
+        Differentiate an incrementing series once, returns the increment at each index from 0 to length - 1
+        """
+        if isinstance(data, MinuteSeries):
+            values = data.data[: length + 1].tolist()
+            values += [0] * (length + 1 - len(values))
+        else:
+            values = [data.get(index, 0) for index in range(length + 1)]
+        return [max(value - previous, 0) for value, previous in zip(values, values[1:])]
+
+    def get_historical_array(self, data, count):
+        """
+        Get historical data across N previous days for minutes 0 to count - 1
+        The same as calling get_historical for each minute but the series is only differentiated once
+        """
+        # No data?
+        if not data:
+            return [0] * count
+
+        # Minutes ago for minute 0 of each previous day
+        points = []
+        for days, weight in zip(self.days_previous, self.days_previous_weight):
+            use_days = max(min(days, self.load_minutes_age), 1)
+            points.append((24 * 60 * use_days, weight))
+        if not points:
+            return [0] * count
+        increments = self.get_increment_array(data, max(offset for offset, weight in points) + 1)
+
+        total = [0] * count
+        total_weight = 0
+        for offset, weight in points:
+            total = [value + increments[offset - minute if minute <= offset else (offset - minute) % (24 * 60)] * weight for minute, value in enumerate(total)]
+            total_weight += weight
+
+        # Zero data?
+        if total_weight == 0:
+            return [0] * count
+        else:
+            return [value / total_weight for value in total]
+
+    def get_historical_base_array(self, data, base_minutes, count):
+        """
+        Get historical data from base minute ago for minutes 0 to count - 1
+        """
+        # No data?
+        if not data:
+            return [0] * count
+
+        increments = self.get_increment_array(data, max(base_minutes, 0) + 1)
+        return [increments[base_minutes - minute if minute <= base_minutes else (base_minutes - minute) % (24 * 60)] for minute in range(count)]
+
     def get_from_incrementing(self, data, index, backwards=True):
         """
         Get a single value from an incrementing series e.g. kWh today -> kWh this minute
         """
         while index < 0:
             index += 24 * 60
+        if isinstance(data, MinuteSeries):
+            return data.get_increment(index, backwards)
         if backwards:
             return max(data.get(index, 0) - data.get(index + 1, 0), 0)
         else:
@@ -1694,6 +1825,8 @@ class PredBat(hass.Hass):
     def scenario_summary_state(self, record_time):
         txt = ""
         minute_start = self.minutes_now - self.minutes_now % 30
+        charge_index = WindowIndex(self.charge_window_best)
+        discharge_index = WindowIndex(self.discharge_window_best)
         for minute_absolute in range(minute_start, self.forecast_minutes + minute_start, 30):
             minute_relative_start = max(minute_absolute - self.minutes_now, 0)
             minute_relative_end = minute_relative_start + 30
@@ -1704,13 +1837,13 @@ class PredBat(hass.Hass):
 
             charge_window_n = -1
             for try_minute in range(this_minute_absolute, minute_absolute + 30, 5):
-                charge_window_n = self.in_charge_window(self.charge_window_best, try_minute)
+                charge_window_n = charge_index.find(try_minute)
                 if charge_window_n >= 0:
                     break
 
             discharge_window_n = -1
             for try_minute in range(this_minute_absolute, minute_absolute + 30, 5):
-                discharge_window_n = self.in_charge_window(self.discharge_window_best, try_minute)
+                discharge_window_n = discharge_index.find(try_minute)
                 if discharge_window_n >= 0:
                     break
 
@@ -1929,8 +2062,8 @@ class PredBat(hass.Hass):
         load_max = 0
         look_over = 60 * 8
 
-        for minute in range(0, look_over, PREDICT_STEP):
-            load, load_raw = self.get_filtered_load_minute(load_minutes, minute, historical=True, step=PREDICT_STEP)
+        load_history, load_history_raw = self.get_filtered_load_history(load_minutes, range(0, look_over, PREDICT_STEP), PREDICT_STEP)
+        for load in load_history:
             load *= 1000 * 60 / PREDICT_STEP
             load_total += load
             load_count += 1
@@ -1938,9 +2071,7 @@ class PredBat(hass.Hass):
             load_max = max(load_max, load)
         load_mean = load_total / load_count
         load_diff_total = 0
-        for minute in range(0, look_over, PREDICT_STEP):
-            load = 0
-            load, load_raw = self.get_filtered_load_minute(load_minutes, minute, historical=True, step=PREDICT_STEP)
+        for load in load_history:
             load *= 1000 * 60 / PREDICT_STEP
             load_diff = abs(load - load_mean)
             load_diff *= load_diff
@@ -2009,7 +2140,18 @@ class PredBat(hass.Hass):
         values = {}
         cloud_diff = 0
 
-        for minute in range(0, self.forecast_minutes + 30, step):
+        # Historical data is differentiated once and weighted across the previous days for all minutes
+        count = self.forecast_minutes + 30
+        if not forward:
+            if type_load:
+                if not self.load_forecast_only:
+                    load_history, load_history_raw = self.get_filtered_load_history(item, range(0, count, step), step)
+            elif base_offset:
+                history = self.get_historical_base_array(item, base_offset, count + step)
+            else:
+                history = self.get_historical_array(item, count + step)
+
+        for minute in range(0, count, step):
             value = 0
             minute_absolute = minute + minutes_now
 
@@ -2023,19 +2165,16 @@ class PredBat(hass.Hass):
 
             if type_load and not forward:
                 if self.load_forecast_only:
-                    load_yesterday, load_yesterday_raw = (0, 0)
+                    load_yesterday = 0
                 else:
-                    load_yesterday, load_yesterday_raw = self.get_filtered_load_minute(item, minute, historical=True, step=step)
+                    load_yesterday = load_history[int(minute / step)]
                 value += load_yesterday
             else:
                 for offset in range(step):
                     if forward:
                         value += item.get(minute + minutes_now + offset, 0.0)
                     else:
-                        if base_offset:
-                            value += self.get_historical_base(item, minute + offset, base_offset)
-                        else:
-                            value += self.get_historical(item, minute + offset)
+                        value += history[minute + offset]
 
             # Extra load adding in (e.g. heat pump)
             load_extra = 0
@@ -4192,6 +4331,8 @@ class PredBat(hass.Hass):
         rowspan = 0
         in_span = False
         start_span = False
+        charge_index = WindowIndex(self.charge_window_best)
+        discharge_index = WindowIndex(self.discharge_window_best)
         for minute in range(minute_now_align, end_plan, 30):
             minute_relative = minute - self.minutes_now
             minute_relative_start = max(minute_relative, 0)
@@ -4217,12 +4358,12 @@ class PredBat(hass.Hass):
             show_limit = ""
 
             for try_minute in range(minute_start, minute_end, PREDICT_STEP):
-                charge_window_n = self.in_charge_window(self.charge_window_best, try_minute)
+                charge_window_n = charge_index.find(try_minute)
                 if charge_window_n >= 0:
                     break
 
             for try_minute in range(minute_start, minute_end, PREDICT_STEP):
-                discharge_window_n = self.in_charge_window(self.discharge_window_best, try_minute)
+                discharge_window_n = discharge_index.find(try_minute)
                 if discharge_window_n >= 0:
                     break
 
@@ -4758,8 +4899,9 @@ class PredBat(hass.Hass):
         discharge_limit_first = False
         prev_limit = -1
 
+        discharge_index = WindowIndex(discharge_window)
         for minute in range(0, self.forecast_minutes + self.minutes_now, 5):
-            window_n = self.in_charge_window(discharge_window, minute)
+            window_n = discharge_index.find(minute)
             minute_timestamp = self.midnight_utc + timedelta(minutes=minute)
             stamp = minute_timestamp.strftime(TIME_FORMAT)
             if window_n >= 0 and (discharge_limits[window_n] < 100.0):
@@ -4922,8 +5064,9 @@ class PredBat(hass.Hass):
         charge_limit_time_kw = {}
         prev_perc = -1
 
+        charge_index = WindowIndex(charge_window)
         for minute in range(0, self.forecast_minutes + self.minutes_now, 5):
-            window = self.in_charge_window(charge_window, minute)
+            window = charge_index.find(minute)
             minute_timestamp = self.midnight_utc + timedelta(minutes=minute)
             stamp = minute_timestamp.strftime(TIME_FORMAT)
             if window >= 0:
@@ -5080,6 +5223,7 @@ class PredBat(hass.Hass):
         Init stub
         """
         reset_prediction_globals()
+        self.http_client = HttpClient(timeout=self.args.get("http_timeout", TIMEOUT), retries=self.args.get("http_retries", 0))
         self.html_plan = "<body><h1>Please wait calculating...</h1></body>"
         self.unmatched_args = {}
         self.define_service_list()
@@ -5088,6 +5232,8 @@ class PredBat(hass.Hass):
         self.solcast_api_used = None
         self.currency_symbols = self.args.get("currency_symbols", "£p")
         self.pool = None
+        self.scheduler = None
+        self.prediction_shared = None
         self.watch_list = []
         self.restart_active = False
         self.inverter_needs_reset = False
@@ -5101,6 +5247,9 @@ class PredBat(hass.Hass):
         self.config_index = {}
         self.dashboard_index = []
         self.dashboard_values = {}
+        self.published_state = {}
+        self.published_skipped = 0
+        self.sim_pruned = 0
         self.prefix = self.args.get("prefix", "predbat")
         self.previous_status = None
         self.had_errors = False
@@ -5300,6 +5449,385 @@ class PredBat(hass.Hass):
         self.config_root_p = self.config_root
         self.log("Config root is {}".format(self.config_root))
 
+    def discharge_block_indexes(self):
+        """
+        Index the charge windows, car charging slots and iBoost plan which can stop a discharge window being used
+        """
+        charge_index = WindowIndex(self.charge_window_best)
+        car_index = WindowIndex([slot for car_n in range(self.num_cars) for slot in self.car_charging_slots[car_n]])
+        iboost_index = WindowIndex(self.iboost_plan if self.iboost_plan else [])
+        return charge_index, car_index, iboost_index
+
+    def optimise_price_band_windows(
+        self,
+        loop_price,
+        price_set,
+        price_links,
+        window_index,
+        record_charge_windows,
+        record_discharge_windows,
+        best_limits,
+        best_discharge,
+        charge_window,
+        discharge_window,
+        discharge_limits,
+        region_start,
+        region_end,
+        discharge_enable,
+        window_indexes,
+    ):
+        """
+        Work out the charge limits for one price band, the windows in the region below the price charge and those above it may discharge
+        Returns the charge limits, the highest price charged at, the discharge limits with the region turned off, the discharge windows in price order,
+        those allowed to discharge and the price of each discharge window
+        """
+        charge_index, car_index, iboost_index = window_indexes
+        window_prices = {}
+        window_prices_discharge = {}
+        all_n = []
+        discharge_order = []
+        highest_price_charge = price_set[-1]
+        for price in price_set:
+            links = price_links[price]
+            if loop_price >= price:
+                for key in links:
+                    window_n = window_index[key]["id"]
+                    typ = window_index[key]["type"]
+                    if typ == "c":
+                        window_prices[window_n] = price
+                        all_n.append(window_n)
+            elif discharge_enable:
+                # For prices above threshold try discharge
+                for key in links:
+                    typ = window_index[key]["type"]
+                    window_n = window_index[key]["id"]
+                    if typ == "d":
+                        window_prices_discharge[window_n] = price
+                        discharge_order.append(window_n)
+
+        # Sort for print out
+        all_n.sort()
+
+        # This price band setting for charge
+        try_charge_limit = best_limits.copy()
+        for window_n in range(record_charge_windows):
+            if window_n >= len(try_charge_limit):
+                continue
+
+            if region_start and (charge_window[window_n]["start"] > region_end or charge_window[window_n]["end"] < region_start):
+                continue
+
+            if window_n in all_n:
+                if window_prices[window_n] > highest_price_charge:
+                    highest_price_charge = window_prices[window_n]
+                try_charge_limit[window_n] = self.soc_max
+            else:
+                try_charge_limit[window_n] = 0
+
+        # Discharge windows in this region are off unless selected, find those which are allowed to discharge
+        base_discharge = best_discharge.copy()
+        discharge_allowed = set()
+        for window_n in range(record_discharge_windows):
+            if window_n >= len(discharge_limits):
+                continue
+
+            if region_start and (discharge_window[window_n]["start"] > region_end or discharge_window[window_n]["end"] < region_start):
+                continue
+
+            base_discharge[window_n] = 100
+            if not self.calculate_discharge_oncharge:
+                hit_charge = charge_index.hit(discharge_window[window_n]["start"], discharge_window[window_n]["end"])
+                if hit_charge >= 0 and try_charge_limit[hit_charge] > 0.0:
+                    continue
+            if not self.car_charging_from_battery and car_index.hit(discharge_window[window_n]["start"], discharge_window[window_n]["end"]) >= 0:
+                continue
+            if (
+                not self.iboost_on_discharge
+                and self.iboost_enable
+                and self.iboost_plan
+                and (iboost_index.hit(discharge_window[window_n]["start"], discharge_window[window_n]["end"]) >= 0)
+            ):
+                continue
+            discharge_allowed.add(window_n)
+
+        return try_charge_limit, highest_price_charge, base_discharge, discharge_order, discharge_allowed, window_prices_discharge
+
+    def discharge_sweep_subsets(self, discharge_order, discharge_allowed):
+        """
+        Enumerate the distinct discharge subsets of the sweep, every modulo'th group of divide windows in price order is turned on
+        Returns a list of the subsets with their divide and modulo and the number of patterns swept
+        """
+        legacy_count = 0
+        subsets = []
+        subsets_tried = set()
+        for modulo in OPTIMISE_DISCHARGE_MODULO:
+            for divide in OPTIMISE_DISCHARGE_DIVIDE:
+                legacy_count += 1
+                all_d = tuple(sorted(window_n for count_d, window_n in enumerate(discharge_order) if (int(count_d / divide) % modulo) == 0 and window_n in discharge_allowed))
+                if all_d in subsets_tried:
+                    continue
+                subsets_tried.add(all_d)
+                subsets.append((all_d, divide, modulo))
+        return subsets, legacy_count
+
+    def price_band_plan(self, loop_price, price_set, try_charge_limit, highest_price_charge, base_discharge, window_prices_discharge, all_d, pattern):
+        """
+        Build the plan for a price band with the given discharge windows turned on, pattern describes how the windows were picked for the log
+        """
+        try_discharge = base_discharge.copy()
+        lowest_price_discharge = price_set[0]
+        for window_n in all_d:
+            if window_prices_discharge[window_n] < lowest_price_discharge:
+                lowest_price_discharge = window_prices_discharge[window_n]
+            try_discharge[window_n] = 0
+
+        pred_item = {}
+        pred_item["charge_limit"] = try_charge_limit.copy()
+        pred_item["discharge_limit"] = try_discharge
+        pred_item["highest_price_charge"] = highest_price_charge
+        pred_item["lowest_price_discharge"] = lowest_price_discharge
+        pred_item["loop_price"] = loop_price
+        pred_item["pattern"] = pattern
+        return pred_item
+
+    def optimise_price_band_candidates(
+        self,
+        loop_price,
+        price_set,
+        price_links,
+        window_index,
+        record_charge_windows,
+        record_discharge_windows,
+        best_limits,
+        best_discharge,
+        charge_window,
+        discharge_window,
+        discharge_limits,
+        region_start,
+        region_end,
+        discharge_enable,
+        window_indexes,
+        tried_list,
+    ):
+        """
+        Build the plans to try for one price band, every modulo'th group of divide discharge windows in price order is turned on
+        Plans already in the tried list are skipped and the new ones added to it
+        Returns the plans, the number of distinct discharge subsets and the number of discharge patterns swept
+        """
+        try_charge_limit, highest_price_charge, base_discharge, discharge_order, discharge_allowed, window_prices_discharge = self.optimise_price_band_windows(
+            loop_price,
+            price_set,
+            price_links,
+            window_index,
+            record_charge_windows,
+            record_discharge_windows,
+            best_limits,
+            best_discharge,
+            charge_window,
+            discharge_window,
+            discharge_limits,
+            region_start,
+            region_end,
+            discharge_enable,
+            window_indexes,
+        )
+
+        subsets, legacy_count = self.discharge_sweep_subsets(discharge_order, discharge_allowed)
+        pred_table = []
+        for all_d, divide, modulo in subsets:
+            pred_item = self.price_band_plan(
+                loop_price, price_set, try_charge_limit, highest_price_charge, base_discharge, window_prices_discharge, all_d, "divide {} modulo {}".format(divide, modulo)
+            )
+
+            # Skip this one as it's the same as selected already
+            try_hash = (tuple(pred_item["charge_limit"]), tuple(pred_item["discharge_limit"]))
+            if try_hash in tried_list:
+                continue
+            tried_list[try_hash] = True
+            pred_table.append(pred_item)
+        return pred_table, len(subsets), legacy_count
+
+    def optimise_price_band_search(
+        self,
+        loop_price,
+        price_set,
+        price_links,
+        window_index,
+        record_charge_windows,
+        record_discharge_windows,
+        best_limits,
+        best_discharge,
+        charge_window,
+        discharge_window,
+        discharge_limits,
+        region_start,
+        region_end,
+        discharge_enable,
+        window_indexes,
+        tried_list,
+        end_record,
+        step,
+    ):
+        """
+        Search the discharge windows for one price band with a beam search rather than the modulo and divide sweep
+
+        The discharge windows are split into at most OPTIMISE_DISCHARGE_BEAM_STEPS groups in price order, at each step every plan
+        kept is tried with the next group turned on as well and the OPTIMISE_DISCHARGE_BEAM plans with the best metric are kept
+        Plans already in the tried list are not simulated again, they are ranked from the result cache when it still holds them
+        Returns the plans simulated, their results, the number of distinct discharge subsets the sweep would have tried and the number of patterns it would have swept
+        """
+        try_charge_limit, highest_price_charge, base_discharge, discharge_order, discharge_allowed, window_prices_discharge = self.optimise_price_band_windows(
+            loop_price,
+            price_set,
+            price_links,
+            window_index,
+            record_charge_windows,
+            record_discharge_windows,
+            best_limits,
+            best_discharge,
+            charge_window,
+            discharge_window,
+            discharge_limits,
+            region_start,
+            region_end,
+            discharge_enable,
+            window_indexes,
+        )
+        allowed_order = [window_n for window_n in discharge_order if window_n in discharge_allowed]
+        group_size = max(int((len(allowed_order) + OPTIMISE_DISCHARGE_BEAM_STEPS - 1) / OPTIMISE_DISCHARGE_BEAM_STEPS), 1)
+        groups = [allowed_order[group_start : group_start + group_size] for group_start in range(0, len(allowed_order), group_size)]
+
+        cache = self.prediction.result_cache
+        pred_table = []
+        pred_results = []
+        subset_metric = {}
+        beam = [()]
+        for step_n, group in enumerate([[]] + groups):
+            subsets = []
+            for subset in beam:
+                all_d = tuple(sorted(subset + tuple(group)))
+                if all_d not in subset_metric and all_d not in subsets:
+                    subsets.append(all_d)
+            if not subsets:
+                break
+
+            step_table = []
+            for all_d in subsets:
+                pred_item = self.price_band_plan(
+                    loop_price, price_set, try_charge_limit, highest_price_charge, base_discharge, window_prices_discharge, all_d, "beam step {} of {}".format(step_n, len(groups))
+                )
+                pred_item["subset"] = all_d
+                try_hash = (tuple(pred_item["charge_limit"]), tuple(pred_item["discharge_limit"]))
+                if try_hash in tried_list:
+                    result = cache.get(prediction_cache_key(pred_item["charge_limit"], charge_window, discharge_window, pred_item["discharge_limit"], False, end_record, step))
+                    subset_metric[all_d] = self.compute_metric_price_band(end_record, result) if result is not None else 9999999
+                    continue
+                tried_list[try_hash] = True
+                step_table.append(pred_item)
+
+            step_results = self.run_prediction_price_band(
+                [pred["charge_limit"] for pred in step_table],
+                charge_window,
+                discharge_window,
+                [pred["discharge_limit"] for pred in step_table],
+                end_record,
+                step,
+                9999999,
+            )
+            for pred, pred_result in zip(step_table, step_results):
+                # Plans are only pruned once another plan in the step has beaten them so they are ranked last
+                subset_metric[pred["subset"]] = self.compute_metric_price_band(end_record, pred_result) if pred_result is not None else 9999999
+            pred_table.extend(step_table)
+            pred_results.extend(step_results)
+
+            # Keep the best plans, on a tie the plan with fewer windows on is kept
+            beam = sorted(set(beam + subsets), key=lambda all_d: (subset_metric[all_d], len(all_d), all_d))[:OPTIMISE_DISCHARGE_BEAM]
+
+        sweep_subsets, legacy_count = self.discharge_sweep_subsets(discharge_order, discharge_allowed)
+        return pred_table, pred_results, len(sweep_subsets), legacy_count
+
+    def region_windows(self, charge_window, discharge_window, record_charge_windows, record_discharge_windows, region_start, region_end):
+        """
+        Returns the set of charge and discharge windows which are optimised in a region
+        """
+        windows = set()
+        for window_n in range(min(record_charge_windows, len(charge_window))):
+            if not region_start or (charge_window[window_n]["start"] <= region_end and charge_window[window_n]["end"] >= region_start):
+                windows.add(("c", window_n))
+        for window_n in range(min(record_discharge_windows, len(discharge_window))):
+            if not region_start or (discharge_window[window_n]["start"] <= region_end and discharge_window[window_n]["end"] >= region_start):
+                windows.add(("d", window_n))
+        return windows
+
+    def optimise_region_prefetch(
+        self,
+        price_set,
+        price_links,
+        window_index,
+        record_charge_windows,
+        record_discharge_windows,
+        charge_limit,
+        charge_window,
+        discharge_window,
+        discharge_limits,
+        end_record,
+        region_start,
+        region_end,
+        fast=False,
+        best_metric=9999999,
+        tried_list=None,
+    ):
+        """
+        Launch the plans for a region ahead of time assuming the regions before it leave the plan unchanged
+        When that holds the region collects its results from this batch, otherwise its plans differ and are simulated when it runs
+        """
+        step = PREDICT_STEP
+        if fast:
+            step = 30
+        discharge_enable = self.calculate_best_discharge and self.calculate_discharge_first
+        if discharge_enable and self.calculate_discharge_greedy:
+            # The plans searched depend on the results so can't be launched ahead
+            return
+
+        # The tried list is only read, plans the region would skip are not launched
+        prefetch_tried = ChainMap({}, tried_list if tried_list is not None else {})
+        window_indexes = self.discharge_block_indexes()
+        limits_matrix = []
+        discharge_matrix = []
+        for loop_price in price_set[::] + [self.dp1(price_set[-1] - 1)]:
+            pred_table, ignore_sweep_count, ignore_legacy_count = self.optimise_price_band_candidates(
+                loop_price,
+                price_set,
+                price_links,
+                window_index,
+                record_charge_windows,
+                record_discharge_windows,
+                charge_limit,
+                discharge_limits,
+                charge_window,
+                discharge_window,
+                discharge_limits,
+                region_start,
+                region_end,
+                discharge_enable,
+                window_indexes,
+                prefetch_tried,
+            )
+            limits_matrix.extend([pred["charge_limit"] for pred in pred_table])
+            discharge_matrix.extend([pred["discharge_limit"] for pred in pred_table])
+
+        self.launch_run_prediction_batch(
+            limits_matrix,
+            charge_window,
+            discharge_window,
+            discharge_matrix,
+            False,
+            end_record=end_record,
+            step=step,
+            prune=self.prune_bound(end_record, best_metric),
+            prefetch=True,
+        )
+
     def optimise_charge_limit_price_threads(
         self,
         price_set,
@@ -5365,131 +5893,87 @@ class PredBat(hass.Hass):
             self.log("All prices {}".format(all_prices))
             if region_start:
                 self.log("Region {} - {}".format(self.time_abs_str(region_start), self.time_abs_str(region_end)))
-        window_prices = {}
-        window_prices_discharge = {}
 
+        window_indexes = self.discharge_block_indexes()
+        legacy_count = 0
+        sweep_count = 0
+        sim_count = 0
         for loop_price in all_prices:
-            pred_table = []
-            for modulo in [2, 3, 4, 6, 8, 16, 32]:
-                for divide in [96, 48, 32, 16, 8, 4, 3, 2, 1]:
-                    all_n = []
-                    all_d = []
-                    divide_count_d = 0
-                    highest_price_charge = price_set[-1]
-                    lowest_price_discharge = price_set[0]
-                    for price in price_set:
-                        links = price_links[price]
-                        if loop_price >= price:
-                            for key in links:
-                                window_n = window_index[key]["id"]
-                                typ = window_index[key]["type"]
-                                if typ == "c":
-                                    window_prices[window_n] = price
-                                    all_n.append(window_n)
-                        elif discharge_enable:
-                            # For prices above threshold try discharge
-                            for key in links:
-                                typ = window_index[key]["type"]
-                                window_n = window_index[key]["id"]
-                                if typ == "d":
-                                    window_prices_discharge[window_n] = price
-                                    if (int(divide_count_d / divide) % modulo) == 0:
-                                        all_d.append(window_n)
-                                    divide_count_d += 1
-
-                    # Sort for print out
-                    all_n.sort()
-                    all_d.sort()
-
-                    # This price band setting for charge
-                    try_charge_limit = best_limits.copy()
-                    for window_n in range(record_charge_windows):
-                        if window_n >= len(try_charge_limit):
-                            continue
-
-                        if region_start and (charge_window[window_n]["start"] > region_end or charge_window[window_n]["end"] < region_start):
-                            continue
-
-                        if window_n in all_n:
-                            if window_prices[window_n] > highest_price_charge:
-                                highest_price_charge = window_prices[window_n]
-                            try_charge_limit[window_n] = self.soc_max
-                        else:
-                            try_charge_limit[window_n] = 0
-
-                    # Try discharge on/off
-                    try_discharge = best_discharge.copy()
-                    for window_n in range(record_discharge_windows):
-                        if window_n >= len(discharge_limits):
-                            continue
-
-                        if region_start and (discharge_window[window_n]["start"] > region_end or discharge_window[window_n]["end"] < region_start):
-                            continue
-
-                        try_discharge[window_n] = 100
-                        if window_n in all_d:
-                            if not self.calculate_discharge_oncharge:
-                                hit_charge = self.hit_charge_window(self.charge_window_best, discharge_window[window_n]["start"], discharge_window[window_n]["end"])
-                                if hit_charge >= 0 and try_charge_limit[hit_charge] > 0.0:
-                                    continue
-                            if not self.car_charging_from_battery and self.hit_car_window(discharge_window[window_n]["start"], discharge_window[window_n]["end"]):
-                                continue
-                            if (
-                                not self.iboost_on_discharge
-                                and self.iboost_enable
-                                and self.iboost_plan
-                                and (self.hit_charge_window(self.iboost_plan, discharge_window[window_n]["start"], discharge_window[window_n]["end"]) >= 0)
-                            ):
-                                continue
-
-                            if window_prices_discharge[window_n] < lowest_price_discharge:
-                                lowest_price_discharge = window_prices_discharge[window_n]
-                            try_discharge[window_n] = 0
-
-                    # Skip this one as it's the same as selected already
-                    try_hash = str(try_charge_limit) + "_d_" + str(try_discharge)
-                    if try_hash in tried_list:
-                        if self.debug_enable and 0:
-                            self.log(
-                                "Skip this optimisation with divide {} windows {} discharge windows {} discharge_enable {} as it's the same as previous ones hash {}".format(
-                                    divide, all_n, all_d, discharge_enable, try_hash
-                                )
-                            )
-                        continue
-
-                    tried_list[try_hash] = True
+            if discharge_enable and self.calculate_discharge_greedy:
+                pred_table, pred_results, band_sweep_count, band_legacy_count = self.optimise_price_band_search(
+                    loop_price,
+                    price_set,
+                    price_links,
+                    window_index,
+                    record_charge_windows,
+                    record_discharge_windows,
+                    best_limits,
+                    best_discharge,
+                    charge_window,
+                    discharge_window,
+                    discharge_limits,
+                    region_start,
+                    region_end,
+                    discharge_enable,
+                    window_indexes,
+                    tried_list,
+                    end_record,
+                    step,
+                )
+            else:
+                pred_table, band_sweep_count, band_legacy_count = self.optimise_price_band_candidates(
+                    loop_price,
+                    price_set,
+                    price_links,
+                    window_index,
+                    record_charge_windows,
+                    record_discharge_windows,
+                    best_limits,
+                    best_discharge,
+                    charge_window,
+                    discharge_window,
+                    discharge_limits,
+                    region_start,
+                    region_end,
+                    discharge_enable,
+                    window_indexes,
+                    tried_list,
+                )
 
-                    pred_handle = self.launch_run_prediction_single(try_charge_limit, charge_window, discharge_window, try_discharge, False, end_record=end_record, step=step)
-                    pred_item = {}
-                    pred_item["handle"] = pred_handle
-                    pred_item["charge_limit"] = try_charge_limit.copy()
-                    pred_item["discharge_limit"] = try_discharge.copy()
-                    pred_item["highest_price_charge"] = highest_price_charge
-                    pred_item["lowest_price_discharge"] = lowest_price_discharge
-                    pred_item["loop_price"] = loop_price
-                    pred_table.append(pred_item)
+                # Simulate all the plans for this price band as a single batch, plans which can't beat the best so far are pruned
+                pred_results = self.run_prediction_price_band(
+                    [pred["charge_limit"] for pred in pred_table],
+                    charge_window,
+                    discharge_window,
+                    [pred["discharge_limit"] for pred in pred_table],
+                    end_record,
+                    step,
+                    best_metric,
+                )
+            sweep_count += band_sweep_count
+            legacy_count += band_legacy_count
+            sim_count += len(pred_table)
 
-            for pred in pred_table:
-                handle = pred["handle"]
+            for pred, pred_result in zip(pred_table, pred_results):
+                if pred_result is None:
+                    self.sim_pruned += 1
+                    continue
                 try_charge_limit = pred["charge_limit"]
                 try_discharge = pred["discharge_limit"]
                 highest_price_charge = pred["highest_price_charge"]
                 lowest_price_discharge = pred["lowest_price_discharge"]
                 loop_price = pred["loop_price"]
-                cost, import_kwh_battery, import_kwh_house, export_kwh, soc_min, soc, soc_min_minute, battery_cycle, metric_keep, final_iboost, final_carbon_g = handle.get()
-
-                metric = self.compute_metric(
-                    end_record, soc, soc, cost, cost, final_iboost, final_iboost, battery_cycle, metric_keep, final_carbon_g, import_kwh_battery, import_kwh_house, export_kwh
-                )
+                pattern = pred["pattern"]
+                cost, import_kwh_battery, import_kwh_house, export_kwh, soc_min, soc, soc_min_minute, battery_cycle, metric_keep, final_iboost, final_carbon_g = pred_result
+                metric = self.compute_metric_price_band(end_record, pred_result)
 
                 # Optimise
                 if self.debug_enable:
                     if discharge_enable:
                         self.log(
-                            "Optimise all for buy/sell price band <= {} divide {} modulo {} metric {} keep {} soc_min {} import {} export {} soc {} windows {} discharge on {}".format(
+                            "Optimise all for buy/sell price band <= {} {} metric {} keep {} soc_min {} import {} export {} soc {} windows {} discharge on {}".format(
                                 loop_price,
-                                divide,
-                                modulo,
+                                pattern,
                                 self.dp4(metric),
                                 self.dp4(metric_keep),
                                 self.dp4(soc_min),
@@ -5502,10 +5986,9 @@ class PredBat(hass.Hass):
                         )
                     else:
                         self.log(
-                            "Optimise all for buy/sell price band <= {} divide {} modulo {} metric {} keep {} soc_min {} import {} export {}  soc {} windows {} discharge off".format(
+                            "Optimise all for buy/sell price band <= {} {} metric {} keep {} soc_min {} import {} export {}  soc {} windows {} discharge off".format(
                                 loop_price,
-                                divide,
-                                modulo,
+                                pattern,
                                 self.dp4(metric),
                                 self.dp4(metric_keep),
                                 self.dp4(soc_min),
@@ -5549,10 +6032,13 @@ class PredBat(hass.Hass):
 
         if self.debug_enable:
             self.log(
-                "Optimise all charge {} best price threshold {} total simulations {} charges at {} at cost {} metric {} keep {} cycle {} carbon {} import {} cost {} soc_min {} limits {} discharge {}".format(
+                "Optimise all charge {} best price threshold {} total simulations {} this pass {} against {} subsets from {} patterns in sweep, charges at {} at cost {} metric {} keep {} cycle {} carbon {} import {} cost {} soc_min {} limits {} discharge {}".format(
                     region_txt,
                     self.dp4(best_price),
                     len(tried_list),
+                    sim_count,
+                    sweep_count,
+                    legacy_count,
                     self.dp4(best_price_charge),
                     self.dp4(best_cost),
                     self.dp4(best_metric),
@@ -5596,48 +6082,274 @@ class PredBat(hass.Hass):
             tried_list,
         )
 
+    def get_scheduler(self):
+        """
+        Returns the scheduler which runs the simulations for the current prediction data on the pool, or inline if there is no pool
+        """
+        if not self.scheduler or not self.scheduler.matches(self.prediction, self.pool):
+            self.scheduler = PredictionScheduler(self.prediction, self.pool)
+        return self.scheduler
+
     def launch_run_prediction_single(self, charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record, step=PREDICT_STEP):
         """
         Launch a thread to run a prediction
         """
+        cache = self.prediction.result_cache
+        key = prediction_cache_key(charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record, step)
+        result = cache.get(key)
+        if result is not None:
+            return ReadyResult(result)
+
         charge_limit = copy.deepcopy(charge_limit)
         discharge_limits = copy.deepcopy(discharge_limits)
-        if self.pool and self.pool._state == "RUN":
-            han = self.pool.apply_async(wrapped_run_prediction_single, (charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record, step))
-        else:
-            han = DummyThread(self.prediction.thread_run_prediction_single(charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record, step))
-        return han
+        han = self.get_scheduler().submit("thread_run_prediction_single", (charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record, step))
+        return PredictionCacheHandle(han, cache, key)
 
-    def launch_run_prediction_charge(self, loop_soc, window_n, charge_limit, charge_window, discharge_window, discharge_limits, pv10, all_n, end_record):
+    def launch_run_prediction_batch(
+        self, limits_matrix, charge_window, discharge_window, discharge_matrix, pv10, end_record, step=PREDICT_STEP, prune=None, prefetch=False, chunks_per_worker=1
+    ):
         """
-        Launch a thread to run a prediction
+        Launch threads to run a batch of predictions, the batch is split into chunks_per_worker chunks for each worker
+        Plans which have already been simulated are taken from the cache, plans which are pruned give None
+        Plans already launched by a prefetch batch are collected from that batch, a prefetch batch records its plans as pending
+        Returns a list of handles
         """
-        if self.pool and self.pool._state == "RUN":
-            han = self.pool.apply_async(
-                wrapped_run_prediction_charge, (loop_soc, window_n, charge_limit, charge_window, discharge_window, discharge_limits, pv10, all_n, end_record)
-            )
+        cache = self.prediction.result_cache
+        keys = [
+            prediction_cache_key(charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record, step)
+            for charge_limit, discharge_limits in zip(limits_matrix, discharge_matrix)
+        ]
+        results = [cache.get(key) for key in keys]
+        pending_handles = []
+        if prefetch:
+            rows = [row for row in range(len(keys)) if results[row] is None and keys[row] not in cache.pending]
         else:
-            han = DummyThread(
-                self.prediction.thread_run_prediction_charge(loop_soc, window_n, charge_limit, charge_window, discharge_window, discharge_limits, pv10, all_n, end_record)
+            rows = []
+            pending_rows = {}
+            for row in range(len(keys)):
+                if results[row] is not None:
+                    continue
+                pending = cache.pop_pending(keys[row])
+                if pending is None:
+                    rows.append(row)
+                else:
+                    batch, batch_row = pending
+                    batch_pending = pending_rows.setdefault(id(batch), (batch, [], []))
+                    batch_pending[1].append(row)
+                    batch_pending[2].append(batch_row)
+            pending_handles = [(pending_row, PredictionPendingHandle(batch, batch_row)) for batch, pending_row, batch_row in pending_rows.values()]
+        limits_matrix = [copy.deepcopy(limits_matrix[row]) for row in rows]
+        discharge_matrix = [copy.deepcopy(discharge_matrix[row]) for row in rows]
+
+        scheduler = self.get_scheduler()
+        chunk_size = scheduler.chunk_size(len(rows), chunks_per_worker)
+        chunks = [
+            (
+                limits_matrix[chunk_start : chunk_start + chunk_size],
+                charge_window,
+                discharge_window,
+                discharge_matrix[chunk_start : chunk_start + chunk_size],
+                pv10,
+                end_record,
+                step,
+                prune,
             )
-        return han
+            for chunk_start in range(0, len(rows), chunk_size)
+        ]
+        futures = scheduler.submit_many("run_prediction_rows", chunks)
+        handles = [(rows[chunk_n * chunk_size : (chunk_n + 1) * chunk_size], future) for chunk_n, future in enumerate(futures)]
+        batch = PredictionBatchHandle(results, keys, cache, handles + pending_handles)
+        if prefetch:
+            for row in rows:
+                cache.add_pending(keys[row], batch, row)
+        return [batch]
+
+    def run_prediction_price_band(self, limits_matrix, charge_window, discharge_window, discharge_matrix, end_record, step, best_metric):
+        """
+        Simulate the plans for a price band and return the results in order, None for those which were pruned
+
+        The batch is split into several chunks per worker and the best metric is tracked as the chunks finish, once it improves the chunks
+        which have not been launched are cancelled and launched again with the tighter prune bound. Only plans which can't beat a metric
+        already found are pruned so the plan picked is the same
+        """
+        scheduler = self.get_scheduler()
+        batch = self.launch_run_prediction_batch(
+            limits_matrix,
+            charge_window,
+            discharge_window,
+            discharge_matrix,
+            False,
+            end_record=end_record,
+            step=step,
+            prune=self.prune_bound(end_record, best_metric),
+            chunks_per_worker=SCHEDULER_BATCH_CHUNKS,
+        )[0]
+        band_metric = best_metric
+        launch_metric = best_metric
+        waiting = batch.handles
+        finished = []
+        while waiting:
+            ready = scheduler.wait_first([handle for rows, handle in waiting])
+            for rows, handle in waiting:
+                if handle in ready:
+                    finished.append((rows, handle))
+                    for result in handle.get():
+                        if result is not None:
+                            band_metric = min(band_metric, self.compute_metric_price_band(end_record, result))
+            waiting = [(rows, handle) for rows, handle in waiting if handle not in ready]
+
+            if waiting and band_metric < launch_metric:
+                cancelled = scheduler.cancel([handle for rows, handle in waiting])
+                cancelled_rows = [row for rows, handle in waiting if handle in cancelled for row in rows]
+                if cancelled_rows:
+                    relaunch = self.launch_run_prediction_batch(
+                        [limits_matrix[row] for row in cancelled_rows],
+                        charge_window,
+                        discharge_window,
+                        [discharge_matrix[row] for row in cancelled_rows],
+                        False,
+                        end_record=end_record,
+                        step=step,
+                        prune=self.prune_bound(end_record, band_metric),
+                        chunks_per_worker=SCHEDULER_BATCH_CHUNKS,
+                    )[0]
+                    for relaunch_row, result in enumerate(relaunch.results):
+                        if result is not None:
+                            batch.results[cancelled_rows[relaunch_row]] = result
+                    waiting = [(rows, handle) for rows, handle in waiting if handle not in cancelled]
+                    waiting += [([cancelled_rows[relaunch_row] for relaunch_row in rows], handle) for rows, handle in relaunch.handles]
+                launch_metric = band_metric
+        batch.handles = finished
+        return batch.get()
+
+    def launch_run_prediction_charges(self, try_socs, window_n, charge_limit, charge_window, discharge_window, discharge_limits, all_n, end_record, step=PREDICT_STEP, prune=None):
+        """
+        Launch threads to run a prediction for both the pv and pv10 scenarios of each SOC, the handles return a list of the two results
+        Both results are None if the prediction was pruned
+        """
+        cache = self.prediction.result_cache
+        handles = []
+        launch_args = []
+        for try_soc in try_socs:
+            try_charge_limit = charge_limit.copy()
+            if all_n:
+                for set_n in all_n:
+                    try_charge_limit[set_n] = try_soc
+            else:
+                try_charge_limit[window_n] = try_soc
+            keys = [
+                prediction_cache_key(
+                    try_charge_limit,
+                    charge_window,
+                    discharge_window,
+                    discharge_limits,
+                    pv10,
+                    end_record,
+                    step=step,
+                    result_type=PREDICT_RESULT_CHARGE,
+                    window_n=-1 if all_n else window_n,
+                )
+                for pv10 in [False, True]
+            ]
+            results = [cache.get(key) for key in keys]
+            if None not in results:
+                handles.append(ReadyResult(results))
+            else:
+                handles.append(PredictionBatchHandle(results, keys, cache, []))
+                launch_args.append((try_soc, window_n, charge_limit, charge_window, discharge_window, discharge_limits, all_n, end_record, step, prune))
+
+        # The SOCs share the same base plan so are launched in chunks to reuse the base plan simulation in each worker
+        scheduler = self.get_scheduler()
+        futures = scheduler.submit_many("thread_run_prediction_charge", launch_args, scheduler.chunk_size(len(launch_args)))
+        for handle in handles:
+            if isinstance(handle, PredictionBatchHandle):
+                handle.handles = [([0, 1], futures.pop(0))]
+        return handles
+
+    def launch_run_prediction_discharges(self, try_options, window_n, try_charge_limit, charge_window, try_discharge_window, try_discharge, all_n, end_record, prune=None):
+        """
+        Launch threads to run a prediction for both the pv and pv10 scenarios of each start and discharge limit option, the handles return a list of the two results
+        Both results are None if the prediction was pruned
+        """
+        cache = self.prediction.result_cache
+        handles = []
+        launch_args = []
+        for start, this_discharge_limit in try_options:
+            # Work out the plan the thread will simulate to look it up in the cache
+            cache_discharge_window = [window.copy() for window in try_discharge_window]
+            cache_discharge = try_discharge.copy()
+            if all_n:
+                for window_id in all_n:
+                    cache_discharge[window_id] = this_discharge_limit
+            else:
+                cache_discharge[window_n] = this_discharge_limit
+                cache_discharge_window[window_n]["start"] = min(start, cache_discharge_window[window_n]["end"] - 5)
+            keys = [prediction_cache_key(try_charge_limit, charge_window, cache_discharge_window, cache_discharge, pv10, end_record) for pv10 in [False, True]]
+            results = [cache.get(key) for key in keys]
+            if None not in results:
+                handles.append(ReadyResult(results))
+            else:
+                # Pass copies as the thread modifies the plan, this keeps the same base plan between calls for incremental simulation
+                handles.append(PredictionBatchHandle(results, keys, cache, []))
+                launch_args.append(
+                    (
+                        this_discharge_limit,
+                        start,
+                        window_n,
+                        try_charge_limit,
+                        charge_window,
+                        [window.copy() for window in try_discharge_window],
+                        try_discharge.copy(),
+                        all_n,
+                        end_record,
+                        prune,
+                    )
+                )
+
+        scheduler = self.get_scheduler()
+        futures = scheduler.submit_many("thread_run_prediction_discharge", launch_args, scheduler.chunk_size(len(launch_args)))
+        for handle in handles:
+            if isinstance(handle, PredictionBatchHandle):
+                handle.handles = [([0, 1], futures.pop(0))]
+        return handles
 
-    def launch_run_prediction_discharge(self, this_discharge_limit, start, window_n, try_charge_limit, charge_window, try_discharge_window, try_discharge, pv10, all_n, end_record):
+    def metric_end_rate(self, end_record):
         """
-        Launch a thread to run a prediction
+        How much each kWh left in the battery at the end of the plan is worth
+        ie. how much extra battery is worth to us in future, assume it's the same as low rate
         """
-        if self.pool and self.pool._state == "RUN":
-            han = self.pool.apply_async(
-                wrapped_run_prediction_discharge,
-                (this_discharge_limit, start, window_n, try_charge_limit, charge_window, try_discharge_window, try_discharge, pv10, all_n, end_record),
-            )
-        else:
-            han = DummyThread(
-                self.prediction.thread_run_prediction_discharge(
-                    this_discharge_limit, start, window_n, try_charge_limit, charge_window, try_discharge_window, try_discharge, pv10, all_n, end_record
-                )
-            )
-        return han
+        rate_min = self.rate_min_forward.get(end_record, self.rate_min) / self.inverter_loss / self.battery_loss + self.metric_battery_cycle
+        rate_export_min = self.rate_export_min * self.inverter_loss * self.battery_loss_discharge - self.metric_battery_cycle - rate_min
+        return max(rate_min, 1.0, rate_export_min)
+
+    def prune_bound(self, end_record, metric):
+        """
+        Returns the bound passed to the simulations to prune plans whose metric can't come in under the given metric
+        None if there is nothing to prune against
+        """
+        if metric >= 9999999 or self.pv_metric10_weight < 0:
+            return None
+        end_value = max(self.metric_battery_value_scaling * self.metric_end_rate(end_record), 0)
+        return (metric + OPTIMISE_PRUNE_MARGIN, end_value)
+
+    def compute_metric_price_band(self, end_record, result):
+        """
+        Compute the metric of a price band plan which is only simulated with the pv scenario
+        """
+        cost, import_kwh_battery, import_kwh_house, export_kwh, soc_min, soc, soc_min_minute, battery_cycle, metric_keep, final_iboost, final_carbon_g = result
+        return self.compute_metric(
+            end_record, soc, soc, cost, cost, final_iboost, final_iboost, battery_cycle, metric_keep, final_carbon_g, import_kwh_battery, import_kwh_house, export_kwh
+        )
+
+    def compute_metric_result(self, end_record, result, result10):
+        """
+        Compute the metric from the pv and pv10 simulation results
+        """
+        cost, import_kwh_battery, import_kwh_house, export_kwh, soc_min, soc, soc_min_minute, battery_cycle, metric_keep, final_iboost, final_carbon_g = result[:11]
+        cost10, _, _, _, _, soc10, _, _, _, final_iboost10, _ = result10[:11]
+        return self.compute_metric(
+            end_record, soc, soc10, cost, cost10, final_iboost, final_iboost10, battery_cycle, metric_keep, final_carbon_g, import_kwh_battery, import_kwh_house, export_kwh
+        )
 
     def compute_metric(
         self, end_record, soc, soc10, cost, cost10, final_iboost, final_iboost10, battery_cycle, metric_keep, final_carbon_g, import_kwh_battery, import_kwh_house, export_kwh
@@ -5650,11 +6362,9 @@ class PredBat(hass.Hass):
         metric10 = cost10
 
         # Balancing payment to account for battery left over
-        # ie. how much extra battery is worth to us in future, assume it's the same as low rate
-        rate_min = self.rate_min_forward.get(end_record, self.rate_min) / self.inverter_loss / self.battery_loss + self.metric_battery_cycle
-        rate_export_min = self.rate_export_min * self.inverter_loss * self.battery_loss_discharge - self.metric_battery_cycle - rate_min
-        metric -= (soc * self.metric_battery_value_scaling + final_iboost * self.iboost_value_scaling) * max(rate_min, 1.0, rate_export_min)
-        metric10 -= (soc10 * self.metric_battery_value_scaling + final_iboost10 * self.iboost_value_scaling) * max(rate_min, 1.0, rate_export_min)
+        end_rate = self.metric_end_rate(end_record)
+        metric -= (soc * self.metric_battery_value_scaling + final_iboost * self.iboost_value_scaling) * end_rate
+        metric10 -= (soc10 * self.metric_battery_value_scaling + final_iboost10 * self.iboost_value_scaling) * end_rate
         # Metric adjustment based on 10% outcome weighting
         if metric10 > metric:
             metric_diff = metric10 - metric
@@ -5673,6 +6383,30 @@ class PredBat(hass.Hass):
 
         return self.dp4(metric)
 
+    def charge_metric_adjust(self, try_soc, window_n, charge_window, all_n, best_soc_min_setting):
+        """
+        Returns how much the metric for a charge window SOC is reduced by to favour certain settings
+        """
+        adjust = 0
+
+        # Metric adjustment based on current charge limit when inside the window
+        # to try to avoid constant small changes to SOC target by forcing to keep the current % during a charge period
+        # if changing it has little impact
+        if not all_n and self.isCharging and (window_n == self.in_charge_window(charge_window, self.minutes_now)) and (try_soc != self.reserve):
+            try_percent = calc_percent_limit(try_soc, self.soc_max)
+            compare_with = max(self.current_charge_limit, self.reserve_percent)
+
+            if compare_with == try_percent:
+                adjust += max(0.1, self.metric_min_improvement)
+
+        if try_soc == best_soc_min_setting:
+            # Minor weighting to 0%
+            adjust += 0.002
+        elif try_soc == self.soc_max or try_soc == self.reserve:
+            # Minor weighting to 100% or freeze
+            adjust += 0.001
+        return adjust
+
     def optimise_charge_limit(self, window_n, record_charge_windows, charge_limit, charge_window, discharge_window, discharge_limits, all_n=None, end_record=None):
         """
         Optimise a single charging window for best SOC
@@ -5711,97 +6445,14 @@ class PredBat(hass.Hass):
         # Create min/max SOC to avoid simulating SOC that are not going have any impact
         # Can't do this for anything but a single window as the winder SOC impact isn't known
         if not all_n:
-            hans = []
             all_max_soc = 0
             all_min_soc = self.soc_max
-            hans.append(self.launch_run_prediction_charge(loop_soc, window_n, charge_limit, charge_window, discharge_window, discharge_limits, False, all_n, end_record))
-            hans.append(self.launch_run_prediction_charge(loop_soc, window_n, charge_limit, charge_window, discharge_window, discharge_limits, True, all_n, end_record))
-            hans.append(self.launch_run_prediction_charge(best_soc_min, window_n, charge_limit, charge_window, discharge_window, discharge_limits, False, all_n, end_record))
-            hans.append(self.launch_run_prediction_charge(best_soc_min, window_n, charge_limit, charge_window, discharge_window, discharge_limits, True, all_n, end_record))
-            id = 0
-            for han in hans:
-                (
-                    cost,
-                    import_kwh_battery,
-                    import_kwh_house,
-                    export_kwh,
-                    soc_min,
-                    soc,
-                    soc_min_minute,
-                    battery_cycle,
-                    metric_keep,
-                    final_iboost,
-                    final_carbon_g,
-                    min_soc,
-                    max_soc,
-                ) = han.get()
-                all_min_soc = min(all_min_soc, min_soc)
-                all_max_soc = max(all_max_soc, max_soc)
-                if id == 0:
-                    resultmid[loop_soc] = [
-                        cost,
-                        import_kwh_battery,
-                        import_kwh_house,
-                        export_kwh,
-                        soc_min,
-                        soc,
-                        soc_min_minute,
-                        battery_cycle,
-                        metric_keep,
-                        final_iboost,
-                        final_carbon_g,
-                        min_soc,
-                        max_soc,
-                    ]
-                elif id == 1:
-                    result10[loop_soc] = [
-                        cost,
-                        import_kwh_battery,
-                        import_kwh_house,
-                        export_kwh,
-                        soc_min,
-                        soc,
-                        soc_min_minute,
-                        battery_cycle,
-                        metric_keep,
-                        final_iboost,
-                        final_carbon_g,
-                        min_soc,
-                        max_soc,
-                    ]
-                elif id == 2:
-                    resultmid[best_soc_min] = [
-                        cost,
-                        import_kwh_battery,
-                        import_kwh_house,
-                        export_kwh,
-                        soc_min,
-                        soc,
-                        soc_min_minute,
-                        battery_cycle,
-                        metric_keep,
-                        final_iboost,
-                        final_carbon_g,
-                        min_soc,
-                        max_soc,
-                    ]
-                elif id == 3:
-                    result10[best_soc_min] = [
-                        cost,
-                        import_kwh_battery,
-                        import_kwh_house,
-                        export_kwh,
-                        soc_min,
-                        soc,
-                        soc_min_minute,
-                        battery_cycle,
-                        metric_keep,
-                        final_iboost,
-                        final_carbon_g,
-                        min_soc,
-                        max_soc,
-                    ]
-                id += 1
+            hans = self.launch_run_prediction_charges([loop_soc, best_soc_min], window_n, charge_limit, charge_window, discharge_window, discharge_limits, all_n, end_record)
+            for try_soc, han in zip([loop_soc, best_soc_min], hans):
+                resultmid[try_soc], result10[try_soc] = han.get()
+                for result in [resultmid[try_soc], result10[try_soc]]:
+                    all_min_soc = min(all_min_soc, result[11])
+                    all_max_soc = max(all_max_soc, result[12])
 
         # Assemble list of SOCs to try
         try_socs = []
@@ -5835,29 +6486,41 @@ class PredBat(hass.Hass):
         if self.set_charge_freeze and (self.reserve not in try_socs):
             try_socs.append(self.reserve)
 
-        # Run the simulations in parallel
-        results = []
-        results10 = []
-        for try_soc in try_socs:
-            if try_soc not in resultmid:
-                hanres = self.launch_run_prediction_charge(try_soc, window_n, charge_limit, charge_window, discharge_window, discharge_limits, False, all_n, end_record)
-                results.append(hanres)
-                hanres10 = self.launch_run_prediction_charge(try_soc, window_n, charge_limit, charge_window, discharge_window, discharge_limits, True, all_n, end_record)
-                results10.append(hanres10)
+        # Coarse scan to find the best bracket and only simulate the SOCs around it in full
+        if self.calculate_coarse_to_fine and len(try_socs) > OPTIMISE_COARSE_STRIDE * 3:
+            keep_socs = [best_soc_min_setting, self.reserve] + list(resultmid.keys())
+            if not all_n:
+                keep_socs.append(charge_limit[window_n])
+            try_socs = self.optimise_charge_limit_coarse(
+                window_n, try_socs, keep_socs, min_improvement_scaled, charge_limit, charge_window, discharge_window, discharge_limits, all_n, end_record
+            )
 
-        # Get results from sims if we simulated them
-        for try_soc in try_socs:
-            if try_soc not in resultmid:
-                hanres = results.pop(0)
-                hanres10 = results10.pop(0)
-                resultmid[try_soc] = hanres.get()
-                result10[try_soc] = hanres10.get()
+        # The first SOC to try has already been simulated, those after it which can't beat it by more than any adjustment can never be picked so are pruned
+        prune = None
+        if try_socs and (try_socs[0] in resultmid) and (self.metric_min_improvement >= 0):
+            first_soc = try_socs[0]
+            first_result, first_result10 = resultmid[first_soc], result10[first_soc]
+            first_metric = self.compute_metric_result(end_record, first_result, first_result10)
+            first_metric -= self.charge_metric_adjust(first_soc, window_n, charge_window, all_n, best_soc_min_setting)
+            prune = self.prune_bound(end_record, first_metric + max(0.1, self.metric_min_improvement) + 0.002)
+
+        # Run the simulations in parallel, the results are collected as they finish
+        launch_socs = [try_soc for try_soc in try_socs if try_soc not in resultmid]
+        results = self.launch_run_prediction_charges(launch_socs, window_n, charge_limit, charge_window, discharge_window, discharge_limits, all_n, end_record, prune=prune)
+        for han in self.get_scheduler().as_completed(results):
+            try_soc = launch_socs[results.index(han)]
+            resultmid[try_soc], result10[try_soc] = han.get()
 
         window_results = {}
         # Now we have all the results, we can pick the best SOC
         for try_soc in try_socs:
             window = charge_window[window_n]
 
+            # Pruned as it can't be picked
+            if resultmid[try_soc] is None:
+                self.sim_pruned += 1
+                continue
+
             # Store try value into the window, either all or just this one
             if all_n:
                 for window_id in all_n:
@@ -5902,22 +6565,7 @@ class PredBat(hass.Hass):
                 end_record, soc, soc10, cost, cost10, final_iboost, final_iboost10, battery_cycle, metric_keep, final_carbon_g, import_kwh_battery, import_kwh_house, export_kwh
             )
 
-            # Metric adjustment based on current charge limit when inside the window
-            # to try to avoid constant small changes to SOC target by forcing to keep the current % during a charge period
-            # if changing it has little impact
-            if not all_n and self.isCharging and (window_n == self.in_charge_window(charge_window, self.minutes_now)) and (try_soc != self.reserve):
-                try_percent = calc_percent_limit(try_soc, self.soc_max)
-                compare_with = max(self.current_charge_limit, self.reserve_percent)
-
-                if compare_with == try_percent:
-                    metric -= max(0.1, self.metric_min_improvement)
-
-            if try_soc == best_soc_min_setting:
-                # Minor weighting to 0%
-                metric -= 0.002
-            elif try_soc == self.soc_max or try_soc == self.reserve:
-                # Minor weighting to 100% or freeze
-                metric -= 0.001
+            metric -= self.charge_metric_adjust(try_soc, window_n, charge_window, all_n, best_soc_min_setting)
 
             # Round metric to 4 DP
             metric = self.dp4(metric)
@@ -6001,6 +6649,55 @@ class PredBat(hass.Hass):
                 )
         return best_soc, best_metric, best_cost, best_soc_min, best_soc_min_minute, best_keep, best_cycle, best_carbon, best_import
 
+    def optimise_charge_limit_coarse(
+        self, window_n, try_socs, keep_socs, min_improvement_scaled, charge_limit, charge_window, discharge_window, discharge_limits, all_n, end_record
+    ):
+        """
+        Scan the SOCs to try with coarse SOC increments at a 30 minute step
+        Returns the SOCs to try in full, those within one coarse increment of the best coarse SOC and those in keep_socs
+        """
+        scan_socs = sorted(set(try_socs), reverse=True)
+        coarse_socs = scan_socs[::OPTIMISE_COARSE_STRIDE]
+        if scan_socs[-1] not in coarse_socs:
+            coarse_socs.append(scan_socs[-1])
+
+        # Run the simulations in parallel
+        results = self.launch_run_prediction_charges(coarse_socs, window_n, charge_limit, charge_window, discharge_window, discharge_limits, all_n, end_record, step=30)
+
+        best_metric = 9999999
+        best_soc = coarse_socs[0]
+        for try_soc, hanres in zip(coarse_socs, results):
+            result, result10 = hanres.get()
+            (
+                cost,
+                import_kwh_battery,
+                import_kwh_house,
+                export_kwh,
+                soc_min,
+                soc,
+                soc_min_minute,
+                battery_cycle,
+                metric_keep,
+                final_iboost,
+                final_carbon_g,
+                min_soc,
+                max_soc,
+            ) = result
+            cost10, _, _, _, _, soc10, _, _, _, final_iboost10, _, _, _ = result10
+            metric = self.compute_metric(
+                end_record, soc, soc10, cost, cost10, final_iboost, final_iboost10, battery_cycle, metric_keep, final_carbon_g, import_kwh_battery, import_kwh_house, export_kwh
+            )
+            if (metric + min_improvement_scaled) <= best_metric:
+                best_metric = metric
+                best_soc = try_soc
+
+        # Refine around the best coarse SOC
+        best_index = scan_socs.index(best_soc)
+        refine_socs = scan_socs[max(best_index - OPTIMISE_COARSE_STRIDE, 0) : best_index + OPTIMISE_COARSE_STRIDE + 1]
+        if self.debug_enable:
+            self.log("Coarse scan charge window {} socs {} best {} refine {}".format(window_n if not all_n else all_n, coarse_socs, best_soc, refine_socs))
+        return [try_soc for try_soc in try_socs if (try_soc in refine_socs) or (try_soc in keep_socs)]
+
     def optimise_discharge(
         self, window_n, record_charge_windows, try_charge_limit, charge_window, discharge_window, discharge_limit, all_n=None, end_record=None, freeze_only=False
     ):
@@ -6036,7 +6733,6 @@ class PredBat(hass.Hass):
 
         # Collect all options
         results = []
-        results10 = []
         try_options = []
         for loop_limit in loop_options:
             # Loop on window size
@@ -6060,30 +6756,33 @@ class PredBat(hass.Hass):
                 this_discharge_limit = max(calc_percent_limit(max(self.best_soc_min, self.reserve), self.soc_max), this_discharge_limit)
                 try_options.append([start, this_discharge_limit])
 
-                results.append(
-                    self.launch_run_prediction_discharge(
-                        this_discharge_limit, start, window_n, try_charge_limit, charge_window, try_discharge_window, try_discharge, False, all_n, end_record
-                    )
-                )
-                results10.append(
-                    self.launch_run_prediction_discharge(
-                        this_discharge_limit, start, window_n, try_charge_limit, charge_window, try_discharge_window, try_discharge, True, all_n, end_record
-                    )
-                )
+        # The first option is discharge off, the others are only picked if they beat it so those which can't are pruned
+        prune = None
+        if try_options and self.metric_min_improvement_discharge >= 0:
+            results = self.launch_run_prediction_discharges(try_options[:1], window_n, try_charge_limit, charge_window, try_discharge_window, try_discharge, all_n, end_record)
+            first_result, first_result10 = results[0].get()
+            first_metric = self.compute_metric_result(end_record, first_result, first_result10)
+            prune = self.prune_bound(end_record, first_metric + max(0.5, self.metric_min_improvement_discharge))
+        results += self.launch_run_prediction_discharges(
+            try_options[len(results) :], window_n, try_charge_limit, charge_window, try_discharge_window, try_discharge, all_n, end_record, prune=prune
+        )
 
-        # Get results from sims
-        try_results = []
-        for try_option in try_options:
-            hanres = results.pop(0)
-            hanres10 = results10.pop(0)
-            result = hanres.get()
-            result10 = hanres10.get()
-            try_results.append(try_option + [result, result10])
+        # Get results from sims as they finish
+        try_results = [None for try_option in try_options]
+        for han in self.get_scheduler().as_completed(results):
+            option_n = results.index(han)
+            result, result10 = han.get()
+            try_results[option_n] = try_options[option_n] + [result, result10]
 
         window_results = {}
         for try_option in try_results:
             start, this_discharge_limit, hanres, hanres10 = try_option
 
+            # Pruned as it can't beat discharge off
+            if hanres is None:
+                self.sim_pruned += 1
+                continue
+
             # Simulate with medium PV
             cost, import_kwh_battery, import_kwh_house, export_kwh, soc_min, soc, soc_min_minute, battery_cycle, metric_keep, final_iboost, final_carbon_g = hanres
             (
@@ -6664,6 +7363,251 @@ class PredBat(hass.Hass):
             )
         )
 
+    def discharge_window_allowed(self, window_n):
+        """
+        Can the discharge window be optimised, it's skipped if it overlaps a charge window (unless discharge on charge is enabled),
+        a car charging window or an iBoost window (unless iBoost on discharge is enabled)
+        """
+        start = self.discharge_window_best[window_n]["start"]
+        end = self.discharge_window_best[window_n]["end"]
+        if not self.calculate_discharge_oncharge:
+            hit_charge = self.hit_charge_window(self.charge_window_best, start, end)
+            if hit_charge >= 0 and self.charge_limit_best[hit_charge] > 0.0:
+                return False
+        if not self.car_charging_from_battery and self.hit_car_window(start, end):
+            return False
+        if not self.iboost_on_discharge and self.iboost_enable and self.iboost_plan and (self.hit_charge_window(self.iboost_plan, start, end) >= 0):
+            return False
+        return True
+
+    def optimise_plan_dp_options(self, windows, charge_options, discharge_options, charge_steps, discharge_steps):
+        """
+        Returns the distinct combinations of levels to try for windows which start together in the dynamic programming optimiser
+
+        The levels of the window with the most are thinned out, keeping the first and last, until there are at most
+        OPTIMISE_DP_STAGE_OPTIONS combinations
+        """
+        window_options = [charge_options if typ == "c" else discharge_options for typ, window_n in windows]
+        while math.prod([len(values) for values in window_options]) > OPTIMISE_DP_STAGE_OPTIONS:
+            longest = max(range(len(window_options)), key=lambda index: len(window_options[index]))
+            values = window_options[longest]
+            if len(values) <= 2:
+                break
+            window_options[longest] = values[::2] + ([values[-1]] if len(values) % 2 == 0 else [])
+
+        options = []
+        options_tried = set()
+        for option in product(*window_options):
+            # A charge window which is clipped out by a discharge window starting with it is left at its first level
+            clipped = set()
+            for (typ, window_n), value in zip(windows, option):
+                if typ == "d" and value < 100.0:
+                    clipped.update(discharge_steps.get(window_n, []))
+            option = tuple(charge_options[0] if typ == "c" and charge_steps.get(window_n, set()) <= clipped else value for (typ, window_n), value in zip(windows, option))
+            if option not in options_tried:
+                options_tried.add(option)
+                options.append(option)
+        return options
+
+    def optimise_plan_dp(self, record_charge_windows, record_discharge_windows, end_record):
+        """
+        Optimise the charge and discharge windows with dynamic programming over the battery SOC
+
+        The windows are visited in time order, each plan so far is simulated up to the start of the next window and checkpointed
+        and only the best plan ending in each SOC bucket is carried forward. The search uses the medium PV scenario, the plans
+        left at the end and the plan we started from are then compared on the full metric.
+
+        The score used to pick the plan kept in each bucket is only a heuristic, it is the metric so far with the energy in the
+        battery valued at the end rate so it ignores the pv10 scenario and what the later windows would make of that energy.
+
+        Returns the charge limits, discharge limits, best charge and discharge price and the metric, cost, keep, cycle, carbon and import
+        """
+        prediction = self.prediction
+        charge_window = self.charge_window_best
+        discharge_window = self.discharge_window_best
+        end_value = max(self.metric_battery_value_scaling * self.metric_end_rate(end_record), 0)
+        buckets = OPTIMISE_DP_BUCKETS
+
+        # Charge levels to try, off first
+        best_soc_min_setting = self.best_soc_min
+        if best_soc_min_setting > 0:
+            best_soc_min_setting = max(self.reserve, best_soc_min_setting)
+        charge_options = [best_soc_min_setting]
+        if self.set_charge_freeze and (self.reserve not in charge_options):
+            charge_options.append(self.reserve)
+        soc_top = min(self.best_soc_max, self.soc_max) if self.best_soc_max > 0 else self.soc_max
+        for level in range(1, buckets + 1):
+            try_soc = self.dp2(min(self.soc_max * level / buckets, soc_top))
+            if (try_soc > self.reserve) and (try_soc > best_soc_min_setting) and (try_soc not in charge_options):
+                charge_options.append(try_soc)
+
+        # Discharge levels to try, off first
+        discharge_options = [100.0]
+        if self.set_discharge_freeze:
+            discharge_options.append(99.0)
+        if not self.set_discharge_freeze_only:
+            discharge_min = calc_percent_limit(max(self.best_soc_min, self.reserve), self.soc_max)
+            for level in range(0, buckets):
+                try_limit = max(discharge_min, 100.0 * level / buckets)
+                if try_limit not in discharge_options:
+                    discharge_options.append(try_limit)
+
+        # Group the windows to optimise by the minute they start
+        stages = {}
+        for window_n in range(min(record_charge_windows, len(charge_window))):
+            window = charge_window[window_n]
+            if window["start"] not in self.manual_all_times:
+                stages.setdefault(max(window["start"] - self.minutes_now, 0), []).append(("c", window_n))
+        if self.calculate_best_discharge:
+            for window_n in range(min(record_discharge_windows, len(discharge_window))):
+                window = discharge_window[window_n]
+                if (window["start"] in self.manual_all_times) or not self.discharge_window_allowed(window_n):
+                    continue
+                # Without discharge on charge the charge windows come first
+                if not self.calculate_discharge_oncharge and self.hit_charge_window(charge_window, window["start"], window["end"]) >= 0:
+                    continue
+                stages.setdefault(max(window["start"] - self.minutes_now, 0), []).append(("d", window_n))
+        stage_starts = sorted([start for start in stages if start < end_record])
+
+        # The plan we start from, the discharge windows to optimise are off until they are reached
+        charge_limit = self.charge_limit_best.copy()
+        discharge_limits = self.discharge_limits_best.copy()
+        for start in stage_starts:
+            for typ, window_n in stages[start]:
+                if typ == "d":
+                    discharge_limits[window_n] = 100.0
+        start_charge_limit = charge_limit.copy()
+        start_discharge_limits = discharge_limits.copy()
+
+        # Charging is clipped out of enabled discharge windows, the same as remove_intersecting_windows()
+        steps = len(prediction.pv_forecast_array)
+        charge_array = prediction.find_charge_window_array(charge_window, steps)
+        discharge_array = prediction.find_charge_window_array(discharge_window, steps)
+        charge_steps = {}
+        for step_n, window_n in enumerate(charge_array):
+            if window_n >= 0:
+                charge_steps.setdefault(window_n, set()).add(step_n)
+        discharge_steps = {}
+        for step_n, window_n in enumerate(discharge_array):
+            if window_n >= 0:
+                discharge_steps.setdefault(window_n, []).append(step_n)
+        for window_n, limit in enumerate(discharge_limits):
+            if limit < 100.0:
+                for step_n in discharge_steps.get(window_n, []):
+                    charge_array[step_n] = -1
+
+        nodes = {}
+        if stage_starts:
+            checkpoint = prediction.run_prediction_array(
+                charge_limit,
+                charge_window,
+                discharge_window,
+                discharge_limits,
+                False,
+                end_record,
+                checkpoints={},
+                lean=True,
+                plan=(charge_limit, charge_window, charge_array, discharge_array),
+                stop=stage_starts[0],
+            )
+            nodes[0] = (None, checkpoint, charge_limit, discharge_limits, charge_array)
+
+        for stage_n, start in enumerate(stage_starts):
+            windows = stages[start]
+            if stage_n + 1 < len(stage_starts):
+                stop = stage_starts[stage_n + 1]
+            else:
+                window_end = max([(charge_window if typ == "c" else discharge_window)[window_n]["end"] for typ, window_n in windows])
+                stop = min(window_end - self.minutes_now, end_record, self.forecast_minutes - PREDICT_STEP)
+            options = self.optimise_plan_dp_options(windows, charge_options, discharge_options, charge_steps, discharge_steps)
+            next_nodes = {}
+            for score, checkpoint, charge_limit, discharge_limits, charge_array in nodes.values():
+                for option in options:
+                    try_charge_limit = charge_limit.copy()
+                    try_discharge_limits = discharge_limits.copy()
+                    try_charge_array = charge_array
+                    for (typ, window_n), value in zip(windows, option):
+                        if typ == "c":
+                            try_charge_limit[window_n] = value
+                        else:
+                            try_discharge_limits[window_n] = value
+                            if value < 100.0:
+                                if try_charge_array is charge_array:
+                                    try_charge_array = charge_array.copy()
+                                for step_n in discharge_steps.get(window_n, []):
+                                    try_charge_array[step_n] = -1
+                    plan = (try_charge_limit, charge_window, try_charge_array, discharge_array)
+
+                    # Each window is simulated up to the start of the next, the last one to its end
+                    state = prediction.run_prediction_array(
+                        try_charge_limit,
+                        charge_window,
+                        discharge_window,
+                        try_discharge_limits,
+                        False,
+                        end_record,
+                        checkpoints={},
+                        resume=checkpoint,
+                        lean=True,
+                        plan=plan,
+                        stop=stop,
+                    )
+                    try_soc = state.soc
+                    try_score = prediction.checkpoint_metric(state, end_value)
+
+                    # Keep the best plan in each bucket, on a tie the one with the most energy left in the battery
+                    try_soc = round(try_soc, 3)
+                    bucket = int(try_soc * buckets / self.soc_max + 0.5) if self.soc_max > 0 else 0
+                    try_score = (round(try_score, 4), -try_soc)
+                    if (bucket not in next_nodes) or (try_score < next_nodes[bucket][0]):
+                        next_nodes[bucket] = (try_score, state, try_charge_limit, try_discharge_limits, try_charge_array)
+            nodes = next_nodes
+
+        # Compare the plans left and the plan we started from on the full metric
+        candidates = [(start_charge_limit, start_discharge_limits)] + [(node[2], node[3]) for node in nodes.values()]
+        handles = []
+        for try_charge_limit, try_discharge_limits in candidates:
+            handles.append([self.launch_run_prediction_single(try_charge_limit, charge_window, discharge_window, try_discharge_limits, pv10, end_record) for pv10 in [False, True]])
+
+        best = None
+        for (try_charge_limit, try_discharge_limits), (han, han10) in zip(candidates, handles):
+            result = han.get()
+            result10 = han10.get()
+            metric = self.compute_metric_result(end_record, result, result10)
+            if best is None or metric < best[0]:
+                best = (metric, try_charge_limit, try_discharge_limits, result)
+        best_metric, charge_limit, discharge_limits, result = best
+        cost, import_kwh_battery, import_kwh_house, export_kwh, soc_min, soc, soc_min_minute, battery_cycle, metric_keep, final_iboost, final_carbon_g = result
+
+        # Report the highest rate charged at and the lowest rate discharged at as the thresholds
+        best_price = 0
+        for window_n in range(min(record_charge_windows, len(charge_window))):
+            if charge_limit[window_n] > 0:
+                best_price = max(best_price, charge_window[window_n]["average"])
+        best_price_discharge = 0
+        for window_n in range(min(record_discharge_windows, len(discharge_window))):
+            if discharge_limits[window_n] < 100.0:
+                average = discharge_window[window_n]["average"]
+                best_price_discharge = min(best_price_discharge, average) if best_price_discharge else average
+
+        self.log(
+            "Dynamic programming optimised {} windows in {} stages with {} charge and {} discharge levels, best metric {} cost {}".format(
+                sum([len(stages[start]) for start in stage_starts]), len(stage_starts), len(charge_options), len(discharge_options), self.dp2(best_metric), self.dp2(cost)
+            )
+        )
+        return (
+            charge_limit,
+            discharge_limits,
+            best_price,
+            best_price_discharge,
+            best_metric,
+            cost,
+            metric_keep,
+            battery_cycle,
+            final_carbon_g,
+            import_kwh_battery + import_kwh_house,
+        )
+
     def optimise_all_windows(self, best_metric, metric_keep):
         """
         Optimise all windows, both charge and discharge in rate order
@@ -6683,6 +7627,40 @@ class PredBat(hass.Hass):
         best_price_discharge = 0
         fast_mode = True
 
+        # Optimise the whole plan with dynamic programming instead of the price threshold and per window passes
+        if self.calculate_dynamic_programming and price_set and self.calculate_best_charge and self.charge_window_best:
+            self.log("Optimise all windows with dynamic programming, total charge {} discharge {}".format(record_charge_windows, record_discharge_windows))
+            self.optimise_charge_windows_reset(reset_all=True)
+            self.optimise_charge_windows_manual()
+            (
+                self.charge_limit_best,
+                self.discharge_limits_best,
+                best_price,
+                best_price_discharge,
+                best_metric,
+                best_cost,
+                best_keep,
+                best_cycle,
+                best_carbon,
+                best_import,
+            ) = self.optimise_plan_dp(record_charge_windows, record_discharge_windows, self.end_record)
+            self.end_record = self.record_length(self.charge_window_best, self.charge_limit_best, best_price)
+            self.rate_best_cost_threshold_charge = best_price
+            self.rate_best_cost_threshold_discharge = best_price_discharge
+            self.log(
+                "Best plan best_metric {} best_cost {} best_carbon {} best_import {} metric_keep {} end_record {} charge windows {} discharge windows {}".format(
+                    self.dp2(best_metric),
+                    self.dp2(best_cost),
+                    self.dp0(best_carbon),
+                    self.dp2(best_import),
+                    self.dp2(best_keep),
+                    self.time_abs_str(self.end_record + self.minutes_now),
+                    self.window_as_text(self.charge_window_best, calc_percent_limit(self.charge_limit_best, self.soc_max), ignore_min=True),
+                    self.window_as_text(self.discharge_window_best, self.discharge_limits_best, ignore_max=True),
+                )
+            )
+            return
+
         # Optimise all windows by picking a price threshold default
         if price_set and self.calculate_best_charge and self.charge_window_best:
             self.log("Optimise all windows, total charge {} discharge {}".format(record_charge_windows, record_discharge_windows))
@@ -6720,10 +7698,54 @@ class PredBat(hass.Hass):
                 region_size = int(16 * 60)
                 while region_size >= 2 * 60:
                     self.log(">> Region optimisation pass width {}".format(region_size))
+                    regions = []
                     for region in range(0, self.end_record + self.minutes_now, region_size):
                         region_end = min(region + region_size, self.end_record + self.minutes_now)
-                        if region_end < self.minutes_now:
-                            continue
+                        if region_end >= self.minutes_now:
+                            regions.append((region, region_end))
+
+                    for region_n, (region, region_end) in enumerate(regions):
+                        # Launch all the price bands of this region and the following regions up front so the pool is kept busy while the results are reduced
+                        # The results are only used for plans which match exactly so the regions are still merged in order and the plan is the same as
+                        # optimising them one at a time, plans already launched are not launched again
+                        if self.pool and self.pool._state == "RUN":
+                            region_windows = self.region_windows(
+                                self.charge_window_best, self.discharge_window_best, record_charge_windows, record_discharge_windows, region, region_end
+                            )
+                            # Regions which share a window with this one are changed by it so are not launched ahead
+                            prefetch_regions = [
+                                (prefetch_start, prefetch_end)
+                                for prefetch_start, prefetch_end in regions[region_n + 1 :]
+                                if region_windows.isdisjoint(
+                                    self.region_windows(
+                                        self.charge_window_best,
+                                        self.discharge_window_best,
+                                        record_charge_windows,
+                                        record_discharge_windows,
+                                        prefetch_start,
+                                        prefetch_end,
+                                    )
+                                )
+                            ]
+                            for prefetch_start, prefetch_end in [(region, region_end)] + prefetch_regions[:OPTIMISE_REGION_PREFETCH]:
+                                self.optimise_region_prefetch(
+                                    price_set,
+                                    price_links,
+                                    window_index,
+                                    record_charge_windows,
+                                    record_discharge_windows,
+                                    self.charge_limit_best,
+                                    self.charge_window_best,
+                                    self.discharge_window_best,
+                                    ignore_discharge_limits,
+                                    self.end_record,
+                                    prefetch_start,
+                                    prefetch_end,
+                                    fast=fast_mode,
+                                    best_metric=best_metric,
+                                    tried_list=tried_list,
+                                )
+                        plan_before = (self.charge_limit_best.copy(), ignore_discharge_limits.copy())
                         (
                             self.charge_limit_best,
                             ignore_discharge_limits,
@@ -6763,8 +7785,14 @@ class PredBat(hass.Hass):
                             best_carbon=best_carbon,
                             tried_list=tried_list,
                         )
+                        if plan_before != (self.charge_limit_best, ignore_discharge_limits):
+                            # The plans launched ahead were built on the old plan so will never be asked for
+                            self.prediction.result_cache.clear_pending(cancel=self.get_scheduler().cancel)
                     region_size = int(region_size / 2)
 
+                # Prefetched results are only valid against the bounds of these passes
+                self.prediction.result_cache.clear_pending(cancel=self.get_scheduler().cancel)
+
         # Set the new end record and blackout period based on the levelling
         self.end_record = self.record_length(self.charge_window_best, self.charge_limit_best, best_price)
         self.optimise_charge_windows_reset(reset_all=False)
@@ -6899,22 +7927,7 @@ class PredBat(hass.Hass):
                             continue
 
                         if self.calculate_best_discharge and (window_start not in self.manual_all_times):
-                            if not self.calculate_discharge_oncharge:
-                                hit_charge = self.hit_charge_window(
-                                    self.charge_window_best, self.discharge_window_best[window_n]["start"], self.discharge_window_best[window_n]["end"]
-                                )
-                                if hit_charge >= 0 and self.charge_limit_best[hit_charge] > 0.0:
-                                    continue
-                            if not self.car_charging_from_battery and self.hit_car_window(
-                                self.discharge_window_best[window_n]["start"], self.discharge_window_best[window_n]["end"]
-                            ):
-                                continue
-                            if (
-                                not self.iboost_on_discharge
-                                and self.iboost_enable
-                                and self.iboost_plan
-                                and (self.hit_charge_window(self.iboost_plan, self.discharge_window_best[window_n]["start"], self.discharge_window_best[window_n]["end"]) >= 0)
-                            ):
+                            if not self.discharge_window_allowed(window_n):
                                 continue
 
                             average = self.discharge_window_best[window_n]["average"]
@@ -7032,18 +8045,7 @@ class PredBat(hass.Hass):
                 else:
                     window_start = self.discharge_window_best[window_n]["start"]
                     if self.calculate_best_discharge and (window_start not in self.manual_all_times):
-                        if not self.calculate_discharge_oncharge:
-                            hit_charge = self.hit_charge_window(self.charge_window_best, self.discharge_window_best[window_n]["start"], self.discharge_window_best[window_n]["end"])
-                            if hit_charge >= 0 and self.charge_limit_best[hit_charge] > 0.0:
-                                continue
-                        if not self.car_charging_from_battery and self.hit_car_window(self.discharge_window_best[window_n]["start"], self.discharge_window_best[window_n]["end"]):
-                            continue
-                        if (
-                            not self.iboost_on_discharge
-                            and self.iboost_enable
-                            and self.iboost_plan
-                            and (self.hit_charge_window(self.iboost_plan, self.discharge_window_best[window_n]["start"], self.discharge_window_best[window_n]["end"]) >= 0)
-                        ):
+                        if not self.discharge_window_allowed(window_n):
                             continue
 
                         average = self.discharge_window_best[window_n]["average"]
@@ -7700,8 +8702,10 @@ class PredBat(hass.Hass):
         yesterday_pv_step = self.step_data_history(self.pv_today, 0, forward=False, scale_today=1.0, scale_fixed=1.0, base_offset=24 * 60 + self.minutes_now)
         yesterday_pv_step_zero = self.step_data_history(None, 0, forward=False, scale_today=1.0, scale_fixed=1.0, base_offset=24 * 60 + self.minutes_now)
 
-        # Get SOC history to find yesterday SOC
-        soc_kwh_data = self.get_history_wrapper(entity_id=self.prefix + ".soc_kw_h0", days=2)
+        # Get SOC and cost history to find yesterday SOC and cost
+        soc_kwh_data, cost_today_data = self.get_history_wrapper_multiple([self.prefix + ".soc_kw_h0", self.prefix + ".cost_today"], days=2)
+        if soc_kwh_data is None:
+            raise ValueError
         if not soc_kwh_data:
             self.log("Warn: No SOC data found for yesterday")
             return
@@ -7738,7 +8742,8 @@ class PredBat(hass.Hass):
         self.log("Yesterday basic charge window best: {} charge limit best: {}".format(charge_window_best, charge_limit_best))
 
         # Get Cost yesterday
-        cost_today_data = self.get_history_wrapper(entity_id=self.prefix + ".cost_today", days=2)
+        if cost_today_data is None:
+            raise ValueError
         if not cost_today_data:
             self.log("Warn: No cost_today data for yesterday")
             return
@@ -8022,17 +9027,28 @@ class PredBat(hass.Hass):
         # Creation prediction object
         self.prediction = Prediction(self, pv_forecast_minute_step, pv_forecast_minute10_step, load_minutes_step, load_minutes_step10)
 
-        # Create pool
+        # Create pool, it's kept between plans and the workers attach to the prediction data via shared memory
         if not self.pool:
             threads = self.get_arg("threads", "auto")
             if threads == "auto":
-                self.log("Creating pool of {} processes to match your CPU count".format(cpu_count()))
-                self.pool = Pool(processes=cpu_count())
+                threads = cpu_count()
+                self.log("Creating pool of {} processes to match your CPU count".format(threads))
             elif threads:
-                self.log("Creating pool of {} processes as per apps.yaml".format(int(threads)))
-                self.pool = Pool(processes=int(threads))
+                threads = int(threads)
+                self.log("Creating pool of {} processes as per apps.yaml".format(threads))
             else:
                 self.log("Not using threading as threads is set to 0 in apps.yaml")
+            if threads and self.get_arg("threads_backend", "process") == "thread":
+                self.log("Using a pool of threads rather than processes as per apps.yaml")
+                self.pool = ThreadPool(processes=threads)
+            elif threads:
+                if not self.prediction_shared:
+                    self.prediction_shared = PredictionShared()
+                self.pool = Pool(processes=threads, initializer=prediction_worker_init, initargs=(self.prediction_shared.control_name(),))
+
+        # Publish this plan's prediction data to the workers
+        if self.pool and self.prediction_shared:
+            self.prediction_shared.publish(self.prediction)
 
         # Simulate current settings to get initial data
         metric, import_kwh_battery, import_kwh_house, export_kwh, soc_min, soc, soc_min_minute, battery_cycle, metric_keep, final_iboost, final_carbon_g = self.run_prediction(
@@ -8049,12 +9065,21 @@ class PredBat(hass.Hass):
             self.log_option_best()
 
             # Full plan
+            self.sim_pruned = 0
             self.optimise_all_windows(metric, metric_keep)
 
             # Tweak plan
             if self.calculate_tweak_plan:
                 self.tweak_plan(self.end_record, metric, metric_keep)
 
+            # Report how much simulation the result cache saved
+            cache = self.prediction.result_cache
+            self.log(
+                "Prediction result cache hits {} misses {} hit rate {}% entries {} evictions {} pruned {} prefetched {} used {}".format(
+                    cache.hits, cache.misses, cache.hit_rate(), len(cache.results), cache.evictions, self.sim_pruned, cache.prefetched, cache.prefetch_hits
+                )
+            )
+
             # Remove charge windows that overlap with discharge windows
             self.charge_limit_best, self.charge_window_best = remove_intersecting_windows(
                 self.charge_limit_best, self.charge_window_best, self.discharge_limits_best, self.discharge_window_best
@@ -8242,15 +9267,6 @@ class PredBat(hass.Hass):
             # HTML data
             self.publish_html_plan(pv_forecast_minute_step, pv_forecast_minute10_step, load_minutes_step, load_minutes_step10, self.end_record)
 
-        # Destroy pool
-        if self.pool:
-            try:
-                self.pool.close()
-                self.pool.join()
-            except Exception as e:
-                self.log("Warn: failed to close thread pool: {}".format(e))
-                self.log("Warn: " + traceback.format_exc())
-            self.pool = None
         # Return if we recomputed or not
         return recompute
 
@@ -8364,6 +9380,7 @@ class PredBat(hass.Hass):
                     )
                     # Are we actually charging?
                     if self.minutes_now >= minutes_start and self.minutes_now < minutes_end:
+                        compile_rate_curve_tables(self)
                         charge_rate = find_charge_rate(
                             self,
                             self.minutes_now,
@@ -9733,6 +10750,9 @@ class PredBat(hass.Hass):
         self.calculate_second_pass = self.get_arg("calculate_second_pass")
         self.calculate_inday_adjustment = self.get_arg("calculate_inday_adjustment")
         self.calculate_tweak_plan = self.get_arg("calculate_tweak_plan")
+        self.calculate_coarse_to_fine = self.get_arg("calculate_coarse_to_fine")
+        self.calculate_discharge_greedy = self.get_arg("calculate_discharge_greedy")
+        self.calculate_dynamic_programming = self.get_arg("calculate_dynamic_programming")
         self.calculate_regions = True
         self.calculate_secondary_order = self.get_arg("calculate_secondary_order")
 
@@ -10002,6 +11022,16 @@ class PredBat(hass.Hass):
             )
         self.expose_config("active", False)
         self.save_current_config()
+        if self.debug_enable:
+            self.log_http_stats()
+            self.log("Skipped {} unchanged entity updates".format(self.published_skipped))
+
+    def log_http_stats(self):
+        """
+        Log the latency of each HTTP endpoint used so far
+        """
+        for endpoint, stats in sorted(self.http_client.get_stats().items()):
+            self.log("HTTP {} requests {} errors {} average {}s max {}s".format(endpoint, stats["count"], stats["errors"], self.dp3(stats["average"]), self.dp3(stats["max"])))
 
     async def update_event(self, event, data, kwargs):
         """
@@ -10268,10 +11298,10 @@ class PredBat(hass.Hass):
                         unit = item["unit"]
                         unit = unit.replace("£", self.currency_symbols[0])
                         unit = unit.replace("p", self.currency_symbols[1])
-                        self.set_state_wrapper(
-                            entity_id=entity,
-                            state=value,
-                            attributes={
+                        self.publish_state(
+                            entity,
+                            value,
+                            {
                                 "friendly_name": item["friendly_name"],
                                 "min": item["min"],
                                 "max": item["max"],
@@ -10283,7 +11313,7 @@ class PredBat(hass.Hass):
                     elif item["type"] == "switch":
                         """SWITCH"""
                         icon = item.get("icon", "mdi:light-switch")
-                        self.set_state_wrapper(entity_id=entity, state=("on" if value else "off"), attributes={"friendly_name": item["friendly_name"], "icon": icon})
+                        self.publish_state(entity, ("on" if value else "off"), {"friendly_name": item["friendly_name"], "icon": icon})
                     elif item["type"] == "select":
                         """SELECT"""
                         icon = item.get("icon", "mdi:format-list-bulleted")
@@ -10295,7 +11325,7 @@ class PredBat(hass.Hass):
                         old_state = self.get_state_wrapper(entity_id=entity)
                         if old_state and old_state != value:
                             self.set_state_wrapper(entity_id=entity, state=old_state, attributes={"friendly_name": item["friendly_name"], "options": options, "icon": icon})
-                        self.set_state_wrapper(entity_id=entity, state=value, attributes={"friendly_name": item["friendly_name"], "options": options, "icon": icon})
+                        self.publish_state(entity, value, {"friendly_name": item["friendly_name"], "options": options, "icon": icon})
                     elif item["type"] == "update":
                         """UPDATE"""
                         summary = self.releases.get("latest_body", "")
@@ -10303,10 +11333,10 @@ class PredBat(hass.Hass):
                         state = "off"
                         if item["installed_version"] != latest:
                             state = "on"
-                        self.set_state_wrapper(
-                            entity_id=entity,
-                            state=state,
-                            attributes={
+                        self.publish_state(
+                            entity,
+                            state,
+                            {
                                 "friendly_name": item["friendly_name"],
                                 "title": item["title"],
                                 "in_progress": in_progress,
@@ -10338,11 +11368,35 @@ class PredBat(hass.Hass):
                 self.log("Warn: Badly formed CONFIG enable item {}, please raise a Github ticket".format(item["name"]))
         return True
 
+    def publish_state_hash(self, state, attributes):
+        """
+        Hash of a state and its attributes, None if it can not be hashed
+        """
+        try:
+            return hashlib.md5(json.dumps([state, attributes], sort_keys=True, default=str).encode()).hexdigest()
+        except (TypeError, ValueError):
+            return None
+
+    def publish_state(self, entity, state, attributes={}):
+        """
+        Publish state to HA, skipping the write if the state and attributes are unchanged since the last publish
+        and HA still holds the same state
+        """
+        state_hash = self.publish_state_hash(state, attributes)
+        if state_hash and self.published_state.get(entity) == state_hash and str(self.get_state_wrapper(entity_id=entity)) == str(state):
+            self.published_skipped += 1
+            return
+        self.set_state_wrapper(entity_id=entity, state=state, attributes=attributes)
+        if state_hash:
+            self.published_state[entity] = state_hash
+        else:
+            self.published_state.pop(entity, None)
+
     def dashboard_item(self, entity, state, attributes):
         """
         Publish state and log dashboard item
         """
-        self.set_state_wrapper(entity_id=entity, state=state, attributes=attributes)
+        self.publish_state(entity, state, attributes)
         if entity not in self.dashboard_index:
             self.dashboard_index.append(entity)
         self.dashboard_values[entity] = {}
@@ -10609,6 +11663,9 @@ class PredBat(hass.Hass):
         self.config_index = {}
         self.log("Refreshing Predbat configuration")
 
+        # Republish all entities on a config refresh in case HA has lost them
+        self.published_state = {}
+
         # New install, used to set default of expert mode
         new_install = True
         current_status = self.load_previous_value_from_ha(self.prefix + ".status")
@@ -10908,6 +11965,8 @@ class PredBat(hass.Hass):
         Setup the app, called once each time the app starts
         """
         self.pool = None
+        self.scheduler = None
+        self.prediction_shared = None
         self.log("Predbat: Startup {}".format(__name__))
         self.update_time(print=False)
         run_every = RUN_EVERY * 60
@@ -11005,6 +12064,10 @@ class PredBat(hass.Hass):
                     self.log("Warn: Failed to close thread pool {}".format(e))
                     self.log("Warn: " + traceback.format_exc())
                 self.pool = None
+        if hasattr(self, "prediction_shared"):
+            if self.prediction_shared:
+                self.prediction_shared.close()
+                self.prediction_shared = None
         self.log("Predbat terminated")
 
     def update_time_loop(self, cb_args):
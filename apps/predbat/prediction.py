@@ -13,10 +13,65 @@ import os
 import re
 import time
 import math
+import pickle
+import struct
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from multiprocessing import shared_memory
 from config import PREDICT_STEP, RUN_EVERY, TIME_FORMAT
-from utils import remove_intersecting_windows, get_charge_rate_curve, get_discharge_rate_curve, find_charge_rate, calc_percent_limit
-
+from utils import remove_intersecting_windows, get_charge_rate_curve, get_discharge_rate_curve, find_charge_rate, calc_percent_limit, compile_rate_curve_tables
+
+
+# Step arrays which are published into shared memory for the worker processes
+SHARED_ARRAYS = [
+    "pv_forecast_array",
+    "pv_forecast10_array",
+    "load_array",
+    "load10_array",
+    "rate_import_array",
+    "rate_export_array",
+    "carbon_array",
+    "rate_gas_array",
+    "iboost_load_array",
+    "export_value_array",
+    "import_value_array",
+]
+
+# Per-minute inputs which are only used to build the step arrays, the workers use the arrays instead
+SHARED_INPUTS = [
+    "pv_forecast_minute_step",
+    "pv_forecast_minute10_step",
+    "load_minutes_step",
+    "load_minutes_step10",
+    "rate_import",
+    "rate_export",
+    "rate_gas",
+    "carbon_intensity",
+]
+
+# Items which can't or don't need to be passed to the worker processes, the workers build the rate tables and caches themselves
+SHARED_EXCLUDE = ["log", "time_abs_str", "checkpoint_cache", "result_cache", "prune_cache", "battery_charge_rate_table", "battery_discharge_rate_table"]
+
+# Control block layout - generation counter, name length and name of the current data block
+SHARED_CONTROL_FORMAT = "<QI"
+SHARED_CONTROL_SIZE = 256
+
+# Data block layout - length of the pickled data and offset of the step arrays
+SHARED_DATA_FORMAT = "<QQ"
+
+# Number of base plans whose checkpoints are kept for incremental simulation
+PREDICT_CHECKPOINT_CACHE = 4
+
+# Maximum number of simulation results kept for the current plan
+PREDICT_RESULT_CACHE = 8192
+
+# Result cache key header - result type, window number, pv10, end record, step and the length of each part of the plan
+PREDICT_RESULT_KEY_FORMAT = "<Bi?iiIIII"
+PREDICT_RESULT_SINGLE = 0
+PREDICT_RESULT_CHARGE = 1
+
+# Number of steps between checks of whether a scenario can still beat the bound it was given
+PREDICT_PRUNE_INTERVAL = 12
 
 # Only assign globals once to avoid re-creating them with processes are forked
 if not "PRED_GLOBAL" in globals():
@@ -28,25 +83,340 @@ def reset_prediction_globals():
     PRED_GLOBAL = {}
 
 
-def wrapped_run_prediction_single(charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record, step):
+def prediction_worker_init(control_name):
+    """
+    Initialise a persistent worker process, the prediction data will be attached from shared memory on first use
+    """
     global PRED_GLOBAL
-    pred = Prediction()
-    pred.__dict__ = PRED_GLOBAL["dict"].copy()
-    return pred.thread_run_prediction_single(charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record, step)
+    PRED_GLOBAL["control"] = shared_memory.SharedMemory(name=control_name)
+    PRED_GLOBAL["generation"] = None
+    PRED_GLOBAL["pred"] = Prediction()
 
 
-def wrapped_run_prediction_charge(try_soc, window_n, charge_limit, charge_window, discharge_window, discharge_limits, pv10, all_n, end_record):
+def prediction_worker_release():
+    """
+    Release the shared memory views held for the previous plan generation
+    """
     global PRED_GLOBAL
-    pred = Prediction()
-    pred.__dict__ = PRED_GLOBAL["dict"].copy()
-    return pred.thread_run_prediction_charge(try_soc, window_n, charge_limit, charge_window, discharge_window, discharge_limits, pv10, all_n, end_record)
+    pred = PRED_GLOBAL.get("pred", None)
+    if pred:
+        pred.__dict__ = {}
+    for view in PRED_GLOBAL.get("views", []):
+        view.release()
+    PRED_GLOBAL["views"] = []
+    block = PRED_GLOBAL.get("block", None)
+    if block:
+        block.close()
+    PRED_GLOBAL["block"] = None
+
+
+def get_prediction_worker():
+    """
+    Returns the Prediction object for the worker
 
+    Persistent workers re-attach to the shared memory only when a new plan generation has been published, otherwise
+    the data copied from the parent process when the worker was forked is used
 
-def wrapped_run_prediction_discharge(this_discharge_limit, start, window_n, charge_limit, charge_window, discharge_window, discharge_limits, pv10, all_n, end_record):
+    Only the step arrays and a header of the settings are published, the worker builds the rate tables from the settings once per generation
+    """
     global PRED_GLOBAL
-    pred = Prediction()
-    pred.__dict__ = PRED_GLOBAL["dict"].copy()
-    return pred.thread_run_prediction_discharge(this_discharge_limit, start, window_n, charge_limit, charge_window, discharge_window, discharge_limits, pv10, all_n, end_record)
+    control = PRED_GLOBAL.get("control", None)
+    if not control:
+        pred = Prediction()
+        pred.__dict__ = PRED_GLOBAL["dict"].copy()
+        return pred
+
+    generation, name_len = struct.unpack_from(SHARED_CONTROL_FORMAT, control.buf, 0)
+    if generation != PRED_GLOBAL["generation"]:
+        prediction_worker_release()
+        offset = struct.calcsize(SHARED_CONTROL_FORMAT)
+        name = bytes(control.buf[offset : offset + name_len]).decode("utf-8")
+        block = shared_memory.SharedMemory(name=name)
+        pickle_len, base = struct.unpack_from(SHARED_DATA_FORMAT, block.buf, 0)
+        offset = struct.calcsize(SHARED_DATA_FORMAT)
+        pred_dict = pickle.loads(block.buf[offset : offset + pickle_len])
+
+        # Map the step arrays directly onto the shared memory
+        views = []
+        for array_name, (array_offset, array_len) in pred_dict.pop("shared_layout").items():
+            view = block.buf[base + array_offset : base + array_offset + array_len * 8]
+            array = view.cast("d")
+            views.extend([array, view])
+            pred_dict[array_name] = array
+
+        pred = PRED_GLOBAL["pred"]
+        pred.__dict__ = pred_dict
+        compile_rate_curve_tables(pred)
+        pred.checkpoint_cache = {}
+        pred.prune_cache = {}
+        PRED_GLOBAL["block"] = block
+        PRED_GLOBAL["views"] = views
+        PRED_GLOBAL["generation"] = generation
+    return PRED_GLOBAL["pred"]
+
+
+def prediction_cache_key(charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record, step=PREDICT_STEP, result_type=PREDICT_RESULT_SINGLE, window_n=-1):
+    """
+    Pack a plan into a compact binary key for the result cache, only the parts of the plan which change the simulation are included
+    """
+    charge_times = [minute for window in charge_window for minute in (window["start"], window["end"])]
+    discharge_times = [minute for window in discharge_window for minute in (window["start"], window["end"])]
+    key_format = PREDICT_RESULT_KEY_FORMAT + "{}d{}i{}i{}d".format(len(charge_limit), len(charge_times), len(discharge_times), len(discharge_limits))
+    return struct.pack(
+        key_format,
+        result_type,
+        window_n,
+        bool(pv10),
+        int(end_record),
+        int(step),
+        len(charge_limit),
+        len(charge_times),
+        len(discharge_times),
+        len(discharge_limits),
+        *charge_limit,
+        *charge_times,
+        *discharge_times,
+        *discharge_limits,
+    )
+
+
+class PredictionCache:
+    """
+    Least recently used cache of simulation results for the plan inputs of one Prediction
+    """
+
+    def __init__(self, size=PREDICT_RESULT_CACHE):
+        self.size = size
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.pending = {}
+        self.prefetched = 0
+        self.prefetch_hits = 0
+
+    def get(self, key):
+        """
+        Return the cached result for the key or None
+        """
+        result = self.results.get(key, None)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.results.move_to_end(key)
+        return result
+
+    def put(self, key, result):
+        """
+        Store a result, evicting the least recently used results beyond the cache size
+        """
+        self.results[key] = result
+        self.results.move_to_end(key)
+        while len(self.results) > self.size:
+            self.results.popitem(last=False)
+            self.evictions += 1
+
+    def add_pending(self, key, batch, row):
+        """
+        Record a result which is still being simulated by a batch launched ahead of time
+        """
+        self.pending[key] = (batch, row)
+        self.prefetched += 1
+
+    def pop_pending(self, key):
+        """
+        Return the batch and row of a pending result for the key and stop tracking it, or None
+        """
+        pending = self.pending.pop(key, None)
+        if pending is not None:
+            self.prefetch_hits += 1
+        return pending
+
+    def clear_pending(self, cancel=None):
+        """
+        Forget the pending results which were never asked for
+        The handles of each batch are passed to cancel so the chunks not yet launched can be dropped, the rest are left to finish on their own
+        """
+        batches = {}
+        for batch, row in self.pending.values():
+            batches[id(batch)] = batch
+        self.pending = {}
+        if cancel:
+            for batch in batches.values():
+                cancel([handle for rows, handle in batch.handles])
+
+    def hit_rate(self):
+        """
+        Percentage of lookups which were found in the cache
+        """
+        lookups = self.hits + self.misses
+        return round(self.hits * 100.0 / lookups, 1) if lookups else 0.0
+
+
+class PredictionCacheHandle:
+    """
+    Wraps a thread handle so the result is stored in the cache once it is collected
+    """
+
+    def __init__(self, handle, cache, key):
+        self.handle = handle
+        self.cache = cache
+        self.key = key
+
+    def get(self):
+        """
+        Return the result
+        """
+        result = self.handle.get()
+        if result is not None:
+            self.cache.put(self.key, result)
+        return result
+
+    def ready(self):
+        return self.handle.ready()
+
+
+class PredictionBatchHandle:
+    """
+    Collects the results of a batch of predictions which was split between the cache and a number of thread handles
+    """
+
+    def __init__(self, results, keys, cache, handles):
+        self.results = results
+        self.keys = keys
+        self.cache = cache
+        self.handles = handles
+
+    def get(self):
+        """
+        Return the results in the order the batch was submitted
+        """
+        for rows, handle in self.handles:
+            for row, result in zip(rows, handle.get()):
+                self.results[row] = result
+                # Pruned scenarios depend on the bound they were given so are not cached
+                if result is not None:
+                    self.cache.put(self.keys[row], result)
+        self.handles = []
+        return self.results
+
+    def ready(self):
+        """
+        True once all the results are known
+        """
+        return all(handle.ready() for rows, handle in self.handles)
+
+
+class PredictionPendingHandle:
+    """
+    Takes the results for some rows of a batch which was launched before it was needed
+    """
+
+    def __init__(self, batch, batch_rows):
+        self.batch = batch
+        self.batch_rows = batch_rows
+
+    def get(self):
+        """
+        Return the results of the rows in the order they were asked for
+        """
+        results = self.batch.get()
+        return [results[row] for row in self.batch_rows]
+
+    def ready(self):
+        return self.batch.ready()
+
+
+class PredictionShared:
+    """
+    Publishes the prediction data for each plan into shared memory so a persistent pool of worker processes can attach to it
+    """
+
+    def __init__(self):
+        self.generation = 0
+        self.control = shared_memory.SharedMemory(create=True, size=SHARED_CONTROL_SIZE)
+        struct.pack_into(SHARED_CONTROL_FORMAT, self.control.buf, 0, 0, 0)
+        self.block = None
+
+    def control_name(self):
+        """
+        Name of the control block which is passed to the workers when the pool is created
+        """
+        return self.control.name
+
+    def publish(self, pred):
+        """
+        Publish the data for a new Prediction into a new shared memory block and bump the generation counter
+
+        The block holds a pickled header of the settings followed by the step arrays, the per-minute inputs aren't needed by the workers
+        """
+        pred_dict = {key: value for key, value in pred.__dict__.items() if (key not in SHARED_ARRAYS) and (key not in SHARED_INPUTS) and (key not in SHARED_EXCLUDE)}
+
+        # Lay out the step arrays as float64 after the pickled data, offsets are relative to the 8 byte aligned start of the arrays
+        layout = {}
+        offset = 0
+        for array_name in SHARED_ARRAYS:
+            array_len = len(pred.__dict__[array_name])
+            layout[array_name] = (offset, array_len)
+            offset += array_len * 8
+        pred_dict["shared_layout"] = layout
+        data = pickle.dumps(pred_dict)
+        base = struct.calcsize(SHARED_DATA_FORMAT) + int((len(data) + 7) / 8) * 8
+
+        block = shared_memory.SharedMemory(create=True, size=base + offset + 8)
+        struct.pack_into(SHARED_DATA_FORMAT, block.buf, 0, len(data), base)
+        block.buf[struct.calcsize(SHARED_DATA_FORMAT) : struct.calcsize(SHARED_DATA_FORMAT) + len(data)] = data
+        for array_name in SHARED_ARRAYS:
+            array_offset, array_len = layout[array_name]
+            if array_len:
+                struct.pack_into("<{}d".format(array_len), block.buf, base + array_offset, *pred.__dict__[array_name])
+
+        # Switch the workers over to the new block and drop the old one, workers still attached keep their mapping until they move on
+        name = block.name.encode("utf-8")
+        self.generation += 1
+        offset = struct.calcsize(SHARED_CONTROL_FORMAT)
+        self.control.buf[offset : offset + len(name)] = name
+        struct.pack_into(SHARED_CONTROL_FORMAT, self.control.buf, 0, self.generation, len(name))
+        self.release_block()
+        self.block = block
+
+    def release_block(self):
+        """
+        Unlink the current data block
+        """
+        if self.block:
+            self.block.close()
+            self.block.unlink()
+            self.block = None
+
+    def close(self):
+        """
+        Release all the shared memory
+        """
+        self.release_block()
+        if self.control:
+            self.control.close()
+            self.control.unlink()
+            self.control = None
+
+
+def wrapped_run_prediction_single(charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record, step):
+    pred = get_prediction_worker()
+    return pred.thread_run_prediction_single(charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record, step)
+
+
+def run_prediction_chunk(pred, name, args_list):
+    """
+    Run a chunk of calls to the named Prediction method, returns the results in order
+    """
+    method = getattr(pred, name)
+    return [method(*args) for args in args_list]
+
+
+def wrapped_run_prediction_chunk(name, args_list):
+    pred = get_prediction_worker()
+    return run_prediction_chunk(pred, name, args_list)
 
 
 def get_diff(battery_draw, pv_dc, pv_ac, load_yesterday, inverter_loss, debug=False):
@@ -82,6 +452,67 @@ def get_total_inverted(battery_draw, pv_dc, pv_ac, inverter_loss, inverter_hybri
     return total_inverted
 
 
+class PredictionCheckpoint:
+    """
+    Simulation state saved by run_prediction_array() at a window boundary, a simulation which is identical up to that minute can resume from it
+    The predicted soc and export are shared with the rest of the run, only the part before the checkpoint is used on resume
+    """
+
+    __slots__ = (
+        "minute",
+        "minute_left",
+        "soc",
+        "soc_min",
+        "soc_min_minute",
+        "charge_has_run",
+        "charge_has_started",
+        "discharge_has_run",
+        "export_kwh",
+        "import_kwh",
+        "load_kwh",
+        "pv_kwh",
+        "iboost_today_kwh",
+        "import_kwh_house",
+        "import_kwh_battery",
+        "carbon_g",
+        "battery_cycle",
+        "metric_keep",
+        "four_hour_rule",
+        "final_export_kwh",
+        "final_import_kwh",
+        "final_load_kwh",
+        "final_pv_kwh",
+        "final_iboost_kwh",
+        "final_import_kwh_house",
+        "final_import_kwh_battery",
+        "final_battery_cycle",
+        "final_metric_keep",
+        "final_carbon_g",
+        "metric",
+        "final_soc",
+        "first_charge_soc",
+        "final_metric",
+        "car_soc",
+        "final_car_soc",
+        "charge_rate_now",
+        "discharge_rate_now",
+        "first_charge",
+        "export_to_first_charge",
+        "record",
+        "iboost_running",
+        "iboost_running_solar",
+        "iboost_running_full",
+        "iboost_next",
+        "car_charging_soc_next",
+        "predict_soc",
+        "predict_export",
+    )
+
+    def __init__(self, **state):
+        for name in self.__slots__:
+            setattr(self, name, state[name])
+
+
 class Prediction:
     """
     Class to hold prediction input and output data and the run function
@@ -127,6 +558,9 @@ class Prediction:
             self.iboost_on_discharge = base.iboost_on_discharge
             self.iboost_prevent_discharge = base.iboost_prevent_discharge
             self.carbon_enable = base.carbon_enable
+            self.carbon_metric = base.carbon_metric
+            self.metric_battery_cycle = base.metric_battery_cycle
+            self.metric_self_sufficiency = base.metric_self_sufficiency
             self.iboost_next = base.iboost_next
             self.iboost_max_energy = base.iboost_max_energy
             self.iboost_max_power = base.iboost_max_power
@@ -154,6 +588,7 @@ class Prediction:
             self.battery_discharge_power_curve = base.battery_discharge_power_curve
             self.battery_rate_max_scaling = base.battery_rate_max_scaling
             self.battery_rate_max_scaling_discharge = base.battery_rate_max_scaling_discharge
+            compile_rate_curve_tables(self)
             self.battery_loss = base.battery_loss
             self.battery_loss_discharge = base.battery_loss_discharge
             self.best_soc_keep = base.best_soc_keep
@@ -170,21 +605,244 @@ class Prediction:
             self.iboost_running_solar = False
             self.iboost_running_full = False
 
+            # Compile the forecast and rate data into dense arrays for the array engine
+            self.build_step_arrays()
+            self.checkpoint_cache = {}
+            self.prune_cache = {}
+
             # Store this dictionary in global so we can reconstruct it in the thread without passing the data
             PRED_GLOBAL["dict"] = self.__dict__.copy()
 
+            # Results are only valid for these inputs so the cache is created along with them
+            self.result_cache = PredictionCache()
+
+    def build_step_arrays(self):
+        """
+        Compile the per-minute forecast, rate and carbon dictionaries into dense lists indexed by step (minute / PREDICT_STEP)
+        """
+        # Extra hour of padding so coarse steps can total up beyond the end of the forecast
+        steps = int((self.forecast_minutes + 60) / PREDICT_STEP)
+        minutes = [step_n * PREDICT_STEP for step_n in range(steps)]
+        minutes_absolute = [minute + self.minutes_now for minute in minutes]
+
+        self.pv_forecast_array = [self.pv_forecast_minute_step.get(minute, 0) for minute in minutes]
+        self.pv_forecast10_array = [self.pv_forecast_minute10_step.get(minute, 0) for minute in minutes]
+        self.load_array = [self.load_minutes_step.get(minute, 0) for minute in minutes]
+        self.load10_array = [self.load_minutes_step10.get(minute, 0) for minute in minutes]
+        self.rate_import_array = [self.rate_import.get(minute, 0) for minute in minutes_absolute]
+        self.rate_export_array = [self.rate_export.get(minute, 0) for minute in minutes_absolute]
+        self.carbon_array = [self.carbon_intensity.get(minute, 0) for minute in minutes]
+        if self.rate_gas:
+            self.rate_gas_array = [self.rate_gas.get(minute, 99) * self.iboost_gas_scale for minute in minutes_absolute]
+        else:
+            self.rate_gas_array = []
+
+        # Car and iBoost slots don't change between scenarios so the load in each step is worked out once
+        self.car_load_array = [self.in_car_slot(minute) for minute in minutes_absolute]
+        if self.iboost_plan:
+            self.iboost_load_array = [self.in_iboost_slot(minute) for minute in minutes_absolute]
+        else:
+            self.iboost_load_array = [0 for minute in minutes_absolute]
+
+        # Bounds used to prune scenarios, the value of each kWh exported (including carbon) and the cost of each kWh imported
+        carbon_scale = self.carbon_metric / 1000.0 if self.carbon_enable else 0
+        self.export_value_array = [max(rate + carbon * carbon_scale, 0) for rate, carbon in zip(self.rate_export_array, self.carbon_array)]
+        self.import_value_array = [rate + carbon * carbon_scale for rate, carbon in zip(self.rate_import_array, self.carbon_array)]
+
+        # The bound is only valid when nothing in the metric can go down other than through export or the battery value at the end
+        # and the battery and inverter can't create energy
+        self.prune_enable = (
+            not self.iboost_enable
+            and self.battery_loss <= 1.0
+            and self.battery_loss_discharge <= 1.0
+            and self.inverter_loss <= 1.0
+            and min(self.rate_import_array, default=0) >= 0
+            and min(self.carbon_array, default=0) >= 0
+            and self.metric_battery_cycle >= 0
+            and self.metric_self_sufficiency >= 0
+            and carbon_scale >= 0
+        )
+
+    def prune_arrays(self, end_value, end_record):
+        """
+        Returns lists indexed by step used to bound the best possible outcome of a scenario from that step until end_record
+
+        rate - the most each kWh in the battery can be worth, exported at the best future rate or kept at end_value per kWh
+        gain - the most the remaining PV and any grid energy bought to be sold on later can be worth at the battery charge rate
+        full/empty - the most a kWh of battery capacity that starts full or empty can be worth when charge rates are ignored
+        pv_gain - the most the remaining PV can be worth
+        """
+        key = (end_value, end_record)
+        arrays = self.prune_cache.get(key, None)
+        if arrays:
+            return arrays
+
+        # Largest rate the battery can charge at
+        charge_max = max(max(self.battery_charge_rate_table), self.battery_rate_min) * PREDICT_STEP
+
+        # Nothing after end_record counts, allowing for the largest step size
+        steps = len(self.export_value_array)
+        end_index = min(int((end_record + 30) / PREDICT_STEP) + 1, steps)
+
+        rate_array = [end_value] * (steps + 1)
+        gain_array = [0] * (steps + 1)
+        full_array = [end_value] * (steps + 1)
+        empty_array = [0] * (steps + 1)
+        pv_gain_array = [0] * (steps + 1)
+        best_rate = end_value
+        for step_n in range(end_index - 1, -1, -1):
+            export_value = self.export_value_array[step_n]
+            import_value = self.import_value_array[step_n]
+            best_rate = max(best_rate, export_value)
+            rate_array[step_n] = best_rate
+            pv_gain = max(self.pv_forecast_array[step_n], self.pv_forecast10_array[step_n]) * best_rate
+            grid_gain = max(best_rate - import_value, 0) * charge_max
+            gain_array[step_n] = gain_array[step_n + 1] + pv_gain + grid_gain
+            pv_gain_array[step_n] = pv_gain_array[step_n + 1] + pv_gain
+            full_array[step_n] = max(full_array[step_n + 1], export_value + empty_array[step_n + 1])
+            empty_array[step_n] = max(empty_array[step_n + 1], full_array[step_n + 1] - import_value)
+
+        arrays = (rate_array, gain_array, full_array, empty_array, pv_gain_array)
+        self.prune_cache[key] = arrays
+        return arrays
+
+    def find_charge_window_array(self, charge_windows, steps):
+        """
+        Takes in an array of charge windows
+        Returns a list indexed by step which contains the window number for each step that is in a window or -1 otherwise
+        """
+        window_array = [-1] * steps
+        for window_n in range(len(charge_windows)):
+            offset = charge_windows[window_n]["start"] - self.minutes_now
+            # Windows which are not aligned to the steps are never hit, the same as find_charge_window_optimised()
+            if offset % PREDICT_STEP:
+                continue
+            start_index = max(int(offset / PREDICT_STEP), 0)
+            end_index = min(int((charge_windows[window_n]["end"] - self.minutes_now + PREDICT_STEP - 1) / PREDICT_STEP), steps)
+            for step_n in range(start_index, end_index):
+                window_array[step_n] = window_n
+        return window_array
+
     def thread_run_prediction_single(self, charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record, step):
         """
         Run single prediction in a thread
         """
-        cost, import_kwh_battery, import_kwh_house, export_kwh, soc_min, soc, soc_min_minute, battery_cycle, metric_keep, final_iboost, final_carbon_g = self.run_prediction(
-            charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record=end_record, step=step
+        cost, import_kwh_battery, import_kwh_house, export_kwh, soc_min, soc, soc_min_minute, battery_cycle, metric_keep, final_iboost, final_carbon_g = self.run_prediction_array(
+            charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record=end_record, step=step, lean=True
         )
         return (cost, import_kwh_battery, import_kwh_house, export_kwh, soc_min, soc, soc_min_minute, battery_cycle, metric_keep, final_iboost, final_carbon_g)
 
-    def thread_run_prediction_charge(self, try_soc, window_n, charge_limit, charge_window, discharge_window, discharge_limits, pv10, all_n, end_record):
+    def run_prediction_rows(self, limits_matrix, charge_window, discharge_window, discharge_matrix, pv10, end_record, step=PREDICT_STEP, prune=None):
+        """
+        Run a chunk of prediction scenarios which share the same windows but differ in charge and discharge limits
+
+        Each row is simulated in turn with run_prediction_array(), a chunk is dispatched to a worker as one call so the
+        windows are only sent once and the cost of the dispatch is shared between the rows
+        limits_matrix and discharge_matrix hold one row of charge limits and discharge limits per scenario
+        Returns a list with the results of run_prediction for each scenario in the same order, None for those which were pruned
+        """
+        results = []
+        for charge_limit, discharge_limits in zip(limits_matrix, discharge_matrix):
+            results.append(
+                self.run_prediction_array(charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record=end_record, step=step, lean=True, prune=prune)
+            )
+        return results
+
+    def prepare_plan(self, charge_limit, charge_window, discharge_window, discharge_limits):
+        """
+        Remove intersecting windows and find the charge and discharge window for each step
+
+        Returns the charge limits and charge windows left and the window arrays, the pv and pv10 scenarios of a plan share these
+        """
+        charge_limit, charge_window = remove_intersecting_windows(charge_limit, charge_window, discharge_limits, discharge_window)
+        steps = len(self.pv_forecast_array)
+        return charge_limit, charge_window, self.find_charge_window_array(charge_window, steps), self.find_charge_window_array(discharge_window, steps)
+
+    def plan_step_signature(self, charge_limit, charge_window, discharge_window, discharge_limits, plan=None):
+        """
+        Returns a list indexed by step of the charge limit and discharge limit which apply to that step and whether any
+        charge windows remain once the discharge windows have been removed, two plans with the same signature up to a step
+        simulate identically up to that step
+        """
+        if plan is None:
+            plan = self.prepare_plan(charge_limit, charge_window, discharge_window, discharge_limits)
+        charge_limit, charge_window, charge_window_array, discharge_window_array = plan
+        signature = []
+        for charge_window_n, discharge_window_n in zip(charge_window_array, discharge_window_array):
+            signature.append((charge_limit[charge_window_n] if charge_window_n >= 0 else 0, discharge_limits[discharge_window_n] if discharge_window_n >= 0 else None))
+        return bool(charge_window), signature
+
+    def run_prediction_incremental(
+        self,
+        base_charge_limit,
+        base_discharge_window,
+        base_discharge_limits,
+        charge_limit,
+        charge_window,
+        discharge_window,
+        discharge_limits,
+        pv10,
+        end_record,
+        step=PREDICT_STEP,
+        lean=False,
+        plan=None,
+        prune=None,
+    ):
+        """
+        Run a prediction scenario which differs from a base plan, return the results
+
+        The base plan shares the charge windows with the scenario, the simulation of the base plan is run once and checkpointed
+        at each window boundary so that the scenario only needs to be simulated from the last checkpoint before the first step where the two differ
+        plan is the scenario prepared by prepare_plan(), it is worked out if not given
+        """
+        if plan is None:
+            plan = self.prepare_plan(charge_limit, charge_window, discharge_window, discharge_limits)
+        base_key = (
+            tuple(base_charge_limit),
+            tuple((window["start"], window["end"]) for window in charge_window),
+            tuple(base_discharge_limits),
+            tuple((window["start"], window["end"]) for window in base_discharge_window),
+            pv10,
+            end_record,
+            step,
+            lean,
+        )
+        base_run = self.checkpoint_cache.get(base_key, None)
+        if not base_run:
+            checkpoints = {}
+            self.run_prediction_array(
+                base_charge_limit, charge_window, base_discharge_window, base_discharge_limits, pv10, end_record=end_record, step=step, checkpoints=checkpoints, lean=lean
+            )
+            base_run = (self.plan_step_signature(base_charge_limit, charge_window, base_discharge_window, base_discharge_limits), checkpoints)
+            # Keep only the most recent base plans
+            while len(self.checkpoint_cache) >= PREDICT_CHECKPOINT_CACHE:
+                self.checkpoint_cache.pop(next(iter(self.checkpoint_cache)))
+            self.checkpoint_cache[base_key] = base_run
+
+        # Find the first step where the scenario differs from the base plan
+        (base_has_charge, base_signature), checkpoints = base_run
+        has_charge, signature = self.plan_step_signature(charge_limit, charge_window, discharge_window, discharge_limits, plan=plan)
+        resume = None
+        if has_charge == base_has_charge:
+            first_change = len(signature)
+            for step_n in range(len(signature)):
+                if signature[step_n] != base_signature[step_n]:
+                    first_change = step_n
+                    break
+            first_change_minute = first_change * PREDICT_STEP
+            for minute in checkpoints:
+                if minute <= first_change_minute:
+                    resume = checkpoints[minute]
+        return self.run_prediction_array(
+            charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record=end_record, step=step, resume=resume, lean=lean, plan=plan, prune=prune
+        )
+
+    def thread_run_prediction_charge(self, try_soc, window_n, charge_limit, charge_window, discharge_window, discharge_limits, all_n, end_record, step=PREDICT_STEP, prune=None):
         """
         Run prediction in a thread
+
+        Both the pv and pv10 scenarios are simulated, returns a tuple of the results for each
+        The metric with pv10 can't be lower than with pv, so if the pv scenario is pruned both results are None
         """
 
         try_charge_limit = charge_limit.copy()
@@ -194,40 +852,50 @@ class Prediction:
         else:
             try_charge_limit[window_n] = try_soc
 
-        cost, import_kwh_battery, import_kwh_house, export_kwh, soc_min, soc, soc_min_minute, battery_cycle, metric_keep, final_iboost, final_carbon_g = self.run_prediction(
-            try_charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record=end_record
-        )
-        min_soc = 0
-        max_soc = self.soc_max
-        if not all_n:
-            window = charge_window[window_n]
-            predict_minute_start = max(int((window["start"] - self.minutes_now) / 5) * 5, 0)
-            predict_minute_end = int((window["end"] - self.minutes_now) / 5) * 5
-            if (predict_minute_start in self.predict_soc) and (predict_minute_end in self.predict_soc):
-                min_soc = min(self.predict_soc[predict_minute_start], self.predict_soc[predict_minute_end])
-            if (predict_minute_start in self.predict_soc) and (predict_minute_end in self.predict_soc):
-                max_soc = max(self.predict_soc[predict_minute_start], self.predict_soc[predict_minute_end])
-
-        return (
-            cost,
-            import_kwh_battery,
-            import_kwh_house,
-            export_kwh,
-            soc_min,
-            soc,
-            soc_min_minute,
-            battery_cycle,
-            metric_keep,
-            final_iboost,
-            final_carbon_g,
-            min_soc,
-            max_soc,
-        )
-
-    def thread_run_prediction_discharge(self, this_discharge_limit, start, window_n, charge_limit, charge_window, discharge_window, discharge_limits, pv10, all_n, end_record):
+        plan = self.prepare_plan(try_charge_limit, charge_window, discharge_window, discharge_limits)
+        results = []
+        for pv10 in [False, True]:
+            result = self.run_prediction_incremental(
+                charge_limit,
+                discharge_window,
+                discharge_limits,
+                try_charge_limit,
+                charge_window,
+                discharge_window,
+                discharge_limits,
+                pv10,
+                end_record=end_record,
+                step=step,
+                plan=plan,
+                prune=None if pv10 else prune,
+            )
+            if result is None:
+                return (None, None)
+            min_soc = 0
+            max_soc = self.soc_max
+            if not all_n:
+                window = charge_window[window_n]
+                predict_minute_start = max(int((window["start"] - self.minutes_now) / 5) * 5, 0)
+                predict_minute_end = int((window["end"] - self.minutes_now) / 5) * 5
+                if (predict_minute_start in self.predict_soc) and (predict_minute_end in self.predict_soc):
+                    min_soc = min(self.predict_soc[predict_minute_start], self.predict_soc[predict_minute_end])
+                    max_soc = max(self.predict_soc[predict_minute_start], self.predict_soc[predict_minute_end])
+            results.append(result + (min_soc, max_soc))
+        return tuple(results)
+
+    def thread_run_prediction_discharge(
+        self, this_discharge_limit, start, window_n, charge_limit, charge_window, discharge_window, discharge_limits, all_n, end_record, prune=None
+    ):
         """
         Run prediction in a thread
+
+        Both the pv and pv10 scenarios are simulated, returns a tuple of the results for each
+        The metric with pv10 can't be lower than with pv, so if the pv scenario is pruned both results are None
         """
+        # Keep the plan as passed in as the base for incremental simulation
+        base_discharge_window = [window.copy() for window in discharge_window]
+        base_discharge_limits = discharge_limits.copy()
+
         # Store try value into the window
         if all_n:
             for window_id in all_n:
@@ -239,10 +907,27 @@ class Prediction:
             start = min(start, window["end"] - 5)
             discharge_window[window_n]["start"] = start
 
-        metricmid, import_kwh_battery, import_kwh_house, export_kwh, soc_min, soc, soc_min_minute, battery_cycle, metric_keep, final_iboost, final_carbon_g = self.run_prediction(
-            charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record=end_record
-        )
-        return metricmid, import_kwh_battery, import_kwh_house, export_kwh, soc_min, soc, soc_min_minute, battery_cycle, metric_keep, final_iboost, final_carbon_g
+        plan = self.prepare_plan(charge_limit, charge_window, discharge_window, discharge_limits)
+        results = []
+        for pv10 in [False, True]:
+            result = self.run_prediction_incremental(
+                charge_limit,
+                base_discharge_window,
+                base_discharge_limits,
+                charge_limit,
+                charge_window,
+                discharge_window,
+                discharge_limits,
+                pv10,
+                end_record=end_record,
+                lean=True,
+                plan=plan,
+                prune=None if pv10 else prune,
+            )
+            if result is None:
+                return (None, None)
+            results.append(result)
+        return tuple(results)
 
     def find_charge_window_optimised(self, charge_windows):
         """
@@ -299,39 +984,137 @@ class Prediction:
     def run_prediction(self, charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record, save=None, step=PREDICT_STEP):
         """
         Run a prediction scenario given a charge limit, return the results
+
+        The scenario is simulated by run_prediction_array() which also records the time series and final values used to show and save the plan
+        """
+        return self.run_prediction_array(charge_limit, charge_window, discharge_window, discharge_limits, pv10, end_record, step=step, save=save, series=True)
+
+    def checkpoint_metric(self, checkpoint, end_value):
+        """
+        Returns the metric of a simulation checkpoint so far, including the keep, cycle, self sufficiency and carbon terms,
+        less the battery energy valued at end_value per kWh
+        """
+        if checkpoint.record:
+            soc = checkpoint.soc
+            metric = checkpoint.metric
+            metric_keep = checkpoint.metric_keep
+            battery_cycle = checkpoint.battery_cycle
+            import_kwh_house = checkpoint.import_kwh_house
+            import_kwh_battery = checkpoint.import_kwh_battery
+            carbon_g = checkpoint.carbon_g
+        else:
+            # Past the end of the record the final values are used
+            soc = checkpoint.final_soc
+            metric = checkpoint.final_metric
+            metric_keep = checkpoint.final_metric_keep
+            battery_cycle = checkpoint.final_battery_cycle
+            import_kwh_house = checkpoint.final_import_kwh_house
+            import_kwh_battery = checkpoint.final_import_kwh_battery
+            carbon_g = checkpoint.final_carbon_g
+        carbon_scale = self.carbon_metric / 1000.0 if self.carbon_enable else 0
+        return (
+            metric
+            + metric_keep
+            + battery_cycle * self.metric_battery_cycle
+            + (import_kwh_house + import_kwh_battery) * self.metric_self_sufficiency
+            + carbon_g * carbon_scale
+            - soc * end_value
+        )
+
+    def run_prediction_array(
+        self,
+        charge_limit,
+        charge_window,
+        discharge_window,
+        discharge_limits,
+        pv10,
+        end_record,
+        step=PREDICT_STEP,
+        checkpoints=None,
+        resume=None,
+        lean=False,
+        plan=None,
+        prune=None,
+        stop=None,
+        save=None,
+        series=False,
+    ):
         """
+        Run a prediction scenario given a charge limit, return the results
+
+        Simulates the battery over the dense per-step arrays built by build_step_arrays(), used by the optimiser and by run_prediction().
 
-        # Fetch data from globals, optimised away from class to avoid passing it between threads
+        When series is True the final values and, with save set or debug enabled, the time series of the plan are recorded for run_prediction().
+        save names the plan being recorded, the standing charge is added for the final plans and the charge rate is tuned for the best plan.
+
+        When checkpoints is a dictionary the simulation state is saved into it at the start of each window boundary, keyed on minute.
+        resume is a checkpoint taken from a plan which is identical up to that minute, the simulation continues from there.
+        When stop is given along with checkpoints the simulation ends at that minute and the checkpoint taken there is returned instead.
+
+        In lean mode only the results are returned, the predicted soc and export are not recorded and the final values are not stored.
+
+        plan is the scenario prepared by prepare_plan(), it is worked out if not given.
+
+        prune is a tuple of a metric bound and the value per kWh of the battery at the end of the scenario, the simulation
+        gives up and returns None once the metric can no longer come in under the bound however the rest of the scenario goes.
+        """
+
+        # Pick the step arrays for this scenario
         if pv10:
-            pv_forecast_minute_step = self.pv_forecast_minute10_step
-            load_minutes_step = self.load_minutes_step10
+            pv_array = self.pv_forecast10_array
+            load_array = self.load10_array
         else:
-            pv_forecast_minute_step = self.pv_forecast_minute_step
-            load_minutes_step = self.load_minutes_step
-        rate_import = self.rate_import
-        rate_export = self.rate_export
+            pv_array = self.pv_forecast_array
+            load_array = self.load_array
+        rate_import_array = self.rate_import_array
+        rate_export_array = self.rate_export_array
+        rate_gas_array = self.rate_gas_array
+        carbon_array = self.carbon_array
+        array_len = len(pv_array)
+        step_count = int(step / PREDICT_STEP)
+
+        # Bounds on the best possible outcome from each step, used for pruning
+        prune_rate_array = None
+        if prune and self.prune_enable:
+            prune_metric, prune_end_value = prune
+            prune_rate_array, prune_gain_array, prune_full_array, prune_empty_array, prune_pv_gain_array = self.prune_arrays(prune_end_value, end_record)
+            carbon_scale = self.carbon_metric / 1000.0 if self.carbon_enable else 0
 
         # Data structures creating during the prediction
         self.predict_soc = {}
-        self.predict_soc_best = {}
-        self.predict_metric_best = {}
-        self.predict_iboost_best = {}
-        self.predict_carbon_best = {}
         self.iboost_running = False
         self.iboost_running_solar = False
         self.iboost_running_full = False
 
+        # Time series recorded for the plan
+        record_series = series and (self.debug_enable or save)
+        record_best = save in ["best", "test"]
+        standing_charge = save in ["best", "base", "base10", "best10", "test"]
+        tune_charge_rate = save in ["best", "best10", "test"]
+        if series:
+            self.predict_soc_best = {}
+            self.predict_metric_best = {}
+            self.predict_iboost_best = {}
+            self.predict_carbon_best = {}
+            predict_battery_power = {}
+            predict_battery_cycle = {}
+            predict_soc_time = {}
+            predict_car_soc_time = [{} for car_n in range(self.num_cars)]
+            predict_pv_power = {}
+            predict_state = {}
+            predict_grid_power = {}
+            predict_load_power = {}
+            predict_iboost = {}
+            predict_carbon_g = {}
+            metric_time = {}
+            load_kwh_time = {}
+            pv_kwh_time = {}
+            export_kwh_time = {}
+            import_kwh_time = {}
+            record_time = {}
+        battery_state = "-"
+
         predict_export = {}
-        predict_battery_power = {}
-        predict_battery_cycle = {}
-        predict_soc_time = {}
-        predict_car_soc_time = [{} for car_n in range(self.num_cars)]
-        predict_pv_power = {}
-        predict_state = {}
-        predict_grid_power = {}
-        predict_load_power = {}
-        predict_iboost = {}
-        predict_carbon_g = {}
         minute = 0
         minute_left = self.forecast_minutes
         soc = self.soc_kw
@@ -341,13 +1124,9 @@ class Prediction:
         charge_has_started = False
         discharge_has_run = False
         export_kwh = self.export_today_now
-        export_kwh_h0 = export_kwh
         import_kwh = self.import_today_now
-        import_kwh_h0 = import_kwh
         load_kwh = self.load_minutes_now
-        load_kwh_h0 = load_kwh
         pv_kwh = self.pv_today_now
-        pv_kwh_h0 = pv_kwh
         iboost_today_kwh = self.iboost_today
         import_kwh_house = 0
         import_kwh_battery = 0
@@ -370,30 +1149,79 @@ class Prediction:
         first_charge_soc = soc
         prev_soc = soc
         final_metric = metric
-        metric_time = {}
-        load_kwh_time = {}
-        pv_kwh_time = {}
-        export_kwh_time = {}
-        import_kwh_time = {}
-        record_time = {}
         car_soc = self.car_charging_soc[:]
         final_car_soc = car_soc[:]
         charge_rate_now = self.charge_rate_now
         discharge_rate_now = self.discharge_rate_now
-        battery_state = "-"
-        grid_state = "-"
         first_charge = end_record
         export_to_first_charge = 0
+        export_kwh_h0 = export_kwh
+        import_kwh_h0 = import_kwh
+        load_kwh_h0 = load_kwh
+        pv_kwh_h0 = pv_kwh
 
         # Remove intersecting windows and optimise the data format of the charge/discharge window
-        charge_limit, charge_window = remove_intersecting_windows(charge_limit, charge_window, discharge_limits, discharge_window)
-        charge_window_optimised = self.find_charge_window_optimised(charge_window)
-        discharge_window_optimised = self.find_charge_window_optimised(discharge_window)
+        if plan is None:
+            plan = self.prepare_plan(charge_limit, charge_window, discharge_window, discharge_limits)
+        charge_limit, charge_window, charge_window_array, discharge_window_array = plan
 
         # For the SOC calculation we need to stop 24 hours after the first charging window starts
         # to avoid wrapping into the next day
         record = True
 
+        # Carry on from a checkpoint
+        if resume:
+            minute = resume.minute
+            minute_left = resume.minute_left
+            soc = resume.soc
+            soc_min = resume.soc_min
+            soc_min_minute = resume.soc_min_minute
+            charge_has_run = resume.charge_has_run
+            charge_has_started = resume.charge_has_started
+            discharge_has_run = resume.discharge_has_run
+            export_kwh = resume.export_kwh
+            import_kwh = resume.import_kwh
+            load_kwh = resume.load_kwh
+            pv_kwh = resume.pv_kwh
+            iboost_today_kwh = resume.iboost_today_kwh
+            import_kwh_house = resume.import_kwh_house
+            import_kwh_battery = resume.import_kwh_battery
+            carbon_g = resume.carbon_g
+            battery_cycle = resume.battery_cycle
+            metric_keep = resume.metric_keep
+            four_hour_rule = resume.four_hour_rule
+            final_export_kwh = resume.final_export_kwh
+            final_import_kwh = resume.final_import_kwh
+            final_load_kwh = resume.final_load_kwh
+            final_pv_kwh = resume.final_pv_kwh
+            final_iboost_kwh = resume.final_iboost_kwh
+            final_import_kwh_house = resume.final_import_kwh_house
+            final_import_kwh_battery = resume.final_import_kwh_battery
+            final_battery_cycle = resume.final_battery_cycle
+            final_metric_keep = resume.final_metric_keep
+            final_carbon_g = resume.final_carbon_g
+            metric = resume.metric
+            final_soc = resume.final_soc
+            first_charge_soc = resume.first_charge_soc
+            final_metric = resume.final_metric
+            car_soc = resume.car_soc
+            final_car_soc = resume.final_car_soc
+            charge_rate_now = resume.charge_rate_now
+            discharge_rate_now = resume.discharge_rate_now
+            first_charge = resume.first_charge
+            export_to_first_charge = resume.export_to_first_charge
+            record = resume.record
+            self.iboost_running = resume.iboost_running
+            self.iboost_running_solar = resume.iboost_running_solar
+            self.iboost_running_full = resume.iboost_running_full
+            self.iboost_next = resume.iboost_next
+            car_soc = car_soc[:]
+            final_car_soc = final_car_soc[:]
+            self.car_charging_soc_next = resume.car_charging_soc_next[:]
+            if not lean:
+                self.predict_soc = {key: value for key, value in resume.predict_soc.items() if key < minute}
+                predict_export = {key: value for key, value in resume.predict_export.items() if key < minute}
+
         # Battery behaviour
         if self.inverter_hybrid:
             inverter_loss_ac = self.inverter_loss
@@ -401,14 +1229,88 @@ class Prediction:
             inverter_loss_ac = 1.0
         inverter_loss = self.inverter_loss
         inverter_hybrid = self.inverter_hybrid
+        checkpoint_window = None
 
         # Simulate each forward minute
         while minute < self.forecast_minutes:
             # Minute yesterday can wrap if days_previous is only 1
             minute_absolute = minute + self.minutes_now
+            minute_index = int(minute / PREDICT_STEP)
             prev_soc = soc
+
+            # Save the state at each window boundary
+            if checkpoints is not None and (
+                checkpoint_window != (charge_window_array[minute_index], discharge_window_array[minute_index]) or (stop is not None and minute >= stop)
+            ):
+                checkpoint_window = (charge_window_array[minute_index], discharge_window_array[minute_index])
+                checkpoints[minute] = PredictionCheckpoint(
+                    minute=minute,
+                    minute_left=minute_left,
+                    soc=soc,
+                    soc_min=soc_min,
+                    soc_min_minute=soc_min_minute,
+                    charge_has_run=charge_has_run,
+                    charge_has_started=charge_has_started,
+                    discharge_has_run=discharge_has_run,
+                    export_kwh=export_kwh,
+                    import_kwh=import_kwh,
+                    load_kwh=load_kwh,
+                    pv_kwh=pv_kwh,
+                    iboost_today_kwh=iboost_today_kwh,
+                    import_kwh_house=import_kwh_house,
+                    import_kwh_battery=import_kwh_battery,
+                    carbon_g=carbon_g,
+                    battery_cycle=battery_cycle,
+                    metric_keep=metric_keep,
+                    four_hour_rule=four_hour_rule,
+                    final_export_kwh=final_export_kwh,
+                    final_import_kwh=final_import_kwh,
+                    final_load_kwh=final_load_kwh,
+                    final_pv_kwh=final_pv_kwh,
+                    final_iboost_kwh=final_iboost_kwh,
+                    final_import_kwh_house=final_import_kwh_house,
+                    final_import_kwh_battery=final_import_kwh_battery,
+                    final_battery_cycle=final_battery_cycle,
+                    final_metric_keep=final_metric_keep,
+                    final_carbon_g=final_carbon_g,
+                    metric=metric,
+                    final_soc=final_soc,
+                    first_charge_soc=first_charge_soc,
+                    final_metric=final_metric,
+                    car_soc=car_soc[:],
+                    final_car_soc=final_car_soc[:],
+                    charge_rate_now=charge_rate_now,
+                    discharge_rate_now=discharge_rate_now,
+                    first_charge=first_charge,
+                    export_to_first_charge=export_to_first_charge,
+                    record=record,
+                    iboost_running=self.iboost_running,
+                    iboost_running_solar=self.iboost_running_solar,
+                    iboost_running_full=self.iboost_running_full,
+                    iboost_next=self.iboost_next,
+                    car_charging_soc_next=self.car_charging_soc_next[:],
+                    predict_soc=self.predict_soc,
+                    predict_export=predict_export,
+                )
+                if stop is not None and minute >= stop:
+                    return checkpoints[minute]
             reserve_expected = self.reserve
 
+            # Give up once the metric so far less the most the rest of the scenario could be worth can't beat the bound
+            if prune_rate_array and record and (minute_index % PREDICT_PRUNE_INTERVAL == 0):
+                gain_rate = soc * prune_rate_array[minute_index] + prune_gain_array[minute_index]
+                gain_capacity = soc * prune_full_array[minute_index] + max(self.soc_max - soc, 0) * prune_empty_array[minute_index] + prune_pv_gain_array[minute_index]
+                metric_lower = (
+                    metric
+                    + metric_keep
+                    + battery_cycle * self.metric_battery_cycle
+                    + (import_kwh_house + import_kwh_battery) * self.metric_self_sufficiency
+                    + carbon_g * carbon_scale
+                    - min(gain_rate, gain_capacity)
+                )
+                if metric_lower > prune_metric:
+                    return None
+
             # Once a force discharge is set the four hour rule is disabled
             if four_hour_rule:
                 keep_minute_scaling = min((minute / (4 * 60)), 1.0) * 0.5
@@ -416,8 +1318,8 @@ class Prediction:
                 keep_minute_scaling = 0.5
 
             # Find charge & discharge windows
-            charge_window_n = charge_window_optimised.get(minute_absolute, -1)
-            discharge_window_n = discharge_window_optimised.get(minute_absolute, -1)
+            charge_window_n = charge_window_array[minute_index]
+            discharge_window_n = discharge_window_array[minute_index]
 
             # Find charge limit
             charge_limit_n = 0
@@ -440,13 +1342,9 @@ class Prediction:
                 record = False
 
             # Store data before the next simulation step to align timestamps
-            if self.debug_enable or save:
+            if record_series:
                 minute_timestamp = self.midnight_utc + timedelta(seconds=60 * minute_absolute)
                 stamp = minute_timestamp.strftime(TIME_FORMAT)
-            else:
-                stamp = ""
-
-            if self.debug_enable or save:
                 predict_soc_time[stamp] = round(soc, 3)
                 metric_time[stamp] = round(metric, 3)
                 load_kwh_time[stamp] = round(load_kwh, 3)
@@ -459,23 +1357,29 @@ class Prediction:
                 record_time[stamp] = 0 if record else self.soc_max
 
             # Save Soc prediction data as minutes for later use
-            self.predict_soc[minute] = round(soc, 3)
-            if save and (save in ["best", "test"]):
+            if not lean:
+                self.predict_soc[minute] = round(soc, 3)
+            if record_best:
                 self.predict_soc_best[minute] = round(soc, 3)
                 self.predict_metric_best[minute] = round(metric, 3)
                 self.predict_iboost_best[minute] = round(iboost_today_kwh, 2)
                 self.predict_carbon_best[minute] = round(carbon_g, 0)
 
             # Add in standing charge, only for the final plan when we save the results
-            if save and (save in ["best", "base", "base10", "best10", "test"]) and (minute_absolute % (24 * 60)) < step:
+            if standing_charge and (minute_absolute % (24 * 60)) < step:
                 metric += self.metric_standing_charge
 
             # Get load and pv forecast, total up for all values in the step
-            pv_now = 0
-            load_yesterday = 0
-            for offset in range(0, step, PREDICT_STEP):
-                pv_now += pv_forecast_minute_step.get(minute + offset, 0)
-                load_yesterday += load_minutes_step.get(minute + offset, 0)
+            if step_count == 1:
+                pv_now = pv_array[minute_index]
+                load_yesterday = load_array[minute_index]
+            else:
+                pv_now = 0
+                load_yesterday = 0
+                for offset_index in range(minute_index, minute_index + step_count):
+                    if offset_index < array_len:
+                        pv_now += pv_array[offset_index]
+                        load_yesterday += load_array[offset_index]
 
             # Count PV kWh
             pv_kwh += pv_now
@@ -483,7 +1387,7 @@ class Prediction:
                 final_pv_kwh = pv_kwh
 
             # Simulate car charging
-            car_load = self.in_car_slot(minute_absolute)
+            car_load = self.car_load_array[minute_index]
 
             # Car charging?
             car_freeze = False
@@ -506,25 +1410,21 @@ class Prediction:
             # IBoost energy rate control
             if self.iboost_enable:
                 # Boost on energy rates
-                import_rate = rate_import.get(minute_absolute, 0)
+                import_rate = rate_import_array[minute_index]
                 if import_rate > self.iboost_rate_threshold:
                     iboost_rate_okay = False
-                export_rate = rate_export.get(minute_absolute, 0)
+                export_rate = rate_export_array[minute_index]
                 if export_rate > self.iboost_rate_threshold_export:
                     iboost_rate_okay = False
 
                 # Boost on gas vs import rate
-                if self.iboost_gas and self.rate_gas:
-                    gas_rate = self.rate_gas.get(minute_absolute, 99) * self.iboost_gas_scale
-                    import_rate = rate_import.get(minute_absolute, 0)
-                    if import_rate > gas_rate:
+                if self.iboost_gas and rate_gas_array:
+                    if import_rate > rate_gas_array[minute_index]:
                         iboost_rate_okay = False
 
                 # Boost on gas vs export rate
-                if self.iboost_gas_export and self.rate_gas:
-                    gas_rate = self.rate_gas.get(minute_absolute, 99) * self.iboost_gas_scale
-                    export_rate = rate_export.get(minute_absolute, 0)
-                    if export_rate > gas_rate:
+                if self.iboost_gas_export and rate_gas_array:
+                    if export_rate > rate_gas_array[minute_index]:
                         iboost_rate_okay = False
 
             # IBoost solar diverter on load, don't do on discharge
@@ -532,7 +1432,7 @@ class Prediction:
             if self.iboost_enable:
                 # IBoost based on plan for given rates
                 if self.iboost_plan and (self.iboost_on_discharge or (discharge_window_n < 0)):
-                    iboost_load = self.in_iboost_slot(minute_absolute) * step / 60.0
+                    iboost_load = self.iboost_load_array[minute_index] * step / 60.0
                     iboost_amount = min(iboost_load, self.iboost_max_power * step, max(self.iboost_max_energy - iboost_today_kwh, 0))
 
                 # IBoost based on Predbat charging
@@ -652,7 +1552,7 @@ class Prediction:
                 four_hour_rule = False
             elif (charge_window_n >= 0) and soc < charge_limit_n:
                 # Charge enable
-                if save in ["best", "best10", "test"]:
+                if tune_charge_rate:
                     # Only tune charge rate on final plan not every simulation
                     charge_rate_now = (
                         find_charge_rate(self, minute_absolute, soc, charge_window[charge_window_n], charge_limit_n, self.battery_rate_max_charge) * self.battery_rate_max_scaling
@@ -687,12 +1587,11 @@ class Prediction:
                     pv_compare = pv_dc + pv_ac
                     if pv_dc >= (charge_limit_n - soc) and (pv_compare < (charge_rate_now_curve * step)):
                         potential_import = min((charge_rate_now_curve * step) - pv_compare, (charge_limit_n - soc))
-                        metric_keep += potential_import * rate_import.get(minute_absolute, 0)
+                        metric_keep += potential_import * rate_import_array[minute_index]
             else:
                 # ECO Mode
                 pv_ac = pv_now * inverter_loss_ac
                 pv_dc = 0
-                diff = get_diff(0, pv_dc, pv_ac, load_yesterday, inverter_loss)
 
                 required_for_load = load_yesterday / inverter_loss_ac
                 if inverter_hybrid:
@@ -819,37 +1718,30 @@ class Prediction:
                 # Weight to 50% chance of the scenario
                 keep_diff = max(get_diff(0, 0, pv_now, load_yesterday, inverter_loss), battery_draw)
                 if keep_diff > 0:
-                    metric_keep += rate_import[minute_absolute] * keep_diff * keep_minute_scaling
+                    metric_keep += rate_import_array[minute_index] * keep_diff * keep_minute_scaling
             if diff > 0:
                 # Import
                 # All imports must go to home (no inverter loss) or to the battery (inverter loss accounted before above)
                 import_kwh += diff
 
                 if self.carbon_enable:
-                    carbon_g += diff * self.carbon_intensity.get(minute, 0)
+                    carbon_g += diff * carbon_array[minute_index]
 
                 if charge_window_n >= 0:
                     # If the battery is on charge anyhow then imports are at battery charging rate
                     import_kwh_battery += diff
                 else:
-                    # self.log("importing to minute %s amount %s kW total %s kWh total draw %s" % (minute, energy, import_kwh_house, diff))
                     import_kwh_house += diff
 
-                metric += rate_import[minute_absolute] * diff
-                grid_state = "<"
+                metric += rate_import_array[minute_index] * diff
             else:
                 # Export
                 energy = -diff
                 export_kwh += energy
                 if self.carbon_enable:
-                    carbon_g -= energy * self.carbon_intensity.get(minute, 0)
+                    carbon_g -= energy * carbon_array[minute_index]
 
-                if minute_absolute in rate_export:
-                    metric -= rate_export[minute_absolute] * energy
-                if diff != 0:
-                    grid_state = ">"
-                else:
-                    grid_state = "~"
+                metric -= rate_export_array[minute_index] * energy
 
             # Store the number of minutes until the battery runs out
             if record and soc <= self.reserve:
@@ -876,10 +1768,11 @@ class Prediction:
 
                 # Store export data
                 if diff < 0:
-                    predict_export[minute] = energy
+                    if not lean:
+                        predict_export[minute] = energy
                     if minute <= first_charge:
                         export_to_first_charge += energy
-                else:
+                elif not lean:
                     predict_export[minute] = 0
 
                 # Soc at next charge start
@@ -901,11 +1794,17 @@ class Prediction:
                 soc_min = min(soc_min, soc)
 
             # Record state
-            if self.debug_enable or save:
+            if record_series:
+                if diff > 0:
+                    grid_state = "<"
+                elif diff != 0:
+                    grid_state = ">"
+                else:
+                    grid_state = "~"
                 predict_state[stamp] = "g" + grid_state + "b" + battery_state
                 predict_battery_power[stamp] = round(battery_draw * (60 / step), 3)
                 predict_battery_cycle[stamp] = round(battery_cycle, 3)
-                predict_pv_power[stamp] = round((pv_forecast_minute_step[minute] + pv_forecast_minute_step.get(minute + step, 0)) * (30 / step), 3)
+                predict_pv_power[stamp] = round((pv_array[minute_index] + (pv_array[minute_index + step_count] if minute_index + step_count < array_len else 0)) * (30 / step), 3)
                 predict_grid_power[stamp] = round(diff * (60 / step), 3)
                 predict_load_power[stamp] = round(load_yesterday * (60 / step), 3)
                 if self.carbon_enable:
@@ -913,11 +1812,23 @@ class Prediction:
 
             minute += step
 
-        hours_left = minute_left / 60.0
+        if lean:
+            return (
+                round(final_metric, 4),
+                round(import_kwh_battery, 4),
+                round(import_kwh_house, 4),
+                round(export_kwh, 4),
+                round(soc_min, 4),
+                round(final_soc, 4),
+                soc_min_minute,
+                round(final_battery_cycle, 4),
+                round(final_metric_keep, 4),
+                round(final_iboost_kwh, 4),
+                round(final_carbon_g, 4),
+            )
 
-        self.hours_left = hours_left
+        self.hours_left = minute_left / 60.0
         self.final_car_soc = final_car_soc
-        self.predict_car_soc_time = predict_car_soc_time
         self.final_soc = round(final_soc, 4)
         self.final_metric = round(final_metric, 4)
         self.final_metric_keep = round(final_metric_keep, 4)
@@ -932,30 +1843,30 @@ class Prediction:
         self.final_soc_min = round(soc_min, 4)
         self.final_soc_min_minute = soc_min_minute
         self.export_to_first_charge = export_to_first_charge
-        self.predict_soc_time = predict_soc_time
         self.first_charge = first_charge
         self.first_charge_soc = round(first_charge_soc, 4)
-        self.predict_state = predict_state
-        self.predict_battery_power = predict_battery_power
-        self.predict_battery_power = predict_battery_power
-        self.predict_pv_power = predict_pv_power
-        self.predict_grid_power = predict_grid_power
-        self.predict_load_power = predict_load_power
-        self.predict_iboost = predict_iboost
-        self.predict_carbon_g = predict_carbon_g
         self.predict_export = predict_export
-        self.metric_time = metric_time
-        self.record_time = record_time
-        self.predict_battery_cycle = predict_battery_cycle
-        self.predict_battery_power = predict_battery_power
-        self.pv_kwh_h0 = round(pv_kwh_h0, 4)
-        self.import_kwh_h0 = round(import_kwh_h0, 4)
-        self.export_kwh_h0 = round(export_kwh_h0, 4)
-        self.load_kwh_h0 = round(load_kwh_h0, 4)
-        self.load_kwh_time = load_kwh_time
-        self.pv_kwh_time = pv_kwh_time
-        self.import_kwh_time = import_kwh_time
-        self.export_kwh_time = export_kwh_time
+        if series:
+            self.predict_car_soc_time = predict_car_soc_time
+            self.predict_soc_time = predict_soc_time
+            self.predict_state = predict_state
+            self.predict_battery_power = predict_battery_power
+            self.predict_battery_cycle = predict_battery_cycle
+            self.predict_pv_power = predict_pv_power
+            self.predict_grid_power = predict_grid_power
+            self.predict_load_power = predict_load_power
+            self.predict_iboost = predict_iboost
+            self.predict_carbon_g = predict_carbon_g
+            self.metric_time = metric_time
+            self.record_time = record_time
+            self.pv_kwh_h0 = round(pv_kwh_h0, 4)
+            self.import_kwh_h0 = round(import_kwh_h0, 4)
+            self.export_kwh_h0 = round(export_kwh_h0, 4)
+            self.load_kwh_h0 = round(load_kwh_h0, 4)
+            self.load_kwh_time = load_kwh_time
+            self.pv_kwh_time = pv_kwh_time
+            self.import_kwh_time = import_kwh_time
+            self.export_kwh_time = export_kwh_time
 
         return (
             round(final_metric, 4),
@@ -0,0 +1,319 @@
+# -----------------------------------------------------------------------------
+# Predbat Home Battery System
+# Copyright Trefor Southwell 2024 - All Rights Reserved
+# This application maybe used for personal use only and not for commercial use
+# -----------------------------------------------------------------------------
+# fmt off
+# pylint: disable=consider-using-f-string
+# pylint: disable=line-too-long
+# pylint: disable=attribute-defined-outside-init
+
+import threading
+from collections import deque
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from config import SCHEDULER_QUEUE_DEPTH, SCHEDULER_WAIT
+from prediction import Prediction, run_prediction_chunk, wrapped_run_prediction_chunk
+
+
+class CancelledError(Exception):
+    """
+    Raised when the result of a call which was cancelled is asked for
+    """
+
+
+class SchedulerError(Exception):
+    """
+    Raised when calls can't finish because the worker running them has gone
+    """
+
+
+class ReadyResult:
+    """
+    Handle for a result which is already known
+    """
+
+    def __init__(self, result):
+        self.result = result
+
+    def ready(self):
+        return True
+
+    def wait(self, timeout=None):
+        return
+
+    def get(self):
+        """
+        Return the result
+        """
+        return self.result
+
+
+class InlineBackend:
+    """
+    Runs each job in the calling thread as it is launched
+    """
+
+    def __init__(self, prediction):
+        self.prediction = prediction
+        self.workers = 1
+
+    def apply(self, name, args_list, callback, error_callback):
+        callback(run_prediction_chunk(self.prediction, name, args_list))
+
+    def failure(self):
+        return None
+
+
+class ProcessBackend:
+    """
+    Runs jobs on the worker processes, the workers attach to the prediction data via shared memory
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.workers = pool._processes
+        self.processes = [process for process in pool._pool if process.exitcode is None]
+
+    def apply(self, name, args_list, callback, error_callback):
+        self.pool.apply_async(wrapped_run_prediction_chunk, (name, args_list), callback=callback, error_callback=error_callback)
+
+    def failure(self):
+        """
+        Describes why the running jobs can't finish or None, the pool doesn't retry the job of a worker process which exits
+        """
+        if self.pool._state != "RUN":
+            return "The prediction worker pool has stopped"
+        for process in self.processes:
+            if process.exitcode is not None:
+                return "Prediction worker process {} exited with code {}".format(process.pid, process.exitcode)
+        return None
+
+
+class ThreadBackend:
+    """
+    Runs jobs on a pool of threads in this process, each thread simulates on its own copy of the Prediction
+    """
+
+    def __init__(self, pool, prediction):
+        self.pool = pool
+        self.workers = pool._processes
+        self.prediction = prediction
+        self.local = threading.local()
+
+    def thread_prediction(self):
+        """
+        Returns the Prediction for the calling thread, the forecast data is shared but the simulation state is not
+        """
+        pred = getattr(self.local, "prediction", None)
+        if pred is None:
+            pred = Prediction()
+            pred.__dict__ = self.prediction.__dict__.copy()
+            pred.checkpoint_cache = {}
+            pred.prune_cache = {}
+            pred.car_charging_soc_next = self.prediction.car_charging_soc_next[:]
+            self.local.prediction = pred
+        return pred
+
+    def run_chunk(self, name, args_list):
+        return run_prediction_chunk(self.thread_prediction(), name, args_list)
+
+    def apply(self, name, args_list, callback, error_callback):
+        self.pool.apply_async(self.run_chunk, (name, args_list), callback=callback, error_callback=error_callback)
+
+    def failure(self):
+        if self.pool._state != "RUN":
+            return "The prediction thread pool has stopped"
+        return None
+
+
+class SchedulerJob:
+    """
+    A chunk of calls which is run as a single job on the backend
+    """
+
+    def __init__(self, name, args_list):
+        self.name = name
+        self.args_list = args_list
+        self.results = None
+        self.cancelled = False
+
+
+class SchedulerFuture:
+    """
+    The result of one call submitted to the scheduler
+    """
+
+    def __init__(self, scheduler, job, index):
+        self.scheduler = scheduler
+        self.job = job
+        self.index = index
+
+    def ready(self):
+        """
+        True once the result is known or the call was cancelled
+        """
+        if self.job.results is None and not self.job.cancelled:
+            self.scheduler.poll()
+        return self.job.results is not None or self.job.cancelled
+
+    def cancelled(self):
+        return self.job.cancelled
+
+    def get(self):
+        """
+        Wait for and return the result, raises CancelledError if the call was cancelled
+        """
+        self.scheduler.wait_first([self])
+        if self.job.cancelled:
+            raise CancelledError("Prediction call {} was cancelled".format(self.job.name))
+        return self.job.results[self.index]
+
+
+class PredictionScheduler:
+    """
+    Runs calls to the Prediction simulation methods on a backend, either inline, a process pool or a thread pool
+
+    Calls are submitted in chunks, only enough chunks to keep each worker busy are launched and the others wait in a queue
+    so they can still be cancelled. Finished chunks are collected in the order they complete so a slow chunk doesn't hold up the launch of the rest,
+    the backend reports each chunk as it finishes so waiting doesn't need to poll the running chunks
+    """
+
+    def __init__(self, prediction, pool=None):
+        self.prediction = prediction
+        self.pool = pool
+        if pool and pool._state == "RUN":
+            if isinstance(pool, ThreadPool):
+                self.backend = ThreadBackend(pool, prediction)
+            else:
+                self.backend = ProcessBackend(pool)
+        else:
+            self.backend = InlineBackend(prediction)
+        self.workers = self.backend.workers
+        self.queue = deque()
+        self.running = []
+        self.cancelled = 0
+        self.finished = deque()
+        self.finished_event = threading.Event()
+        self.failed = None
+
+    def matches(self, prediction, pool):
+        """
+        True if this scheduler runs on the given prediction data and pool
+        """
+        running = bool(pool and pool._state == "RUN")
+        return self.prediction is prediction and self.pool is pool and running == (not isinstance(self.backend, InlineBackend)) and not self.failed
+
+    def chunk_size(self, count, chunks_per_worker=SCHEDULER_QUEUE_DEPTH):
+        """
+        The number of calls per chunk to split count calls into chunks_per_worker chunks for each worker
+        """
+        chunks = self.workers * chunks_per_worker
+        return max(int((count + chunks - 1) / chunks), 1)
+
+    def submit(self, name, args):
+        """
+        Submit a single call to the named Prediction method, returns its future
+        """
+        return self.submit_many(name, [args])[0]
+
+    def submit_many(self, name, args_list, chunk_size=1):
+        """
+        Submit calls to the named Prediction method in chunks of chunk_size calls, returns a future for each call in order
+        """
+        futures = []
+        for chunk_start in range(0, len(args_list), chunk_size):
+            job = SchedulerJob(name, args_list[chunk_start : chunk_start + chunk_size])
+            futures.extend([SchedulerFuture(self, job, index) for index in range(len(job.args_list))])
+            self.queue.append(job)
+        self.launch()
+        return futures
+
+    def launch(self):
+        """
+        Launch queued chunks until each worker has SCHEDULER_QUEUE_DEPTH chunks running
+        """
+        while self.queue and len(self.running) < self.workers * SCHEDULER_QUEUE_DEPTH:
+            job = self.queue.popleft()
+            self.running.append(job)
+            self.backend.apply(job.name, job.args_list, partial(self.job_finished, job), partial(self.job_failed, job))
+
+    def job_finished(self, job, results):
+        """
+        Called by the backend with the results of a chunk, from the thread which collects the results of the pool
+        """
+        self.finished.append((job, results, None))
+        self.finished_event.set()
+
+    def job_failed(self, job, error):
+        """
+        Called by the backend when a chunk raised an exception
+        """
+        self.finished.append((job, None, error))
+        self.finished_event.set()
+
+    def poll(self):
+        """
+        Collect the running chunks which have finished, returns True if any finished
+        An exception raised by a chunk is raised again here
+        """
+        collected = False
+        while self.finished:
+            job, results, error = self.finished.popleft()
+            self.running.remove(job)
+            if error is not None:
+                raise error
+            job.results = results
+            collected = True
+        return collected
+
+    def wait_first(self, handles):
+        """
+        Wait until at least one of the handles is ready, returns the handles which are ready
+
+        Queued chunks are launched in place of those which finished only when waiting, so the caller can cancel them first
+        Raises SchedulerError if the handles can't become ready because the chunks they wait on have been lost
+        """
+        while True:
+            ready = [handle for handle in handles if handle.ready()]
+            if ready or not handles:
+                return ready
+            self.finished_event.clear()
+            self.launch()
+            if self.poll():
+                continue
+            if not self.running:
+                raise SchedulerError("Waiting for prediction calls which are neither running nor queued")
+            failure = self.backend.failure()
+            if failure:
+                # The chunks running on the worker are lost, a new scheduler is made for the next calls
+                self.failed = failure
+                raise SchedulerError(failure)
+            self.finished_event.wait(SCHEDULER_WAIT)
+
+    def as_completed(self, handles):
+        """
+        Yields the handles as they become ready, those which finish together are yielded in the order given
+        """
+        waiting = list(handles)
+        while waiting:
+            ready = self.wait_first(waiting)
+            for handle in ready:
+                waiting.remove(handle)
+                yield handle
+
+    def cancel(self, handles):
+        """
+        Cancel the chunks which have not been launched and only hold calls from the given futures
+        Running chunks can't be stopped so are left to finish, returns the futures which were cancelled
+        """
+        futures = set(handle for handle in handles if isinstance(handle, SchedulerFuture))
+        cancelled = []
+        for job in list(self.queue):
+            job_futures = [future for future in futures if future.job is job]
+            if len(job_futures) == len(job.args_list):
+                job.cancelled = True
+                self.queue.remove(job)
+                cancelled.extend(job_futures)
+        self.cancelled += len(cancelled)
+        return cancelled
@@ -16,12 +16,17 @@ import math
 import sys
 from datetime import datetime, timedelta
 import hashlib
+import pickle
+import struct
+import tempfile
+import threading
 import traceback
 
 import pytz
 import requests
 import yaml
 from multiprocessing import Pool, cpu_count, set_start_method
+from multiprocessing.pool import ThreadPool
 import asyncio
 import json
 import matplotlib
@@ -29,8 +34,24 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from predbat import PredBat
-from prediction import Prediction
-from prediction import wrapped_run_prediction_single
+from prediction import Prediction, PredictionCache, PredictionBatchHandle
+from ha import HAInterface
+from httpclient import HttpClient
+from scheduler import PredictionScheduler, CancelledError, SchedulerError
+from prediction import wrapped_run_prediction_single, wrapped_run_prediction_chunk, prediction_worker_init, PredictionShared, SHARED_INPUTS, SHARED_DATA_FORMAT
+from config import (
+    TIME_FORMAT_HA,
+    TIME_FORMAT,
+    TIME_FORMAT_SECONDS,
+    TIME_FORMAT_OCTOPUS,
+    PREDICT_STEP,
+    HISTORY_MAX_GAP,
+    OPTIMISE_DP_STAGE_OPTIONS,
+    SCHEDULER_QUEUE_DEPTH,
+    OPTIMISE_DISCHARGE_BEAM,
+    OPTIMISE_DISCHARGE_BEAM_STEPS,
+)
+from utils import find_charge_rate, compile_rate_curve_tables, calc_percent_limit, remove_intersecting_windows, WindowIndex, MinuteSeries, str2time, add_repeated
 
 KEEP_SCALE = 0.5
 
@@ -71,6 +92,9 @@ class TestHAInterface:
         print("Getting history for {}".format(entity_id))
         return [self.history]
 
+    def get_history_multiple(self, entity_ids, now=None, days=30):
+        return [self.get_history(entity_id, now=now, days=days) for entity_id in entity_ids]
+
 
 class TestInverter:
     def __init__(self):
@@ -475,12 +499,366 @@ def simple_scenario(
         print("ERROR: iBoost running full should be {}".format(assert_iboost_running_full))
         failed = True
 
+    # Recording the plan must not change the results of the engine
+    if save != "none":
+        for step in [5, 30]:
+            result_series = prediction.run_prediction(
+                charge_limit_best, charge_window_best, discharge_window_best, discharge_limit_best, pv10, end_record=(my_predbat.end_record), step=step
+            )
+            result_array = prediction.run_prediction_array(
+                charge_limit_best, charge_window_best, discharge_window_best, discharge_limit_best, pv10, end_record=(my_predbat.end_record), step=step
+            )
+            if result_series != result_array:
+                print("ERROR: Array engine step {} results {} differ from recorded plan {}".format(step, result_array, result_series))
+                failed = True
+            result_lean = prediction.run_prediction_array(
+                charge_limit_best, charge_window_best, discharge_window_best, discharge_limit_best, pv10, end_record=(my_predbat.end_record), step=step, lean=True
+            )
+            if result_lean != result_array:
+                print("ERROR: Lean engine step {} results {} differ from array engine {}".format(step, result_lean, result_array))
+                failed = True
+            result_rows = prediction.run_prediction_rows(
+                [charge_limit_best, charge_limit_best], charge_window_best, discharge_window_best, [discharge_limit_best, discharge_limit_best], pv10, my_predbat.end_record, step
+            )
+            if result_rows != [result_array, result_array]:
+                print("ERROR: Prediction rows step {} results {} differ from array engine {}".format(step, result_rows, result_array))
+                failed = True
+
+        # The pv and pv10 scenarios run together must match running them separately
+        if charge_limit_best:
+            results_pair = prediction.thread_run_prediction_charge(
+                charge_limit_best[0], 0, charge_limit_best, charge_window_best, discharge_window_best, discharge_limit_best, None, my_predbat.end_record
+            )
+            for pv10_n, pv10_scenario in enumerate([False, True]):
+                result_array = prediction.run_prediction_array(
+                    charge_limit_best, charge_window_best, discharge_window_best, discharge_limit_best, pv10_scenario, end_record=(my_predbat.end_record)
+                )
+                if results_pair[pv10_n][:11] != result_array:
+                    print("ERROR: Paired engine pv10 {} results {} differ from array engine {}".format(pv10_scenario, results_pair[pv10_n][:11], result_array))
+                    failed = True
+
+            # Pruning against the plan's own metric must not change the result, against a metric that can't be reached it must give up
+            prune = my_predbat.prune_bound(my_predbat.end_record, my_predbat.compute_metric_result(my_predbat.end_record, results_pair[0], results_pair[1]))
+            if prune and prediction.prune_enable:
+                result_prune = prediction.run_prediction_array(
+                    charge_limit_best, charge_window_best, discharge_window_best, discharge_limit_best, False, end_record=(my_predbat.end_record), prune=prune
+                )
+                if result_prune != results_pair[0][:11]:
+                    print("ERROR: Pruned results {} differ from array engine {}".format(result_prune, results_pair[0][:11]))
+                    failed = True
+                result_prune = prediction.run_prediction_array(
+                    charge_limit_best, charge_window_best, discharge_window_best, discharge_limit_best, False, end_record=(my_predbat.end_record), prune=(-9999999, prune[1])
+                )
+                if result_prune is not None:
+                    print("ERROR: Pruning against an unreachable metric should give up but returned {}".format(result_prune))
+                    failed = True
+
+        # Resuming from the checkpoint of a base plan must give identical results to a full simulation when a late window changes
+        late_window = {"start": my_predbat.minutes_now + my_predbat.forecast_minutes - 6 * 60, "end": my_predbat.minutes_now + my_predbat.forecast_minutes - 4 * 60, "average": 0}
+        try_charge_window = charge_window_best + [late_window]
+        for base_limit, try_limit in [[0, my_predbat.soc_max], [my_predbat.soc_max, my_predbat.reserve]]:
+            base_charge_limit = charge_limit_best + [base_limit]
+            try_charge_limit = charge_limit_best + [try_limit]
+            result_array = prediction.run_prediction_array(
+                try_charge_limit, try_charge_window, discharge_window_best, discharge_limit_best, pv10, end_record=(my_predbat.end_record)
+            )
+            predict_soc_array = prediction.predict_soc
+            result_incremental = prediction.run_prediction_incremental(
+                base_charge_limit,
+                discharge_window_best,
+                discharge_limit_best,
+                try_charge_limit,
+                try_charge_window,
+                discharge_window_best,
+                discharge_limit_best,
+                pv10,
+                my_predbat.end_record,
+            )
+            if result_incremental != result_array or prediction.predict_soc != predict_soc_array:
+                print("ERROR: Incremental engine results {} differ from array engine {}".format(result_incremental, result_array))
+                failed = True
+
+        # Stopping at a checkpoint and resuming from it must give identical results to a full simulation
+        stop = 12 * 60
+        result_array = prediction.run_prediction_array(
+            charge_limit_best, charge_window_best, discharge_window_best, discharge_limit_best, pv10, end_record=(my_predbat.end_record), lean=True
+        )
+        checkpoint = prediction.run_prediction_array(
+            charge_limit_best, charge_window_best, discharge_window_best, discharge_limit_best, pv10, end_record=(my_predbat.end_record), lean=True, checkpoints={}, stop=stop
+        )
+        result_resume = prediction.run_prediction_array(
+            charge_limit_best, charge_window_best, discharge_window_best, discharge_limit_best, pv10, end_record=(my_predbat.end_record), lean=True, resume=checkpoint
+        )
+        if checkpoint.minute != stop or result_resume != result_array:
+            print("ERROR: Resumed results {} from checkpoint at minute {} differ from array engine {}".format(result_resume, checkpoint.minute, result_array))
+            failed = True
+
     if failed:
         prediction.run_prediction(charge_limit_best, charge_window_best, discharge_window_best, discharge_limit_best, pv10, end_record=(my_predbat.end_record), save="test")
         plot(name, prediction)
     return failed
 
 
+def find_charge_rate_reference(model, minutes_now, soc, window, target_soc, max_rate):
+    """
+    Reference implementation which simulates every rate with the curve applied and picks the lowest that hits the target
+    """
+    minutes_left = window["end"] - minutes_now - 10
+    if minutes_left < 0 or soc >= target_soc or max_rate * minutes_left < (target_soc - soc):
+        return max_rate
+    min_rate = (target_soc - soc) / minutes_left
+    rate_w = max_rate * 60 * 1000
+    best_rate = max_rate
+    while rate_w >= 400:
+        rate = rate_w / (60 * 1000)
+        if rate >= min_rate:
+            charge_now = soc
+            for minute in range(0, minutes_left, 5):
+                max_charge_rate = (
+                    model.battery_rate_max_charge * model.battery_charge_power_curve.get(calc_percent_limit(charge_now, model.soc_max), 1.0) * model.battery_rate_max_scaling
+                )
+                charge_now += max(min(rate, max_charge_rate), model.battery_rate_min) * 5 * model.battery_loss
+                if charge_now >= target_soc:
+                    best_rate = rate
+                    break
+        rate_w -= 125.0
+    return best_rate
+
+
+def run_find_charge_rate_tests(my_predbat):
+    print("**** Running find charge rate tests ****")
+    reset_inverter(my_predbat)
+    failed = False
+    set_charge_low_power = my_predbat.set_charge_low_power
+    my_predbat.set_charge_low_power = True
+    my_predbat.soc_max = 10.0
+    my_predbat.battery_rate_max_charge = 2.6 / 60.0
+    my_predbat.battery_loss = 0.96
+    window = {"start": my_predbat.minutes_now, "end": my_predbat.minutes_now + 180}
+    for curve in [{}, {85: 0.8, 90: 0.6, 95: 0.4, 96: 0.3, 97: 0.25, 98: 0.2, 99: 0.15, 100: 0.1}]:
+        my_predbat.battery_charge_power_curve = curve
+        compile_rate_curve_tables(my_predbat)
+        for soc in [0.0, 2.5, 5.0, 8.0, 9.5]:
+            for target_soc in [3.0, 6.0, 9.0, 10.0]:
+                rate = find_charge_rate(my_predbat, my_predbat.minutes_now, soc, window, target_soc, my_predbat.battery_rate_max_charge)
+                expect_rate = find_charge_rate_reference(my_predbat, my_predbat.minutes_now, soc, window, target_soc, my_predbat.battery_rate_max_charge)
+                if rate != expect_rate:
+                    print("ERROR: Charge rate from soc {} to {} with curve {} is {} but expected {}".format(soc, target_soc, curve, rate, expect_rate))
+                    failed = True
+    my_predbat.set_charge_low_power = set_charge_low_power
+    reset_inverter(my_predbat)
+    return failed
+
+
+def run_window_index_tests(my_predbat):
+    print("**** Running window index tests ****")
+    reset_inverter(my_predbat)
+    failed = False
+    minutes_now = my_predbat.minutes_now
+    windows = [
+        {"start": minutes_now - 60, "end": minutes_now + 30},
+        {"start": minutes_now + 60, "end": minutes_now + 90},
+        {"start": minutes_now + 90, "end": minutes_now + 180},
+        {"start": minutes_now + 302, "end": minutes_now + 362},
+        {"start": minutes_now + 600, "end": minutes_now + 1440},
+    ]
+    window_index = WindowIndex(windows)
+    for minute in range(minutes_now - 120, minutes_now + 1500, 5):
+        if window_index.find(minute) != my_predbat.in_charge_window(windows, minute):
+            print("ERROR: Window index find minute {} gave {} expected {}".format(minute, window_index.find(minute), my_predbat.in_charge_window(windows, minute)))
+            failed = True
+        for length in [5, 30, 120]:
+            if window_index.hit(minute, minute + length) != my_predbat.hit_charge_window(windows, minute, minute + length):
+                print("ERROR: Window index hit {} - {} gave {}".format(minute, minute + length, window_index.hit(minute, minute + length)))
+                failed = True
+
+    prediction = Prediction(my_predbat, {}, {}, {}, {})
+    steps = int((my_predbat.forecast_minutes + 60) / 5)
+    window_optimised = prediction.find_charge_window_optimised(windows)
+    if prediction.find_charge_window_array(windows, steps) != [window_optimised.get(minutes_now + step_n * 5, -1) for step_n in range(steps)]:
+        print("ERROR: Window step array does not match the window dictionary")
+        failed = True
+    return failed
+
+
+def clean_incrementing_reverse_reference(data, length, state, max_increment, accumulate):
+    """
+    Dictionary based fill, clean, accumulate and rounding of incrementing history used to check MinuteSeries
+    """
+    mdata = dict(data)
+    for minute in range(length):
+        rindex = length - minute - 1
+        state = mdata.get(rindex, state)
+        mdata[rindex] = state
+
+    new_data = {}
+    end = max(mdata) + 1
+    increment = 0
+    last = mdata[end - 1]
+    for index in range(end):
+        rindex = end - index - 1
+        nxt = mdata.get(rindex, last)
+        if nxt >= last:
+            if (max_increment > 0) and ((nxt - last) > max_increment):
+                pass
+            else:
+                increment += nxt - last
+            last = nxt
+        elif nxt < last:
+            if nxt <= 0 or ((last - nxt) >= (1.0)):
+                last = nxt
+        new_data[rindex] = increment
+
+    for minute in range(length):
+        if minute in new_data:
+            new_data[minute] += accumulate.get(minute, 0)
+        else:
+            new_data[minute] = accumulate.get(minute, 0)
+    return {minute: round(value, 4) for minute, value in new_data.items()}
+
+
+def run_minute_series_tests(my_predbat):
+    print("**** Running minute series tests ****")
+    failed = False
+    length = 3 * 24 * 60
+
+    # Sparse incrementing data with daily resets, small glitches, a spike and data older than the length
+    data = {}
+    value = 0
+    for minute in range(length + 90, -30, -1):
+        if minute % 7 == 0 or minute % 11 == 0:
+            continue
+        if minute % (24 * 60) == 0:
+            value = 0
+        elif minute == 1000:
+            value += 50
+        elif minute % 97 == 0:
+            value -= 0.3
+        else:
+            value += 0.0123
+        data[minute] = value
+    accumulate = {minute: minute * 0.001 for minute in range(0, length, 3)}
+
+    for max_increment in [0, 1.0]:
+        expected = clean_incrementing_reverse_reference(data, length, 0, max_increment, accumulate)
+        series = MinuteSeries.from_history(data, length).clean_incrementing_reverse(max_increment)
+        series_dict = MinuteSeries(series.data).accumulate(accumulate, length).round(4)
+        series_series = MinuteSeries(series.data).accumulate(MinuteSeries([accumulate.get(minute, 0) for minute in range(length)]), length).round(4)
+        if series_dict != expected or series_series != expected:
+            print("ERROR: Minute series with max increment {} does not match dictionary version".format(max_increment))
+            failed = True
+        for index in [-1, 0, 500, length - 1, len(series_dict) - 1, len(series_dict) + 5]:
+            for backwards in [True, False]:
+                if my_predbat.get_from_incrementing(series_dict, index, backwards) != my_predbat.get_from_incrementing(expected, index, backwards):
+                    print("ERROR: Minute series increment at {} backwards {} does not match dictionary version".format(index, backwards))
+                    failed = True
+
+    if my_predbat.clean_incrementing_reverse(data, 1.0).round(4) != clean_incrementing_reverse_reference(data, 0, 0, 1.0, {}):
+        print("ERROR: Clean incrementing reverse of a dictionary does not match")
+        failed = True
+    return failed
+
+
+def run_history_store_tests(my_predbat):
+    print("**** Running history store tests ****")
+    failed = False
+    base_time = datetime.strptime("2024-05-01T00:00:00+0000", TIME_FORMAT_HA)
+    states = []
+    for count in range(0, 6 * 24 * 60, 7):
+        point = base_time + timedelta(minutes=count, seconds=count % 60)
+        states.append({"entity_id": "sensor.load_today", "state": str(count % 500), "last_updated": point.strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")})
+
+    calls = []
+
+    def api_call(endpoint, data_in=None, post=False, core=True):
+        # Mimic HA, the state at the start of the period is returned with the start time
+        if data_in.get("filter_entity_id") == "sensor.broken":
+            raise ValueError("bad history")
+        start = my_predbat.str2time(endpoint.split("/")[-1])
+        end = my_predbat.str2time(data_in["end_time"])
+        calls.append(start)
+        result = []
+        previous = None
+        for item in states:
+            item_time = my_predbat.str2time(item["last_updated"])
+            if item_time <= start:
+                previous = item
+            elif item_time <= end:
+                result.append(item)
+        if previous:
+            previous = previous.copy()
+            previous["last_updated"] = endpoint.split("/")[-1]
+            result.insert(0, previous)
+        return [result]
+
+    ha_interface = HAInterface.__new__(HAInterface)
+    ha_interface.base = my_predbat
+    ha_interface.log = my_predbat.log
+    ha_interface.ha_key = "test"
+    ha_interface.history_store = {}
+    ha_interface.history_cache_path = tempfile.mkdtemp()
+    ha_interface.api_call = api_call
+
+    now = base_time + timedelta(days=3, hours=22)
+    for step in range(40):
+        now += timedelta(minutes=5 if step != 30 else 120)
+        if step == 20:
+            # Restart, history is loaded from the cache and only the tail fetched
+            ha_interface.history_store = {}
+        history = ha_interface.get_history("sensor.load_today", now, days=2)
+        full = api_call("/api/history/period/{}".format((now - timedelta(days=2)).strftime(TIME_FORMAT_HA)), {"end_time": now.strftime(TIME_FORMAT_HA)})
+        calls.pop()
+        if history != full:
+            print("ERROR: Incremental history at {} does not match full fetch".format(now))
+            failed = True
+        rollover = step > 0 and (now - timedelta(minutes=5)).date() != now.date()
+        if step > 0 and step != 30 and not rollover and calls[-1] == now - timedelta(days=2):
+            print("ERROR: Incremental history at {} made a full fetch".format(now))
+            failed = True
+
+    # The cache keeps when the history was fetched and the values as they were
+    key = ("sensor.load_today", 2)
+    stored = ha_interface.history_store[key]
+    stored["history"] = [item.copy() for item in stored["history"]]
+    stored["history"][-1]["attributes"] = {"flags": [1, 1.0, True]}
+    stored["history"][-2]["state"] = 1
+    stored["history"][-3]["state"] = 1.0
+    ha_interface.save_history_cache(key, stored, now)
+    ha_interface.history_store = {}
+    loaded = ha_interface.load_history_cache(key, now + timedelta(minutes=HISTORY_MAX_GAP + 5), now - timedelta(days=2))
+    if not loaded or loaded["fetched"] != stored["fetched"] or loaded["date"] != stored["date"] or loaded["history"] != stored["history"]:
+        print("ERROR: History cache did not restore the stored history")
+        failed = True
+    elif [type(item["state"]) for item in loaded["history"][-3:-1]] != [float, int]:
+        print("ERROR: History cache did not keep the value types")
+        failed = True
+
+    # A cache saved too long ago is fetched in full
+    calls.clear()
+    ha_interface.history_store = {}
+    later = now + timedelta(minutes=HISTORY_MAX_GAP + 5)
+    ha_interface.get_history("sensor.load_today", later, days=2)
+    if calls != [later - timedelta(days=2)]:
+        print("ERROR: History cache older than the maximum gap was not fetched in full")
+        failed = True
+
+    # Several sensors are fetched concurrently and returned in order
+    now += timedelta(minutes=5)
+    sensors = ["sensor.load_today", "sensor.import_today", "sensor.load_today", "sensor.export_today"]
+    histories = ha_interface.get_history_multiple(sensors, now, days=2)
+    full = api_call("/api/history/period/{}".format((now - timedelta(days=2)).strftime(TIME_FORMAT_HA)), {"end_time": now.strftime(TIME_FORMAT_HA)})
+    if len(histories) != len(sensors) or any(history != full for history in histories):
+        print("ERROR: History for multiple sensors does not match full fetch")
+        failed = True
+
+    # A sensor which fails to fetch doesn't stop the others
+    histories = ha_interface.get_history_multiple(["sensor.load_today", "sensor.broken", "sensor.export_today"], now, days=2)
+    if histories[1] is not None or histories[0] != full or histories[2] != full:
+        print("ERROR: History for multiple sensors with a failing sensor is wrong")
+        failed = True
+    return failed
+
+
 def run_window_sort_test(
     name, my_predbat, charge_window_best, discharge_window_best, expected=[], inverter_loss=1.0, metric_battery_cycle=0.0, battery_loss=1.0, battery_loss_discharge=1.0
 ):
@@ -622,6 +1000,80 @@ def run_optimise_levels_tests(my_predbat):
     return failed
 
 
+def run_discharge_search_tests(my_predbat):
+    """
+    The discharge beam search must stay within its bound of simulations and find a plan as good as the sweep when each window is worth discharging
+    """
+    print("**** Running Discharge search tests ****")
+    reset_inverter(my_predbat)
+    failed = False
+    end_record = my_predbat.forecast_minutes
+    my_predbat.calculate_best_charge = True
+    my_predbat.calculate_best_discharge = True
+    my_predbat.calculate_discharge_first = True
+    my_predbat.soc_max = 100.0
+    my_predbat.soc_kw = 100.0
+    my_predbat.inverter_loss = 1.0
+
+    # Many half hour export slots at different rates, the battery is big enough to export in all of them
+    reset_rates(my_predbat, 10.0, 5.0)
+    discharge_window_best = []
+    for window_n in range(24):
+        start = my_predbat.minutes_now + 60 + window_n * 30
+        discharge_window_best.append({"start": start, "end": start + 30, "average": 6.0 + (window_n * 7) % 13})
+    update_rates_export(my_predbat, discharge_window_best)
+    charge_window_best = [{"start": my_predbat.minutes_now + 20 * 60, "end": my_predbat.minutes_now + 21 * 60, "average": 10.0}]
+    update_rates_import(my_predbat, charge_window_best)
+
+    pv_step = {}
+    load_step = {}
+    for minute in range(0, my_predbat.forecast_minutes, 5):
+        pv_step[minute] = 0
+        load_step[minute] = 0
+    my_predbat.prediction = Prediction(my_predbat, pv_step, pv_step, load_step, load_step)
+
+    record_charge_windows = max(my_predbat.max_charge_windows(end_record + my_predbat.minutes_now, charge_window_best), 1)
+    record_discharge_windows = max(my_predbat.max_charge_windows(end_record + my_predbat.minutes_now, discharge_window_best), 1)
+    window_sorted, window_index, price_set, price_links = my_predbat.sort_window_by_price_combined(
+        charge_window_best[:record_charge_windows], discharge_window_best[:record_discharge_windows]
+    )
+    my_predbat.optimise_charge_windows_reset(reset_all=True)
+    my_predbat.optimise_charge_windows_manual()
+
+    results = {}
+    for greedy in [False, True]:
+        my_predbat.calculate_discharge_greedy = greedy
+        tried_list = {}
+        charge_limit_best, discharge_limits_best, _, _, best_metric, _, _, _, _, _, _, _ = my_predbat.optimise_charge_limit_price_threads(
+            price_set,
+            price_links,
+            window_index,
+            record_charge_windows,
+            record_discharge_windows,
+            [0 for n in range(len(charge_window_best))],
+            charge_window_best,
+            discharge_window_best,
+            [100 for n in range(len(discharge_window_best))],
+            end_record=end_record,
+            fast=True,
+            quiet=True,
+            tried_list=tried_list,
+        )
+        results[greedy] = (charge_limit_best, discharge_limits_best, best_metric, len(tried_list))
+    my_predbat.calculate_discharge_greedy = False
+
+    bands = len(price_set) + 1
+    if results[True][3] > bands * (1 + OPTIMISE_DISCHARGE_BEAM * OPTIMISE_DISCHARGE_BEAM_STEPS):
+        print("ERROR: Discharge beam search tried {} plans for {} price bands".format(results[True][3], bands))
+        failed = True
+    if results[True][2] > results[False][2] + 0.1:
+        print(
+            "ERROR: Discharge beam search found metric {} plan {} but the sweep found {} plan {}".format(results[True][2], results[True][1], results[False][2], results[False][1])
+        )
+        failed = True
+    return failed
+
+
 def run_optimise_levels(
     name,
     my_predbat,
@@ -726,6 +1178,94 @@ def run_optimise_levels(
         print("ERROR: Expected best metric {} but got {}".format(expect_metric, best_metric))
         failed = True
 
+    # Repeating the optimisation must be served from the result cache and give the same plan
+    cache = my_predbat.prediction.result_cache
+    misses = cache.misses
+    repeat_charge_limit_best, repeat_discharge_limits_best, repeat_best_price, _, repeat_best_metric, _, _, _, _, _, _, _ = my_predbat.optimise_charge_limit_price_threads(
+        price_set,
+        price_links,
+        window_index,
+        record_charge_windows,
+        record_discharge_windows,
+        charge_limit_best,
+        charge_window_best,
+        discharge_window_best,
+        discharge_limits_best,
+        end_record=end_record,
+        fast=True,
+        quiet=True,
+    )
+    if cache.misses != misses or not cache.hits:
+        print("ERROR: Expected repeated optimisation to hit the result cache, hits {} misses {} before {}".format(cache.hits, cache.misses, misses))
+        failed = True
+    if (repeat_charge_limit_best, repeat_discharge_limits_best, repeat_best_price, repeat_best_metric) != (charge_limit_best, discharge_limits_best, best_price, best_metric):
+        print("ERROR: Repeated optimisation from the result cache gave a different plan")
+        failed = True
+
+    # Launching the plans ahead of time must give the same plan with the results collected from the prefetch batch
+    my_predbat.prediction.result_cache = PredictionCache()
+    cache = my_predbat.prediction.result_cache
+    my_predbat.optimise_region_prefetch(
+        price_set,
+        price_links,
+        window_index,
+        record_charge_windows,
+        record_discharge_windows,
+        charge_limit_best,
+        charge_window_best,
+        discharge_window_best,
+        discharge_limits_best,
+        end_record,
+        None,
+        None,
+        fast=True,
+    )
+    prefetch_charge_limit_best, prefetch_discharge_limits_best, prefetch_best_price, _, prefetch_best_metric, _, _, _, _, _, _, _ = my_predbat.optimise_charge_limit_price_threads(
+        price_set,
+        price_links,
+        window_index,
+        record_charge_windows,
+        record_discharge_windows,
+        charge_limit_best,
+        charge_window_best,
+        discharge_window_best,
+        discharge_limits_best,
+        end_record=end_record,
+        fast=True,
+        quiet=True,
+    )
+    cache.clear_pending()
+    if not cache.prefetch_hits or cache.prefetch_hits > cache.prefetched:
+        print("ERROR: Expected prefetched results to be used, prefetched {} used {}".format(cache.prefetched, cache.prefetch_hits))
+        failed = True
+    if (prefetch_charge_limit_best, prefetch_discharge_limits_best, prefetch_best_price, prefetch_best_metric) != (
+        charge_limit_best,
+        discharge_limits_best,
+        best_price,
+        best_metric,
+    ):
+        print("ERROR: Optimisation with prefetched results gave a different plan")
+        failed = True
+
+    # The coarse to fine search must select the same charge level as the full search, all windows are set so all levels are tried
+    if charge_window_best:
+        all_n = [n for n in range(len(charge_window_best))]
+        fine_result = my_predbat.optimise_charge_limit(
+            0, record_charge_windows, charge_limit_best, charge_window_best, discharge_window_best, discharge_limits_best, all_n=all_n, end_record=end_record
+        )
+        my_predbat.calculate_coarse_to_fine = True
+        coarse_result = my_predbat.optimise_charge_limit(
+            0, record_charge_windows, charge_limit_best, charge_window_best, discharge_window_best, discharge_limits_best, all_n=all_n, end_record=end_record
+        )
+        my_predbat.calculate_coarse_to_fine = False
+        if coarse_result[0:2] != fine_result[0:2]:
+            print(
+                "ERROR: Coarse to fine charge search selected soc {} metric {} but full search selected soc {} metric {}".format(
+                    coarse_result[0], coarse_result[1], fine_result[0], fine_result[1]
+                )
+            )
+            failed = True
+
     if failed:
         old_log = my_predbat.log
         my_predbat.log = print
@@ -755,6 +1295,641 @@ def run_optimise_levels(
     return failed
 
 
+def run_optimise_dp_tests(my_predbat):
+    """
+    Benchmark the dynamic programming optimiser against the price threshold and per window search on identical inputs
+    """
+    print("**** Running Optimise dynamic programming tests ****")
+    reset_inverter(my_predbat)
+    failed = False
+    my_predbat.calculate_best_charge = True
+    my_predbat.calculate_best_discharge = True
+    my_predbat.soc_max = 10.0
+    my_predbat.soc_kw = 2.0
+    my_predbat.inverter_hybrid = False
+    my_predbat.inverter_loss = 1.0
+    reset_rates(my_predbat, 20.0, 5.0)
+
+    # Half hour slots for 12 hours, cheap to import for the first 4 hours and good to export from hours 8 to 10
+    charge_window_best = []
+    discharge_window_best = []
+    start = int(my_predbat.minutes_now / 30) * 30 + 30
+    for slot in range(0, 24):
+        slot_start = start + slot * 30
+        charge_window_best.append({"start": slot_start, "end": slot_start + 30, "average": 5.0 if slot < 8 else 20.0})
+        discharge_window_best.append({"start": slot_start, "end": slot_start + 30, "average": 30.0 if 16 <= slot < 20 else 5.0})
+    update_rates_import(my_predbat, charge_window_best)
+    update_rates_export(my_predbat, discharge_window_best)
+
+    pv_step = {}
+    load_step = {}
+    for minute in range(0, my_predbat.forecast_minutes, 5):
+        pv_step[minute] = 0
+        load_step[minute] = 0.5 / (60 / 5)
+    my_predbat.prediction = Prediction(my_predbat, pv_step, pv_step, load_step, load_step)
+
+    results = {}
+    for dynamic_programming in [False, True]:
+        my_predbat.charge_window_best = copy.deepcopy(charge_window_best)
+        my_predbat.discharge_window_best = copy.deepcopy(discharge_window_best)
+        my_predbat.charge_limit_best = [0.0 for n in range(len(charge_window_best))]
+        my_predbat.discharge_limits_best = [100.0 for n in range(len(discharge_window_best))]
+        my_predbat.end_record = my_predbat.forecast_minutes
+        my_predbat.calculate_dynamic_programming = dynamic_programming
+        start_time = time.time()
+        my_predbat.optimise_all_windows(9999999, 0)
+        run_time = time.time() - start_time
+        charge_limit_best, charge_window_best_clipped = remove_intersecting_windows(
+            my_predbat.charge_limit_best, my_predbat.charge_window_best, my_predbat.discharge_limits_best, my_predbat.discharge_window_best
+        )
+        end_record = my_predbat.end_record
+        result = my_predbat.prediction.run_prediction_array(
+            charge_limit_best, charge_window_best_clipped, my_predbat.discharge_window_best, my_predbat.discharge_limits_best, False, end_record
+        )
+        result10 = my_predbat.prediction.run_prediction_array(
+            charge_limit_best, charge_window_best_clipped, my_predbat.discharge_window_best, my_predbat.discharge_limits_best, True, end_record
+        )
+        results[dynamic_programming] = (my_predbat.compute_metric_result(end_record, result, result10), run_time)
+        print("Optimiser dynamic programming {} took {} seconds with metric {}".format(dynamic_programming, round(run_time, 3), results[dynamic_programming][0]))
+    my_predbat.calculate_dynamic_programming = False
+
+    # The plan must make use of the cheap import and the export peak and come close to the full search
+    metric_search = results[False][0]
+    metric_dp = results[True][0]
+    if metric_dp > metric_search + max(1.0, abs(metric_search) * 0.02):
+        print("ERROR: Dynamic programming metric {} is worse than the search metric {}".format(metric_dp, metric_search))
+        failed = True
+
+    # Windows starting together are capped to a limited number of distinct combinations which keep the lowest and highest levels
+    charge_options = [0.0] + [my_predbat.soc_max * level / 20 for level in range(1, 21)]
+    discharge_options = [100.0] + [5.0 * level for level in range(20)]
+    windows = [("c", 0), ("c", 1), ("d", 0)]
+    options = my_predbat.optimise_plan_dp_options(windows, charge_options, discharge_options, {0: {0}, 1: {1}}, {0: [0]})
+    if len(options) > OPTIMISE_DP_STAGE_OPTIONS or len(set(options)) != len(options):
+        print("ERROR: Dynamic programming tried {} options for a stage, expected at most {} distinct".format(len(options), OPTIMISE_DP_STAGE_OPTIONS))
+        failed = True
+    for option in [(0.0, 0.0, 100.0), (0.0, my_predbat.soc_max, 100.0), (my_predbat.soc_max, my_predbat.soc_max, 100.0)]:
+        if option not in options:
+            print("ERROR: Dynamic programming options for a stage are missing {}".format(option))
+            failed = True
+    return failed
+
+
+def run_step_data_history_tests(my_predbat):
+    print("**** Running step data history tests ****")
+    failed = False
+    saved = {}
+    for name in [
+        "days_previous",
+        "days_previous_weight",
+        "load_minutes_age",
+        "load_filter_modal",
+        "car_charging_hold",
+        "car_charging_energy",
+        "iboost_energy_subtract",
+        "iboost_energy_today",
+    ]:
+        saved[name] = getattr(my_predbat, name)
+
+    # Incrementing series running backwards in time with a daily pattern
+    length = 8 * 24 * 60
+    load = [0] * length
+    car = [0] * length
+    for minute in range(length - 2, -1, -1):
+        load[minute] = load[minute + 1] + 0.002 + 0.01 * ((minute % (24 * 60)) > 17 * 60) + 0.0001 * (minute % 7)
+        car[minute] = car[minute + 1] + 0.12 * ((minute % (24 * 60)) < 120)
+    load_series = MinuteSeries(load)
+    car_dict = {minute: car[minute] for minute in range(length) if minute % 3}
+
+    my_predbat.days_previous = [1, 3, 7]
+    my_predbat.days_previous_weight = [1.0, 0.5, 1.0]
+    my_predbat.load_minutes_age = 5
+    my_predbat.iboost_energy_subtract = True
+    my_predbat.iboost_energy_today = MinuteSeries(car[:3000])
+    count = 36 * 60
+    for car_hold, car_energy in [[False, {}], [True, car_dict], [True, {}]]:
+        my_predbat.car_charging_hold = car_hold
+        my_predbat.car_charging_energy = car_energy
+        for data in [load_series, car_dict, {}]:
+            history = my_predbat.get_historical_array(data, count)
+            if history != [my_predbat.get_historical(data, minute) for minute in range(count)]:
+                print("ERROR: Historical array differs from get_historical car hold {}".format(car_hold))
+                failed = True
+            history = my_predbat.get_historical_base_array(data, 24 * 60 + 100, count)
+            if history != [my_predbat.get_historical_base(data, minute, 24 * 60 + 100) for minute in range(count)]:
+                print("ERROR: Historical base array differs from get_historical_base")
+                failed = True
+            loads, loads_raw = my_predbat.get_filtered_load_history(data, range(0, count, PREDICT_STEP), PREDICT_STEP)
+            expected = [my_predbat.get_filtered_load_minute(data, minute, historical=True, step=PREDICT_STEP) for minute in range(0, count, PREDICT_STEP)]
+            if list(zip(loads, loads_raw)) != expected:
+                print("ERROR: Filtered load history differs from get_filtered_load_minute car hold {}".format(car_hold))
+                failed = True
+
+    # Repeated additions made together round the same as one at a time
+    for value, amount, count in [(0, 0.0833, 300), (5, 1e-16, 20), (1023.99, 0.0125, 5000), (17.3, 3 * 2.0**-45, 100), (-2.5, 0.75, 9)]:
+        expect_value = value
+        for index in range(count):
+            expect_value += amount
+        if add_repeated(value, amount, count) != expect_value:
+            print("ERROR: add_repeated({}, {}, {}) gave {} expected {}".format(value, amount, count, add_repeated(value, amount, count), expect_value))
+            failed = True
+
+    # Modal filter and gap filling against the per minute version
+    my_predbat.car_charging_hold = True
+    my_predbat.car_charging_energy = MinuteSeries(car)
+    for load_filter_modal, gaps in [[True, []], [True, [(100, 400)]], [False, [(1500, 1700), (1800, 1830), (4000, 4100)]], [True, [(2 * 24 * 60 + 10, 3 * 24 * 60 + 60)]]]:
+        my_predbat.load_filter_modal = load_filter_modal
+        gap_load = list(load)
+        for gap_start, gap_end in gaps:
+            for minute in range(gap_end, gap_start - 1, -1):
+                gap_load[minute] = gap_load[gap_end + 1]
+            for minute in range(gap_start - 1, -1, -1):
+                gap_load[minute] = gap_load[minute + 1] + (load[minute] - load[minute + 1])
+        for data_type in [MinuteSeries, dict]:
+            my_predbat.days_previous = [1, 2, 3, 4]
+            my_predbat.days_previous_weight = [1.0, 1.0, 1.0, 1.0]
+            if data_type == dict:
+                data = {minute: value for minute, value in enumerate(gap_load) if minute % 7 != 3}
+            else:
+                data = MinuteSeries(gap_load)
+            expected = dict(data.items())
+            previous_days_modal_filter_reference(my_predbat, expected)
+            expected_days = (my_predbat.days_previous, my_predbat.days_previous_weight)
+            my_predbat.days_previous = [1, 2, 3, 4]
+            my_predbat.days_previous_weight = [1.0, 1.0, 1.0, 1.0]
+            my_predbat.previous_days_modal_filter(data)
+            if (my_predbat.days_previous, my_predbat.days_previous_weight) != expected_days or sorted(data.keys()) != sorted(expected.keys()):
+                print("ERROR: Modal filter days {} expected {} for gaps {}".format(my_predbat.days_previous, expected_days, gaps))
+                failed = True
+            elif any(data[minute] != expected[minute] for minute in expected):
+                print("ERROR: Modal filter gap filling differs from the per minute version for gaps {}".format(gaps))
+                failed = True
+
+    for name, value in saved.items():
+        setattr(my_predbat, name, value)
+    return failed
+
+
+def previous_days_modal_filter_reference(my_predbat, data):
+    """
+    The modal filter and gap filling as they were before previous_days_modal_filter was made single pass, used to check it gives the same output
+    """
+
+    total_points = len(my_predbat.days_previous)
+    sum_days = []
+    sum_days_id = {}
+    min_sum = 99999999
+    min_sum_day = 0
+
+    idx = 0
+    for days in my_predbat.days_previous:
+        use_days = max(min(days, my_predbat.load_minutes_age), 1)
+        sum_day = 0
+        full_days = 24 * 60 * (use_days - 1)
+        for minute in range(0, 24 * 60, PREDICT_STEP):
+            minute_previous = 24 * 60 - minute + full_days
+            load_yesterday, load_yesterday_raw = my_predbat.get_filtered_load_minute(data, minute_previous, historical=False, step=PREDICT_STEP)
+            sum_day += load_yesterday
+        sum_days.append(my_predbat.dp2(sum_day))
+        sum_days_id[days] = sum_day
+        if sum_day < min_sum:
+            min_sum_day = days
+            min_sum_day_idx = idx
+            min_sum = my_predbat.dp2(sum_day)
+        idx += 1
+
+    my_predbat.log("Historical data totals for days {} are {} - min {}".format(my_predbat.days_previous, sum_days, min_sum))
+    if my_predbat.load_filter_modal and total_points >= 3 and (min_sum_day > 0):
+        my_predbat.log("Model filter enabled - Discarding day {} as it is the lowest of the {} datapoints".format(min_sum_day, len(my_predbat.days_previous)))
+        del my_predbat.days_previous[min_sum_day_idx]
+        del my_predbat.days_previous_weight[min_sum_day_idx]
+
+    # Gap filling
+    gap_size = max(my_predbat.get_arg("load_filter_threshold", 30), 5)
+    for days in my_predbat.days_previous:
+        use_days = max(min(days, my_predbat.load_minutes_age), 1)
+        num_gaps = 0
+        full_days = 24 * 60 * (use_days - 1)
+        for minute in range(0, 24 * 60, PREDICT_STEP):
+            minute_previous = 24 * 60 - minute + full_days
+            if data.get(minute_previous, 0) == data.get(minute_previous + gap_size, 0):
+                num_gaps += PREDICT_STEP
+
+        # If we have some gaps
+        if num_gaps > 0:
+            average_day = sum_days_id[days]
+            if (average_day == 0) or (num_gaps >= 24 * 60):
+                my_predbat.log("Warn: Historical day {} has no data, unable to fill gaps normally using nominal 24kWh - you should fix your system!".format(days))
+                average_day = 24.0
+            else:
+                real_data_percent = ((24 * 60) - num_gaps) / (24 * 60)
+                average_day /= real_data_percent
+                my_predbat.log(
+                    "Warn: Historical day {} has {} minutes of gap in the data, filled from {} kWh to make new average {} kWh (percent {}%)".format(
+                        days, num_gaps, my_predbat.dp2(sum_days_id[days]), my_predbat.dp2(average_day), my_predbat.dp0(real_data_percent * 100.0)
+                    )
+                )
+
+            # Do the filling
+            per_minute_increment = average_day / (24 * 60)
+            for minute in range(0, 24 * 60, PREDICT_STEP):
+                minute_previous = 24 * 60 - minute + full_days
+                if data.get(minute_previous, 0) == data.get(minute_previous + gap_size, 0):
+                    for offset in range(minute_previous, 0, -1):
+                        if offset in data:
+                            data[offset] += per_minute_increment * PREDICT_STEP
+                        else:
+                            data[offset] = per_minute_increment * PREDICT_STEP
+
+
+def run_write_behind_tests(my_predbat):
+    print("**** Running write behind tests ****")
+    failed = False
+    ha_interface = HAInterface.__new__(HAInterface)
+    ha_interface.base = my_predbat
+    ha_interface.log = my_predbat.log
+    ha_interface.ha_key = "test"
+    ha_interface.state_data = {}
+    ha_interface.write_queue = {}
+    ha_interface.write_lock = threading.Lock()
+    ha_interface.websocket_active = True
+    ha_interface.write_task_active = True
+
+    def api_call(endpoint, data_in=None, post=False, core=True):
+        print("ERROR: Write behind made a direct API call to {}".format(endpoint))
+        return None
+
+    ha_interface.api_call = api_call
+
+    # Repeated writes to an entity are combined and can be read back straight away
+    for count in range(10):
+        ha_interface.set_state("predbat.status", "Idle {}".format(count), attributes={"count": count})
+        ha_interface.set_state("sensor.predbat_charge_limit_{}".format(count % 3), count)
+    if ha_interface.get_state("predbat.status") != "Idle 9" or ha_interface.get_state("predbat.status", attribute="count") != 9:
+        print("ERROR: Write behind state not updated locally")
+        failed = True
+    if len(ha_interface.write_queue) != 4:
+        print("ERROR: Write behind queue should have 4 entities but has {}".format(len(ha_interface.write_queue)))
+        failed = True
+
+    posted = {}
+    my_predbat.published_state["sensor.predbat_charge_limit_0"] = "hash"
+
+    async def post(entity_id, data):
+        await asyncio.sleep(0)
+        posted[entity_id] = data
+        if entity_id == "sensor.predbat_charge_limit_0":
+            raise ValueError("Test failure")
+
+    sent = asyncio.run(ha_interface.flush_writes(post))
+    if sent != 4 or posted.get("predbat.status") != {"state": "Idle 9", "attributes": {"count": 9}} or posted.get("sensor.predbat_charge_limit_2") != {"state": 8}:
+        print("ERROR: Write behind sent {} writes {}".format(sent, posted))
+        failed = True
+    if ha_interface.write_queue or asyncio.run(ha_interface.flush_writes(post)) != 0:
+        print("ERROR: Write behind queue not empty after flush")
+        failed = True
+
+    # A failed write is forgotten locally so the next publish writes it again
+    if ha_interface.get_state("sensor.predbat_charge_limit_0") is not None or "sensor.predbat_charge_limit_0" in my_predbat.published_state:
+        print("ERROR: Write behind failed write was not forgotten")
+        failed = True
+    if ha_interface.get_state("sensor.predbat_charge_limit_2") != 8:
+        print("ERROR: Write behind successful write was forgotten")
+        failed = True
+
+    # The task stops after set_state sees it running but before the write is queued, the write is made directly
+    class StoppingLock:
+        def __enter__(self):
+            ha_interface.write_task_active = False
+
+        def __exit__(self, *args):
+            return False
+
+    direct = []
+    ha_interface.api_call = lambda endpoint, data_in=None, post=False, core=True: direct.append(endpoint)
+    ha_interface.update_state = lambda entity_id: None
+    ha_interface.write_lock = StoppingLock()
+    ha_interface.write_task_active = True
+    ha_interface.set_state("predbat.status", "Stopping")
+    if ha_interface.write_queue or direct != ["/api/states/predbat.status"]:
+        print("ERROR: Write behind write was queued after the task stopped {} {}".format(ha_interface.write_queue, direct))
+        failed = True
+    return failed
+
+
+class TestPublishHAInterface:
+    def __init__(self):
+        self.state_data = {}
+        self.writes = 0
+
+    def get_state(self, entity_id, default=None, attribute=None, refresh=False):
+        return self.state_data.get(entity_id, default)
+
+    def set_state(self, entity_id, state, attributes=None):
+        self.writes += 1
+        self.state_data[entity_id] = state
+
+
+def run_publish_state_tests(my_predbat):
+    print("**** Running publish state tests ****")
+    failed = False
+    old_ha_interface = my_predbat.ha_interface
+    ha_interface = TestPublishHAInterface()
+    my_predbat.ha_interface = ha_interface
+    my_predbat.published_state = {}
+
+    results = {"2024-10-18T10:{:02d}:00+0000".format(minute): minute * 0.1 for minute in range(60)}
+    for count in range(5):
+        my_predbat.dashboard_item("predbat.test_soc", 5.0, {"results": results, "unit_of_measurement": "kWh"})
+    if ha_interface.writes != 1:
+        print("ERROR: Unchanged dashboard item written {} times".format(ha_interface.writes))
+        failed = True
+
+    # Attribute change is written
+    results["2024-10-18T10:00:00+0000"] = 1.0
+    my_predbat.dashboard_item("predbat.test_soc", 5.0, {"results": results, "unit_of_measurement": "kWh"})
+    if ha_interface.writes != 2:
+        print("ERROR: Changed dashboard attributes not written")
+        failed = True
+
+    # State changed in HA by someone else is written again
+    ha_interface.state_data["predbat.test_soc"] = "4.0"
+    my_predbat.dashboard_item("predbat.test_soc", 5.0, {"results": results, "unit_of_measurement": "kWh"})
+    if ha_interface.writes != 3:
+        print("ERROR: Dashboard item not written after HA state changed")
+        failed = True
+
+    # Config refresh forces all entities to be written again
+    my_predbat.published_state = {}
+    my_predbat.dashboard_item("predbat.test_soc", 5.0, {"results": results, "unit_of_measurement": "kWh"})
+    if ha_interface.writes != 4:
+        print("ERROR: Dashboard item not written after refresh")
+        failed = True
+
+    my_predbat.ha_interface = old_ha_interface
+    my_predbat.published_state = {}
+    return failed
+
+
+def run_http_client_tests(my_predbat):
+    print("**** Running HTTP client tests ****")
+    failed = False
+    http_client = HttpClient(timeout=5)
+    http_client.record("GET", "http://givtcp:6345/readData?x=1", 0.2)
+    http_client.record("GET", "http://givtcp:6345/readData", 0.4)
+    http_client.record("POST", "http://givtcp:6345/setChargeTarget", 1.0, failed=True)
+    stats = http_client.get_stats()
+    read_stats = stats.get("GET http://givtcp:6345/readData", {})
+    if read_stats.get("count") != 2 or abs(read_stats.get("average", 0) - 0.3) > 1e-9 or read_stats.get("max") != 0.4 or read_stats.get("errors") != 0:
+        print("ERROR: HTTP client stats for readData are wrong {}".format(stats))
+        failed = True
+    if stats.get("POST http://givtcp:6345/setChargeTarget", {}).get("errors") != 1:
+        print("ERROR: HTTP client stats for setChargeTarget are wrong {}".format(stats))
+        failed = True
+
+    # Requests for different entities and timestamps are counted against the same route
+    http_client.record("GET", "http://ha:8123/api/history/period/2024-05-31T00:00:00+0000?filter_entity_id=sensor.load", 0.1)
+    http_client.record("GET", "http://ha:8123/api/history/period/2024-06-01T00:00:00+0000?filter_entity_id=sensor.pv", 0.1)
+    http_client.record("POST", "http://ha:8123/api/states/sensor.predbat_status", 0.1)
+    http_client.record("POST", "http://ha:8123/api/states/predbat.status", 0.1)
+    stats = http_client.get_stats()
+    if stats.get("GET http://ha:8123/api/history/period", {}).get("count") != 2 or stats.get("POST http://ha:8123/api/states", {}).get("count") != 2 or len(stats) != 4:
+        print("ERROR: HTTP client stats are not grouped by route {}".format(list(stats.keys())))
+        failed = True
+
+    # Requests that fail to connect are recorded as errors
+    try:
+        http_client.get("http://127.0.0.1:1/api/", timeout=1)
+        print("ERROR: HTTP client request to a closed port should fail")
+        failed = True
+    except requests.exceptions.RequestException:
+        pass
+    if http_client.get_stats().get("GET http://127.0.0.1:1/api/", {}).get("errors") != 1:
+        print("ERROR: HTTP client did not record the failed request")
+        failed = True
+
+    # Each thread has its own session but they share the connection pool
+    sessions = [http_client.session]
+    thread = threading.Thread(target=lambda: sessions.append(http_client.session))
+    thread.start()
+    thread.join()
+    if sessions[0] is not http_client.session or sessions[0] is sessions[1]:
+        print("ERROR: HTTP client sessions are not per thread")
+        failed = True
+    if any(session.get_adapter("http://ha:8123/") is not http_client.adapter for session in sessions):
+        print("ERROR: HTTP client sessions do not share the adapter")
+        failed = True
+    return failed
+
+
+def run_prediction_shared_tests(my_predbat):
+    """
+    Worker processes attached to the shared memory must give the same results as the parent, only the settings and step arrays are published
+    """
+    print("**** Running shared prediction tests ****")
+    reset_inverter(my_predbat)
+    failed = False
+    pv_step = {}
+    load_step = {}
+    for minute in range(0, my_predbat.forecast_minutes, 5):
+        pv_step[minute] = 0
+        load_step[minute] = 0.5 / (60 / 5)
+    charge_window = [{"start": my_predbat.minutes_now + 60, "end": my_predbat.minutes_now + 240, "average": 10.0}]
+    args_list = [([charge_limit], charge_window, [], [], False, my_predbat.forecast_minutes, PREDICT_STEP) for charge_limit in [0.0, 5.0, 10.0]]
+
+    shared = PredictionShared()
+    pool = Pool(processes=1, initializer=prediction_worker_init, initargs=(shared.control_name(),))
+    try:
+        # Each plan is published as a new generation which the worker switches to
+        for import_rate in [10.0, 20.0]:
+            reset_rates(my_predbat, import_rate, 5.0)
+            prediction = Prediction(my_predbat, pv_step, pv_step, load_step, load_step)
+            shared.publish(prediction)
+            expect_results = [prediction.thread_run_prediction_single(*args) for args in args_list]
+            results = pool.apply(wrapped_run_prediction_chunk, ("thread_run_prediction_single", args_list))
+            if results != expect_results:
+                print("ERROR: Shared prediction with import rate {} gave {} expected {}".format(import_rate, results, expect_results))
+                failed = True
+
+        pickle_len, base = struct.unpack_from(SHARED_DATA_FORMAT, shared.block.buf, 0)
+        offset = struct.calcsize(SHARED_DATA_FORMAT)
+        header = pickle.loads(shared.block.buf[offset : offset + pickle_len])
+        if any(name in header for name in SHARED_INPUTS) or "battery_charge_rate_table" in header:
+            print("ERROR: Shared prediction header holds data the workers build themselves {}".format(sorted(header.keys())))
+            failed = True
+    finally:
+        pool.close()
+        pool.join()
+        shared.close()
+    return failed
+
+
+def run_scheduler_tests(my_predbat):
+    """
+    The scheduler must give the same results on each backend and only cancel chunks which have not been launched
+    """
+    print("**** Running Scheduler tests ****")
+    reset_inverter(my_predbat)
+    failed = False
+    reset_rates(my_predbat, 10.0, 5.0)
+    pv_step = {}
+    load_step = {}
+    for minute in range(0, my_predbat.forecast_minutes, 5):
+        pv_step[minute] = 0
+        load_step[minute] = 0.5 / (60 / 5)
+    prediction = Prediction(my_predbat, pv_step, pv_step, load_step, load_step)
+    charge_window = [{"start": my_predbat.minutes_now + 60, "end": my_predbat.minutes_now + 240, "average": 10.0}]
+    args_list = [([charge_limit], charge_window, [], [], False, my_predbat.forecast_minutes, PREDICT_STEP) for charge_limit in [0.0, 2.0, 4.0, 6.0, 8.0, 10.0]]
+    expect_results = [prediction.thread_run_prediction_single(*args) for args in args_list]
+
+    pool = ThreadPool(processes=2)
+    for backend, backend_pool in [("inline", None), ("thread", pool)]:
+        scheduler = PredictionScheduler(prediction, backend_pool)
+        futures = scheduler.submit_many("thread_run_prediction_single", args_list, scheduler.chunk_size(len(args_list)))
+        completed = list(scheduler.as_completed(futures))
+        if len(completed) != len(futures) or set(completed) != set(futures):
+            print("ERROR: Scheduler {} completed {} of {} futures".format(backend, len(completed), len(futures)))
+            failed = True
+        results = [future.get() for future in futures]
+        if results != expect_results:
+            print("ERROR: Scheduler {} results {} expected {}".format(backend, results, expect_results))
+            failed = True
+    pool.close()
+    pool.join()
+
+    # Inline there is one worker so only SCHEDULER_QUEUE_DEPTH chunks are launched at once and the rest can be cancelled
+    scheduler = PredictionScheduler(prediction, None)
+    futures = scheduler.submit_many("thread_run_prediction_single", args_list)
+    cancelled = scheduler.cancel(futures)
+    if set(cancelled) != set(futures[SCHEDULER_QUEUE_DEPTH:]):
+        print("ERROR: Scheduler cancelled {} of {} futures, expected {}".format(len(cancelled), len(futures), len(futures) - SCHEDULER_QUEUE_DEPTH))
+        failed = True
+    results = [future.get() for future in futures[:SCHEDULER_QUEUE_DEPTH]]
+    if results != expect_results[:SCHEDULER_QUEUE_DEPTH]:
+        print("ERROR: Scheduler results after cancel {}".format(results))
+        failed = True
+    for future in cancelled:
+        try:
+            future.get()
+            print("ERROR: Getting the result of a cancelled call should raise CancelledError")
+            failed = True
+        except CancelledError:
+            pass
+
+    # Waiting on calls whose worker has gone must raise rather than wait forever
+    class LostBackend:
+        workers = 1
+
+        def apply(self, name, args_list, callback, error_callback):
+            pass
+
+        def failure(self):
+            return "Worker exited"
+
+    scheduler = PredictionScheduler(prediction, None)
+    scheduler.backend = LostBackend()
+    futures = scheduler.submit_many("thread_run_prediction_single", args_list)
+    try:
+        futures[0].get()
+        print("ERROR: Waiting on a call whose worker exited should raise SchedulerError")
+        failed = True
+    except SchedulerError:
+        pass
+    if scheduler.matches(prediction, None):
+        print("ERROR: A scheduler which lost its worker should be replaced")
+        failed = True
+
+    # An exception raised by a call is raised again when its result is collected
+    scheduler = PredictionScheduler(prediction, pool=ThreadPool(processes=1))
+    future = scheduler.submit("thread_run_prediction_single", (None, charge_window, [], [], False, my_predbat.forecast_minutes, PREDICT_STEP))
+    try:
+        future.get()
+        print("ERROR: The exception raised by a call should be raised again by get")
+        failed = True
+    except TypeError:
+        pass
+    scheduler.pool.close()
+    scheduler.pool.join()
+
+    # Clearing the pending results of a prefetch batch cancels its chunks which have not been launched
+    scheduler = PredictionScheduler(prediction, None)
+    futures = scheduler.submit_many("thread_run_prediction_single", args_list)
+    cache = PredictionCache()
+    batch = PredictionBatchHandle([None] * len(args_list), list(range(len(args_list))), cache, [([row], future) for row, future in enumerate(futures)])
+    for row in range(len(args_list)):
+        cache.add_pending(row, batch, row)
+    cache.clear_pending(cancel=scheduler.cancel)
+    if cache.pending or scheduler.cancelled != len(futures) - SCHEDULER_QUEUE_DEPTH:
+        print("ERROR: Clearing pending results left {} pending and cancelled {} futures".format(len(cache.pending), scheduler.cancelled))
+        failed = True
+
+    # Regions which share a window are not independent, a window which ends on the region boundary is in both
+    charge_window = [{"start": my_predbat.minutes_now + 60, "end": my_predbat.minutes_now + 120}, {"start": my_predbat.minutes_now + 240, "end": my_predbat.minutes_now + 300}]
+    discharge_window = [{"start": my_predbat.minutes_now + 120, "end": my_predbat.minutes_now + 180}]
+    first = my_predbat.region_windows(charge_window, discharge_window, 2, 1, my_predbat.minutes_now, my_predbat.minutes_now + 120)
+    second = my_predbat.region_windows(charge_window, discharge_window, 2, 1, my_predbat.minutes_now + 120, my_predbat.minutes_now + 240)
+    third = my_predbat.region_windows(charge_window, discharge_window, 2, 1, my_predbat.minutes_now + 250, my_predbat.minutes_now + 360)
+    if first != {("c", 0), ("d", 0)} or first.isdisjoint(second) or not first.isdisjoint(third):
+        print("ERROR: Region windows {} {} {}".format(first, second, third))
+        failed = True
+    return failed
+
+
+def str2time_reference(value):
+    """
+    strptime based timestamp parsing used to check and benchmark str2time
+    """
+    if "." in value:
+        return datetime.strptime(value, TIME_FORMAT_SECONDS)
+    elif "T" in value:
+        return datetime.strptime(value, TIME_FORMAT)
+    else:
+        return datetime.strptime(value, TIME_FORMAT_OCTOPUS)
+
+
+def run_str2time_tests(my_predbat):
+    print("**** Running str2time tests ****")
+    failed = False
+
+    samples = [
+        "2024-05-01T10:20:30.123456+00:00",
+        "2024-05-01T10:20:30.5+01:00",
+        "2024-05-01T10:20:30.123Z",
+        "2024-05-01T10:20:30+00:00",
+        "2024-05-01T10:20:30Z",
+        "2024-05-01T10:20:30-0530",
+        "2024-05-01 10:20:30+00:00",
+        "2024-05-01 10:20:30+0100",
+        "2024-5-1T10:20:30+00:00",
+    ]
+    for value in samples:
+        if str2time(value) != str2time_reference(value) or str2time(value).utcoffset() != str2time_reference(value).utcoffset():
+            print("ERROR: str2time of {} gave {} expected {}".format(value, str2time(value), str2time_reference(value)))
+            failed = True
+    for value in ["2024-05-01T10:20:30", "2024-05-01 10:20:30.123+00:00", "2024-13-01T10:20:30+00:00", "bad"]:
+        try:
+            str2time(value)
+            print("ERROR: str2time of {} should fail".format(value))
+            failed = True
+        except ValueError:
+            pass
+
+    # Benchmark on a synthetic 30 day history with an update every minute
+    base_time = datetime.strptime("2024-05-01T00:00:00+0000", TIME_FORMAT_HA)
+    history = [(base_time + timedelta(minutes=minute, seconds=minute % 60, microseconds=minute * 7)).isoformat() for minute in range(30 * 24 * 60)]
+    start_time = time.time()
+    expected = [str2time_reference(value) for value in history]
+    reference_time = time.time() - start_time
+    start_time = time.time()
+    result = [str2time(value) for value in history]
+    fast_time = time.time() - start_time
+    print("str2time parsed {} timestamps in {} seconds, strptime took {} seconds".format(len(history), round(fast_time, 3), round(reference_time, 3)))
+    if result != expected:
+        print("ERROR: str2time results differ from strptime")
+        failed = True
+    return failed
+
+
 def run_perf_test(my_predbat):
     print("**** Running Performance tests ****")
     reset_inverter(my_predbat)
@@ -2048,7 +3223,20 @@ def main():
     failed |= run_model_tests(my_predbat)
     failed |= run_window_sort_tests(my_predbat)
     failed |= run_optimise_levels_tests(my_predbat)
+    failed |= run_discharge_search_tests(my_predbat)
+    failed |= run_optimise_dp_tests(my_predbat)
     failed |= run_compute_metric_tests(my_predbat)
+    failed |= run_find_charge_rate_tests(my_predbat)
+    failed |= run_window_index_tests(my_predbat)
+    failed |= run_minute_series_tests(my_predbat)
+    failed |= run_history_store_tests(my_predbat)
+    failed |= run_str2time_tests(my_predbat)
+    failed |= run_step_data_history_tests(my_predbat)
+    failed |= run_http_client_tests(my_predbat)
+    failed |= run_prediction_shared_tests(my_predbat)
+    failed |= run_scheduler_tests(my_predbat)
+    failed |= run_write_behind_tests(my_predbat)
+    failed |= run_publish_state_tests(my_predbat)
     failed |= run_perf_test(my_predbat)
 
     if failed:
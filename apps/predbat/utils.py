@@ -13,8 +13,48 @@ import os
 import re
 import time
 import math
+from array import array
+from bisect import bisect_left, bisect_right
 from datetime import datetime, timedelta
-from config import MINUTE_WATT, PREDICT_STEP
+from config import MINUTE_WATT, PREDICT_STEP, TIME_FORMAT, TIME_FORMAT_SECONDS, TIME_FORMAT_OCTOPUS
+
+# ISO 8601 timestamps as returned by HA and Octopus which fromisoformat can parse once the zone and fraction are normalised
+TIME_ISO_FAST = re.compile(r"(\d{4}-\d{2}-\d{2})(?:T(\d{2}:\d{2}:\d{2})(?:\.(\d{1,6}))?| (\d{2}:\d{2}:\d{2}))(Z|[+-]\d{2}:?\d{2})$")
+STR2TIME_MEMO_SIZE = 4096
+str2time_memo = {}
+
+
+def str2time(value):
+    """
+    Convert a timestamp string into a timezone aware datetime
+    Repeated timestamps (e.g. rate slot boundaries) are returned from a small memo
+    """
+    tdata = str2time_memo.get(value, None)
+    if tdata is not None:
+        return tdata
+
+    match = TIME_ISO_FAST.match(value)
+    if match:
+        date, time_t, fraction, time_s, zone = match.groups()
+        if zone == "Z":
+            zone = "+00:00"
+        elif len(zone) == 5:
+            zone = zone[:3] + ":" + zone[3:]
+        if fraction:
+            tdata = datetime.fromisoformat(date + "T" + time_t + "." + fraction.ljust(6, "0") + zone)
+        else:
+            tdata = datetime.fromisoformat(date + "T" + (time_t or time_s) + zone)
+    elif "." in value:
+        tdata = datetime.strptime(value, TIME_FORMAT_SECONDS)
+    elif "T" in value:
+        tdata = datetime.strptime(value, TIME_FORMAT)
+    else:
+        tdata = datetime.strptime(value, TIME_FORMAT_OCTOPUS)
+
+    if len(str2time_memo) >= STR2TIME_MEMO_SIZE:
+        str2time_memo.clear()
+    str2time_memo[value] = tdata
+    return tdata
 
 
 def calc_percent_limit(charge_limit, soc_max):
@@ -33,6 +73,225 @@ def calc_percent_limit(charge_limit, soc_max):
             return min(int((float(charge_limit) / soc_max * 100.0) + 0.5), 100)
 
 
+def add_repeated(value, amount, count):
+    """
+    Add a positive amount to value count times, the result is exactly the same as adding it one at a time
+
+    While the total stays below the next power of two every addition rounds by the same amount so those are made together
+    """
+    while count > 0:
+        if not math.isfinite(value):
+            return value + amount
+        if value <= amount:
+            value += amount
+            count -= 1
+            continue
+        ulp = math.ulp(value)
+        units = amount / ulp
+        whole = math.floor(units)
+        if units - whole == 0.5:
+            # A tie rounds to even so depends on the value, add it on its own
+            value += amount
+            count -= 1
+            continue
+        step = whole + 1 if units - whole > 0.5 else whole
+        if step == 0:
+            return float(value)
+        value_units = int(value / ulp)
+        steps = min((2**53 - 1 - value_units) // step, count)
+        if steps == 0:
+            value += amount
+            count -= 1
+            continue
+        value = (value_units + steps * step) * ulp
+        count -= steps
+    return value
+
+
+class WindowIndex:
+    """
+    Index of a list of windows sorted by start time so the window containing a minute or intersecting a period
+    can be found by bisection rather than a scan of the whole list
+    """
+
+    def __init__(self, windows):
+        order = sorted(range(len(windows)), key=lambda window_n: windows[window_n]["start"])
+        self.starts = [windows[window_n]["start"] for window_n in order]
+        self.ends = [windows[window_n]["end"] for window_n in order]
+        self.ids = order
+
+        # Latest end of any window up to each position, bounds how far back an overlapping window can start
+        self.max_ends = []
+        max_end = None
+        for end in self.ends:
+            max_end = end if max_end is None else max(max_end, end)
+            self.max_ends.append(max_end)
+
+    def hit(self, start, end):
+        """
+        Returns the index of the first window in the original list which intersects the period start - end or -1
+        """
+        found = -1
+        pos = bisect_left(self.starts, end) - 1
+        while pos >= 0 and self.max_ends[pos] > start:
+            if self.ends[pos] > start and (found < 0 or self.ids[pos] < found):
+                found = self.ids[pos]
+            pos -= 1
+        return found
+
+    def find(self, minute):
+        """
+        Returns the index of the first window in the original list which contains the minute or -1
+        """
+        found = -1
+        pos = bisect_right(self.starts, minute) - 1
+        while pos >= 0 and self.max_ends[pos] > minute:
+            if self.ends[pos] > minute and (found < 0 or self.ids[pos] < found):
+                found = self.ids[pos]
+            pos -= 1
+        return found
+
+
+class MinuteSeries:
+    """
+    Dense series of values indexed by minute from 0 to len - 1 held in a float array
+    Provides the read side of the dictionary interface so it can be used in place of a dictionary of minutes
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, values=None):
+        self.data = array("d", values if values is not None else [])
+
+    @classmethod
+    def from_history(cls, mdata, length, state=0):
+        """
+        Create a series from sparse history indexed by minutes ago covering at least length minutes
+        Gaps are filled with the value from the minute before (older), the oldest gap takes state
+        """
+        if mdata:
+            length = max(length, max(mdata) + 1)
+        values = [0.0] * length
+        get = mdata.get
+        for minute in range(length - 1, -1, -1):
+            state = get(minute, state)
+            values[minute] = state
+        return cls(values)
+
+    def clean_incrementing_reverse(self, max_increment=0):
+        """
+        Cleanup an incrementing sensor data that runs backwards in time to remove the
+        resets (where it goes back to 0) and make it always increment
+        """
+        data = self.data
+        length = len(data)
+        new_data = [0.0] * length
+        increment = 0
+        last = data[length - 1] if length else 0
+
+        for rindex in range(length - 1, -1, -1):
+            nxt = data[rindex]
+            if nxt >= last:
+                if (max_increment > 0) and ((nxt - last) > max_increment):
+                    # Smooth out big spikes
+                    pass
+                else:
+                    increment += nxt - last
+                last = nxt
+            elif nxt <= 0 or ((last - nxt) >= (1.0)):
+                last = nxt
+            new_data[rindex] = increment
+
+        self.data = array("d", new_data)
+        return self
+
+    def accumulate(self, other, length):
+        """
+        Add another series or dictionary of minutes to this one over the first length minutes
+        """
+        data = self.data
+        if len(data) < length:
+            data.extend([0.0] * (length - len(data)))
+        if isinstance(other, MinuteSeries):
+            for minute, value in enumerate(other.data[:length]):
+                data[minute] += value
+        else:
+            get = other.get
+            for minute in range(length):
+                data[minute] += get(minute, 0)
+        return self
+
+    def round(self, digits):
+        """
+        Round all the values to the given number of decimal places
+        """
+        self.data = array("d", [round(value, digits) for value in self.data])
+        return self
+
+    def get_increment(self, index, backwards=True):
+        """
+        Get the increment at index of an incrementing series, values outside of the series count as 0
+        """
+        data = self.data
+        length = len(data)
+        if backwards:
+            value = data[index] if index < length else 0
+            previous = data[index + 1] if index + 1 < length else 0
+        else:
+            value = data[index + 1] if index + 1 < length else 0
+            previous = data[index] if index < length else 0
+        return max(value - previous, 0)
+
+    def get(self, minute, default=None):
+        if isinstance(minute, int) and 0 <= minute < len(self.data):
+            return self.data[minute]
+        return default
+
+    def keys(self):
+        return range(len(self.data))
+
+    def values(self):
+        return self.data.tolist()
+
+    def items(self):
+        return zip(range(len(self.data)), self.data)
+
+    def copy(self):
+        return MinuteSeries(self.data)
+
+    def __getitem__(self, minute):
+        if isinstance(minute, int) and 0 <= minute < len(self.data):
+            return self.data[minute]
+        raise KeyError(minute)
+
+    def __setitem__(self, minute, value):
+        if isinstance(minute, int) and 0 <= minute < len(self.data):
+            self.data[minute] = value
+        elif minute == len(self.data):
+            self.data.append(value)
+        else:
+            raise KeyError(minute)
+
+    def __contains__(self, minute):
+        return isinstance(minute, int) and 0 <= minute < len(self.data)
+
+    def __iter__(self):
+        return iter(range(len(self.data)))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __eq__(self, other):
+        if isinstance(other, MinuteSeries):
+            return self.data == other.data
+        if isinstance(other, dict):
+            return len(other) == len(self.data) and all(other.get(minute) == value for minute, value in enumerate(self.data))
+        return NotImplemented
+
+    def __repr__(self):
+        return "MinuteSeries({})".format(len(self.data))
+
+
 def remove_intersecting_windows(charge_limit_best, charge_window_best, discharge_limit_best, discharge_window_best):
     """
     Filters and removes intersecting charge windows
@@ -98,12 +357,24 @@ def remove_intersecting_windows(charge_limit_best, charge_window_best, discharge
     return new_limit_best, new_window_best
 
 
+def compile_rate_curve_tables(model):
+    """
+    Compile the battery charge and discharge power curves into tables of the maximum rate indexed by SOC percent with the scaling applied
+    """
+    model.battery_charge_rate_table = [
+        model.battery_rate_max_charge * model.battery_charge_power_curve.get(soc_percent, 1.0) * model.battery_rate_max_scaling for soc_percent in range(101)
+    ]
+    model.battery_discharge_rate_table = [
+        model.battery_rate_max_discharge * model.battery_discharge_power_curve.get(soc_percent, 1.0) * model.battery_rate_max_scaling_discharge for soc_percent in range(101)
+    ]
+
+
 def get_charge_rate_curve(model, soc, charge_rate_setting, debug=False):
     """
     Compute true charging rate from SOC and charge rate setting
     """
     soc_percent = calc_percent_limit(soc, model.soc_max)
-    max_charge_rate = model.battery_rate_max_charge * model.battery_charge_power_curve.get(soc_percent, 1.0) * model.battery_rate_max_scaling
+    max_charge_rate = model.battery_charge_rate_table[soc_percent]
     if debug:
         print("Max charge rate: {} SOC: {} Charge rate setting: {}".format(max_charge_rate, soc, charge_rate_setting))
     return max(min(charge_rate_setting, max_charge_rate), model.battery_rate_min)
@@ -114,7 +385,7 @@ def get_discharge_rate_curve(model, soc, discharge_rate_setting):
     Compute true discharging rate from SOC and charge rate setting
     """
     soc_percent = calc_percent_limit(soc, model.soc_max)
-    max_discharge_rate = model.battery_rate_max_discharge * model.battery_discharge_power_curve.get(soc_percent, 1.0) * model.battery_rate_max_scaling_discharge
+    max_discharge_rate = model.battery_discharge_rate_table[soc_percent]
     return max(min(discharge_rate_setting, max_discharge_rate), model.battery_rate_min)
 
 
@@ -144,22 +415,28 @@ def find_charge_rate(model, minutes_now, soc, window, target_soc, max_rate, quie
         # What's the lowest we could go?
         min_rate = charge_left / minutes_left
 
-        # Apply the curve at each rate to pick one that works
+        # Rates to pick from in 125W steps down from the max rate
+        rates = []
         rate_w = max_rate * MINUTE_WATT
-        best_rate = max_rate
         while rate_w >= 400:
             rate = rate_w / MINUTE_WATT
             if rate >= min_rate:
-                charge_now = soc
-                minute = 0
-                for minute in range(0, minutes_left, PREDICT_STEP):
-                    rate_scale = get_charge_rate_curve(model, charge_now, rate)
-                    charge_amount = rate_scale * PREDICT_STEP * model.battery_loss
-                    charge_now += charge_amount
-                    if charge_now >= target_soc:
-                        best_rate = rate
-                        break
+                rates.append(rate)
             rate_w -= 125.0
-        return best_rate
+
+        # Work up from the lowest rate and pick the first one that hits the target with the curve applied
+        charge_rate_table = model.battery_charge_rate_table
+        soc_max = model.soc_max
+        battery_rate_min = model.battery_rate_min
+        battery_loss = model.battery_loss
+        for rate in reversed(rates):
+            charge_now = soc
+            for minute in range(0, minutes_left, PREDICT_STEP):
+                soc_percent = calc_percent_limit(charge_now, soc_max)
+                rate_scale = max(min(rate, charge_rate_table[soc_percent]), battery_rate_min)
+                charge_now += rate_scale * PREDICT_STEP * battery_loss
+                if charge_now >= target_soc:
+                    return rate
+        return max_rate
     else:
         return max_rate